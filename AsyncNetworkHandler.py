@@ -0,0 +1,295 @@
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Deque, Dict, List, Tuple
+
+import BetterLog
+import Bundling
+import Metrics
+import NetworkCommunicationConstants
+import NetworkHandler
+import Packet
+from Capabilities import Capabilities
+from NetworkImpairment import NetworkImpairment
+from TransactionHandler import TransactionHandler
+
+
+class NetworkProtocol(asyncio.DatagramProtocol):
+    """
+    Feeds datagrams from the event loop's transport straight into the owning AsyncNetworkHandler
+    """
+
+    def __init__(self, handler: 'AsyncNetworkHandler'):
+        self.handler = handler
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        try:
+            self.handler.__received_packet__(data, addr)
+        except Exception as e:
+            BetterLog.log_incoming("Failed To Process Packet From {}: {}", addr, e, level=BetterLog.WARNING)
+
+    def pause_writing(self):
+        self.handler.SEND_PAUSED = True
+
+    def resume_writing(self):
+        self.handler.__resume_writing__()
+
+    def error_received(self, exc: Exception):
+        BetterLog.log_text("SOCKET ERROR: {}", exc, level=BetterLog.ERROR)
+
+    def connection_lost(self, exc: Exception | None):
+        # The transport closes the socket just before this, so the loop only stops once the port is free again
+        self.handler.LOOP.stop()
+
+
+class AsyncNetworkHandler:
+    """
+    Drop-in replacement for NetworkHandler that receives, reassembles, acknowledges and retransmits on a single event
+    loop thread, without the socket listener thread, cross-thread queues or timer threads.\n
+    Completed messages are handed to the listener on one worker thread, in the order they completed, where
+    NetworkHandler may call it from several executor threads at once. A listener written for NetworkHandler is
+    therefore safe here, the reverse only if it is thread safe
+    """
+
+    def __init__(self, port: int, listener: Callable[[Packet.Message], None], user_id: int, host: str = '',
+                 batched_receive: bool = NetworkCommunicationConstants.BATCHED_RECEIVE, local_port: int | None = None,
+                 impairment: NetworkImpairment | None = None):
+        """
+        The socket binds local_port, port itself when None and any free port when 0.\n
+        batched_receive is accepted for NetworkHandler's signature, the loop already drains every ready datagram
+        between callbacks.\n
+        impairment, for testing, sits in front of the transport and impairs every outgoing datagram
+        """
+        self.USER_ID = user_id
+        self.PORT = port
+        self.HOST = host
+        self.SOCKET = NetworkHandler.create_socket(self.PORT if local_port is None else local_port)
+        self.IMPAIRMENT = impairment
+        if impairment is not None:  # Delayed datagrams are released from the impairment's thread
+            impairment.attach(lambda raw_packet, recipient: self.__call_on_loop__(self.TRANSPORT.sendto, raw_packet,
+                                                                                 recipient))
+
+        # Set the message listener, one worker so messages still reach it in the order they completed
+        self.MESSAGE_LISTENER = listener
+        self.LISTENER_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+        self.LISTENER_PENDING = 0
+        self.LISTENER_PENDING_LOCK = threading.Lock()
+
+        # Datagrams held back, in order, while the transport's write buffer is over its high-water mark
+        self.SEND_BLOCKED: Deque[Tuple[bytes, Tuple[str, int]]] = deque()
+        self.SEND_PAUSED = False
+
+        # Small packets waiting to share a datagram
+        self.BUNDLER = Bundling.Bundler()
+
+        # Create a transaction history handler
+        self.TRANSACTION_HANDLER = TransactionHandler(self.__send_packets__, self.USER_ID, schedule=self.__schedule__)
+        self.PEERS = self.TRANSACTION_HANDLER.peers
+        label = str(self.SOCKET.getsockname()[1])  # PORT is the remote port on a client
+        self.TRANSACTION_HANDLER.track_metrics(label)
+        Metrics.INCOMING_QUEUE_DEPTH.track(self, lambda: {label: self.LISTENER_PENDING})
+        Metrics.OUTGOING_QUEUE_DEPTH.track(self, lambda: {label: len(self.SEND_BLOCKED)})
+
+        # Run everything on one loop
+        self.TRANSPORT: asyncio.DatagramTransport | None = None
+        self.LOOP = asyncio.new_event_loop()
+        self.LOOP_THREAD: threading.Thread = threading.Thread(target=self.__looper__)
+        self.LOOP_THREAD.daemon = True
+        ready = threading.Event()
+        self.LOOP.call_soon(self.__start__, ready)
+        self.LOOP_THREAD.start()
+        ready.wait()
+
+    def __looper__(self):
+        asyncio.set_event_loop(self.LOOP)
+        self.LOOP.run_forever()
+
+    def __start__(self, ready: threading.Event):
+        async def create_endpoint():
+            self.TRANSPORT, _ = await self.LOOP.create_datagram_endpoint(lambda: NetworkProtocol(self),
+                                                                         sock=self.SOCKET)
+            # Pauses the protocol once the transport buffers as much as the socket's own send buffer holds
+            self.TRANSPORT.set_write_buffer_limits(high=NetworkCommunicationConstants.OUTGOING_BUFFER_SIZE_BYTES)
+            self.find_repeats_resends_and_fails()
+            ready.set()
+
+        self.LOOP.create_task(create_endpoint())
+
+    def __on_loop__(self) -> bool:
+        return threading.current_thread() is self.LOOP_THREAD
+
+    def __call_on_loop__(self, callback: Callable, *args):
+        if self.__on_loop__():
+            callback(*args)
+        else:
+            self.LOOP.call_soon_threadsafe(callback, *args)
+
+    def find_repeats_resends_and_fails(self):
+        # Re-armed on the loop rather than creating a new timer thread, and first so a failed poll never ends polling
+        self.LOOP.call_later(NetworkCommunicationConstants.FIND_RESEND_REPEAT_FAIL_POLL_TIME_S,
+                             self.find_repeats_resends_and_fails)
+        try:
+            self.TRANSACTION_HANDLER.fix_ongoing()
+        except Exception as e:
+            BetterLog.log_text("Failed To Poll Transactions: {}", e, level=BetterLog.ERROR)
+        if self.SEND_BLOCKED and self.__is_writable__():  # A transport that never resumes the protocol
+            self.__drain_blocked__()
+
+    def __flush__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        if self.SEND_BLOCKED or not self.__is_writable__():
+            self.__hold__(batch)
+            return
+        sendto = self.TRANSPORT.sendto if self.IMPAIRMENT is None else self.IMPAIRMENT.sendto
+        for index, (raw_packet, recipient) in enumerate(batch):
+            if not self.__is_writable__():  # The transport went over its high-water mark part way through the batch
+                self.__hold__(batch[index:])
+                batch = batch[:index]
+                break
+            sendto(raw_packet, recipient)
+        Metrics.PACKETS_SENT.inc_batch(batch)
+        if BetterLog.LEVEL <= BetterLog.DEBUG:  # Checked once per batch, not per packet
+            for raw_packet, _ in batch:
+                BetterLog.log_packet_sent_bytes(raw_packet)
+
+    def __hold__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        """
+        Keeps batch back until the transport resumes writing, waiting like NetworkHandler's queue rather than dropping
+        """
+        if len(self.SEND_BLOCKED) >= NetworkCommunicationConstants.OUTGOING_QUEUE_SIZE_PACKETS:
+            BetterLog.log_text("OUTGOING QUEUE FULL", level=BetterLog.WARNING)
+        self.SEND_BLOCKED.extend(batch)
+
+    def __is_writable__(self) -> bool:
+        # Transports that never pause the protocol are held back by the bytes they buffer instead
+        return not self.SEND_PAUSED and \
+            self.TRANSPORT.get_write_buffer_size() < NetworkCommunicationConstants.OUTGOING_BUFFER_SIZE_BYTES
+
+    def __resume_writing__(self):
+        self.SEND_PAUSED = False
+        self.__drain_blocked__()
+
+    def __drain_blocked__(self):
+        blocked = list(self.SEND_BLOCKED)
+        self.SEND_BLOCKED.clear()
+        self.__flush__(blocked)
+
+    def __send_packets__(self, packets: List[bytes], recipient: Tuple[str, int]):
+        self.__transmit__([(packet, recipient) for packet in packets])
+
+    def __transmit__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        batch = self.__bundle__(batch)
+        if batch:
+            self.__call_on_loop__(self.__flush__, batch)
+
+    def __bundle__(self, batch: List[Tuple[bytes, Tuple[str, int]]]) -> List[Tuple[bytes, Tuple[str, int]]]:
+        immediate, started = self.BUNDLER.hold(batch, self.PEERS)
+        if started:
+            self.__schedule__(NetworkCommunicationConstants.BUNDLE_DELAY_S, self.__flush_bundles__)
+        return immediate
+
+    def __flush_bundles__(self):
+        self.__flush__(self.BUNDLER.drain())
+
+    def __received_packet__(self, raw_packet: bytes, sender: Tuple[str, int]):
+        if Bundling.is_bundle(raw_packet) and self.PEERS.is_versioned(sender):
+            for packet in Bundling.unbundle(raw_packet):
+                self.__received_packet__(packet, sender)
+            return
+        if Packet.PacketCodec.is_truncated(raw_packet, self.PEERS.is_versioned(sender)):
+            BetterLog.log_incoming("Lame Packet", level=BetterLog.WARNING)
+            return
+        message: Packet.Message | None
+        message = self.TRANSACTION_HANDLER.receive_raw_packet(raw_packet, sender)
+        if message is not None:
+            self.__received_message__(message)
+
+    def __schedule__(self, delay_s: float, callback: Callable[[], None]):
+        self.__call_on_loop__(self.LOOP.call_later, delay_s, callback)
+
+    def send_ack(self, messageid: bytes, recipient: Tuple[str, int]):
+        self.TRANSACTION_HANDLER.acknowledge(messageid, recipient)
+
+    def __received_message__(self, message: Packet.Message):
+        with self.LISTENER_PENDING_LOCK:
+            self.LISTENER_PENDING += 1
+        self.LISTENER_EXECUTOR.submit(self.__listen__, message)
+
+    def __listen__(self, message: Packet.Message):
+        try:
+            self.MESSAGE_LISTENER(message)
+        except Exception as e:
+            BetterLog.log_incoming("Failed To Process Message {}: {}", message.messageid, e, level=BetterLog.WARNING)
+        finally:
+            with self.LISTENER_PENDING_LOCK:
+                self.LISTENER_PENDING -= 1
+
+    def send_message(self, message: Packet.Message, recipient=None, should_track=True) -> bool:
+        return self.send_messages([(message, recipient)], should_track)
+
+    def send_messages(self, messages: List[Tuple[Packet.Message, Tuple[str, int] | None]], should_track=True) -> bool:
+        batch: List[Tuple[bytes, Tuple[str, int]]] = []
+        for message, recipient in messages:
+            if recipient is None:
+                recipient = (self.HOST, self.PORT)
+            try:
+                sent = self.TRANSACTION_HANDLER.prepare_message(message, recipient, should_track)
+            except Packet.MessageTooLarge as e:
+                BetterLog.log_failed_message_send(message)
+                BetterLog.log_text("{}", e, level=BetterLog.WARNING)
+                self.__transmit__(batch)  # Earlier messages are already tracked
+                return False
+            batch.extend((bytepacket, recipient) for bytepacket in sent)
+            BetterLog.log_message_sent(message)
+        self.__transmit__(batch)
+        return True
+
+    def send_shared(self, message: Packet.Message, recipients: List[Tuple[str, int]], should_track=True) -> bool:
+        """
+        Sends message to every recipient from one set of packets, each recipient still gets its own transaction
+        """
+        try:
+            batch = self.TRANSACTION_HANDLER.prepare_shared(message, recipients, should_track)
+        except Packet.MessageTooLarge as e:
+            BetterLog.log_failed_message_send(message)
+            BetterLog.log_text("{}", e, level=BetterLog.WARNING)
+            return False
+        BetterLog.log_message_sent(message)
+        self.__transmit__(batch)
+        return True
+
+    def set_peer_capabilities(self, peer: Tuple[str, int] | None, capabilities: Capabilities, confirmed: bool = True):
+        if peer is None:
+            peer = (self.HOST, self.PORT)
+        self.PEERS.get(peer).set_capabilities(capabilities, confirmed)
+        if confirmed:
+            self.TRANSACTION_HANDLER.probe_datagram_size(peer)
+
+    def probe_peer(self, peer: Tuple[str, int]):
+        """
+        Probes the datagram size of a peer whose capabilities were set unconfirmed, once the reply carrying the
+        agreement is on its way
+        """
+        self.TRANSACTION_HANDLER.probe_datagram_size(peer)
+
+    def peer_statistics(self) -> Dict[Tuple[str, int], Dict[str, int | float | None]]:
+        return self.TRANSACTION_HANDLER.peer_statistics()
+
+    def shutdown(self):
+        self.TRANSACTION_HANDLER.untrack_metrics()
+        Metrics.INCOMING_QUEUE_DEPTH.untrack(self)
+        Metrics.OUTGOING_QUEUE_DEPTH.untrack(self)
+        if self.IMPAIRMENT is not None:
+            self.IMPAIRMENT.close()
+
+        def stop():
+            if self.TRANSPORT is not None:
+                self.TRANSPORT.close()  # Stops the loop from connection_lost
+            else:
+                self.LOOP.stop()
+                self.SOCKET.close()
+
+        self.LOOP.call_soon_threadsafe(stop)
+        if not self.__on_loop__():  # Returns with the socket closed, so the port can be bound again straight away
+            self.LOOP_THREAD.join(NetworkCommunicationConstants.SHUTDOWN_TIMEOUT_S)
+        self.LISTENER_EXECUTOR.shutdown(wait=False)
@@ -1,84 +1,244 @@
+import itertools
+import sys
 import threading
-
-import eel
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, TextIO, Tuple
 
 from Packet import Packet, Message
 
 PRETTY_PRINT = False
 CALLBACK = None
+SINK = None  # Receives written records, nothing is shown until one is attached
+
+# LEVELS
+DEBUG = 10  # Every packet and transaction
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LEVEL = INFO
+''' Records below this level are dropped before anything is formatted '''
+
+PACKET_SAMPLE_EVERY = 1
+''' Only one in this many packet records is kept, even at DEBUG '''
+
+QUEUE_SIZE = 10_000
+''' Most records waiting for the writer, the oldest are dropped past that rather than blocking the caller '''
+
+WRITE_INTERVAL_S = 0.05
+''' Time (s) the writer waits between drains of the queue '''
+
+# SEQUENCE, SINK, TEXT OR FORMATTER, ARGUMENTS
+Record = Tuple[int, Callable[[str], None], str | Callable[[], str], tuple]
+
+RECORDS: Deque[Record] = deque(maxlen=QUEUE_SIZE)
+PACKET_SAMPLES = itertools.count()
+SEQUENCE = itertools.count()  # Numbers records as they are enqueued, next() on it is atomic so callers never lock
+# Only the writer moves these, a gap in the sequence numbers it pops is the records the full queue pushed out
+WRITTEN = 0
+DROPPED = 0
+NEXT_SEQUENCE = 0
+
+WRITER: threading.Thread | None = None  # Started by the first record, importing this module starts no thread
+WRITER_LOCK = threading.Lock()
+
+
+def enabled(level: int) -> bool:
+    return level >= LEVEL
+
+
+class StreamSink:
+    """
+    Writes records to a text stream, for headless processes
+    """
+
+    def __init__(self, stream: TextIO = sys.stderr):
+        self.stream = stream
+
+    def add_log_message(self, text: str):
+        print(text, file=self.stream)
+
+    def add_outgoing_message(self, text: str):
+        print('>>', text, file=self.stream)
+
+    def add_incoming_message(self, text: str):
+        print('<<', text, file=self.stream)
+
+    def add_message_text(self, text: str, sender: str, isself: bool):
+        print(f"{sender}: {text}", file=self.stream)
+
+
+def attach(sink):
+    """
+    Sends records to sink from now on, anything with the StreamSink methods will do
+    """
+    global SINK
+    SINK = sink
+
+
+def attach_gui(page: str = 'log.html'):
+    """
+    Opens the log window and sends records to it, eel is only imported here
+    """
+    import LogWindow
+    attach(LogWindow.start(page))
+
+
+def write_log(text: str):
+    if SINK is not None and not PRETTY_PRINT:
+        SINK.add_log_message(text)
 
 
-@eel.expose
-def log_text(text: str):
-    if not PRETTY_PRINT:
-        # Call a JavaScript function to add the message to the log
-        eel.add_log_message(text)
+def write_outgoing(text: str):
+    if SINK is not None and not PRETTY_PRINT:
+        SINK.add_outgoing_message(text)
 
 
-@eel.expose
-def log_outgoing(text: str):
-    if not PRETTY_PRINT:
-        # Call a JavaScript function to add the message to the log
-        eel.add_outgoing_message(text)
+def write_incoming(text: str):
+    if SINK is not None and not PRETTY_PRINT:
+        SINK.add_incoming_message(text)
 
 
-@eel.expose
-def log_incoming(text: str):
-    if not PRETTY_PRINT:
-        # Call a JavaScript function to add the message to the log
-        eel.add_incoming_message(text)
+def enqueue(sink: Callable[[str], None], text: str | Callable[[], str], args: tuple = ()):
+    """
+    Hands a record to the writer, text is only formatted with args, or called, once the writer gets to it
+    """
+    RECORDS.append((next(SEQUENCE), sink, text, args))
+    if WRITER is None:
+        __start_writer__()
+
+
+def flush():
+    """
+    Writes every queued record on the calling thread
+    """
+    global WRITTEN, DROPPED, NEXT_SEQUENCE
+    while True:
+        try:
+            sequence, sink, text, args = RECORDS.popleft()
+        except IndexError:
+            return
+        if sequence > NEXT_SEQUENCE:
+            DROPPED += sequence - NEXT_SEQUENCE
+        NEXT_SEQUENCE = sequence + 1
+        WRITTEN += 1
+        try:
+            if callable(text):
+                text = text()
+            elif args:
+                text = text.format(*args)
+            sink(text)
+        except Exception:
+            pass  # A record that cannot be written must never take the writer down with it
+
+
+def __writer__():
+    while True:
+        time.sleep(WRITE_INTERVAL_S)
+        flush()
+
+
+def __start_writer__():
+    global WRITER
+    with WRITER_LOCK:
+        if WRITER is None:
+            WRITER = threading.Thread(target=__writer__)
+            WRITER.daemon = True
+            WRITER.start()
+
+
+def statistics() -> Dict[str, int]:
+    """
+    Records pushed out of a full queue are only counted as dropped once the writer reaches the record after them
+    """
+    return {'queued': len(RECORDS), 'written': WRITTEN, 'dropped': DROPPED}
+
+
+def packet_sampled() -> bool:
+    return next(PACKET_SAMPLES) % PACKET_SAMPLE_EVERY == 0
+
+
+def log_text(text: str, *args, level: int = INFO):
+    if level >= LEVEL:
+        enqueue(write_log, text, args)
+
+
+def log_outgoing(text: str, *args, level: int = INFO):
+    if level >= LEVEL:
+        enqueue(write_outgoing, text, args)
+
+
+def log_incoming(text: str, *args, level: int = INFO):
+    if level >= LEVEL:
+        enqueue(write_incoming, text, args)
+
+
+def log_debug(text: str, *args):
+    if DEBUG >= LEVEL:
+        enqueue(write_log, text, args)
 
 
-@eel.expose
 def log_message_text(text: str, sender: str, isself: bool = False):
-    if PRETTY_PRINT:
-        eel.add_message_text(text, sender, isself)
+    if SINK is not None and PRETTY_PRINT:
+        SINK.add_message_text(text, sender, isself)
 
 
-@eel.expose
 def submit_message(text):
     try:
         CALLBACK(text)
     except:
-        log_text('MESSAGE COULD NOT BE SENT')
-
-
-# Initialize Eel with your HTML file
-eel.init('web')
-
-# Start the Eel application
-thread = threading.Thread(target=eel.start, args=('log.html',))
-thread.daemon = True
-thread.start()
+        log_text('MESSAGE COULD NOT BE SENT', level=ERROR)
 
 
 def log_packet_received(packet: Packet):
-    log_incoming(packet.__str__())
+    # Formatted straight away, the payload may be a view into a receive buffer that is about to be reused
+    if DEBUG >= LEVEL and packet_sampled():
+        enqueue(write_incoming, packet.__str__())
 
 
 def log_message_received(message: Message):
-    log_incoming(message.__str__())
+    if DEBUG >= LEVEL:
+        enqueue(write_incoming, message.__str__)
 
 
 def log_packet_sent(packet: Packet):
-    log_outgoing(packet.__str__())
+    if DEBUG >= LEVEL and packet_sampled():
+        enqueue(write_outgoing, packet.__str__)
 
 
 def log_message_sent(message: Message):
-    log_outgoing(message.__str__())
+    if DEBUG >= LEVEL:
+        enqueue(write_outgoing, message.__str__)
+
+
+def unbundled(datagram: bytes) -> list:
+    """
+    The packets a sent datagram carries, a bundle carries several
+    """
+    import Bundling  # Imported here, as Bundling imports PeerState, which imports this module
+    return Bundling.unbundle(datagram) if Bundling.is_bundle(datagram) else [datagram]
 
 
 def log_packet_sent_bytes(packet: bytes):
-    log_packet_sent(Packet.from_bytes(packet))
+    # Outgoing packets are never rewritten once sent, so they are only parsed if the writer gets to them
+    if DEBUG >= LEVEL and packet_sampled():
+        for sent in unbundled(packet):
+            enqueue(write_outgoing, lambda sent=sent: Packet.from_bytes(sent).__str__())
 
 
 def log_failed_packet_send_bytes(packet: bytes, e: Exception):
-    log_failed_packet_send(Packet.from_bytes(packet), e)
+    if WARNING >= LEVEL:
+        for sent in unbundled(packet):
+            enqueue(write_outgoing, lambda sent=sent: f"FAILED TO SEND\n{Packet.from_bytes(sent).__str__()}\n{e}")
 
 
 def log_failed_message_send(message: Message):
-    log_outgoing(f"FAILED TO SEND\n{message.__str__()}")
+    if WARNING >= LEVEL:
+        enqueue(write_outgoing, lambda: f"FAILED TO SEND\n{message.__str__()}")
 
 
 def log_failed_packet_send(packet: Packet, e: Exception):
-    log_outgoing(f"FAILED TO SEND\n{packet.__str__()}\n{e}")
+    if WARNING >= LEVEL:
+        enqueue(write_outgoing, lambda: f"FAILED TO SEND\n{packet.__str__()}\n{e}")
@@ -0,0 +1,90 @@
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+import NetworkCommunicationConstants
+from PeerState import PeerTable
+
+BUNDLE_MARKER = 0xFF
+''' First byte of a bundle datagram, read as a versioned header it would claim version 15 which is reserved for it '''
+
+ENTRY = struct.Struct('>H')  # LENGTH
+
+
+def is_bundle(datagram: bytes | memoryview) -> bool:
+    return len(datagram) > 0 and datagram[0] == BUNDLE_MARKER
+
+
+def pack(packets: List[bytes]) -> bytes:
+    """
+    A lone packet goes out as it is, several are framed behind the marker with their lengths
+    """
+    if len(packets) == 1:
+        return packets[0]
+    return bytes((BUNDLE_MARKER,)) + b''.join(ENTRY.pack(len(packet)) + packet for packet in packets)
+
+
+def unbundle(datagram: bytes | memoryview) -> List[memoryview]:
+    """
+    Splits a bundle back into views of its packets, a truncated trailing entry is dropped
+    """
+    view = memoryview(datagram)
+    packets: List[memoryview] = []
+    offset = 1
+    while offset + ENTRY.size <= len(view):
+        (length,) = ENTRY.unpack_from(view, offset)
+        offset += ENTRY.size
+        if offset + length > len(view):
+            break
+        packets.append(view[offset:offset + length])
+        offset += length
+    return packets
+
+
+class Bundler:
+    """
+    Small packets per recipient waiting to share one datagram
+    """
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, int], Tuple[List[bytes], int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, packet: bytes, recipient: Tuple[str, int], limit: int) -> Tuple[List[bytes], bool]:
+        """
+        Queues packet, returns any datagrams that filled up and whether a new bundle was started
+        """
+        with self._lock:
+            packets, size = self._pending.get(recipient, ([], 1))
+            ready: List[bytes] = []
+            if packets and size + ENTRY.size + len(packet) > limit:
+                ready.append(pack(packets))
+                packets, size = [], 1
+            packets.append(packet)
+            self._pending[recipient] = (packets, size + ENTRY.size + len(packet))
+            return ready, len(packets) == 1
+
+    def hold(self, batch: List[Tuple[bytes, Tuple[str, int]]], peers: PeerTable) -> Tuple[
+            List[Tuple[bytes, Tuple[str, int]]], bool]:
+        """
+        Holds back small packets to peers that accept bundles, returns what should be sent straight away and whether
+        a new bundle was started
+        """
+        immediate: List[Tuple[bytes, Tuple[str, int]]] = []
+        started = False
+        for packet, recipient in batch:
+            peer = peers.find(recipient)
+            if len(packet) > NetworkCommunicationConstants.BUNDLE_MAXIMUM_PACKET_BYTES or peer is None or \
+                    not peer.accepts_bundles():
+                immediate.append((packet, recipient))
+                continue
+            ready, new_bundle = self.add(packet, recipient, peer.datagram_size)
+            immediate.extend((datagram, recipient) for datagram in ready)
+            started |= new_bundle
+        return immediate, started
+
+    def drain(self) -> List[Tuple[bytes, Tuple[str, int]]]:
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        return [(pack(packets), recipient) for recipient, (packets, _) in pending]
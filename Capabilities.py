@@ -0,0 +1,170 @@
+import struct
+from typing import Dict, Tuple
+
+import Compression
+import NetworkCommunicationConstants
+import Packet
+
+X25519 = 1
+KEY_EXCHANGES: Tuple[int, ...] = (X25519,)
+''' Key agreements this build can negotiate during CONNECT, in order of preference, finite field DH is the fallback.
+Kept here rather than in EncryptionHandler, so the transport never has to import cryptography '''
+
+CAPABILITIES_MAGIC = b'\x00CAPS'
+''' Separates the capability trailer from the rest of a CONNECT payload, a PEM block never contains a NUL byte '''
+
+FIELD = struct.Struct('>BH')  # TAG, LENGTH
+
+
+class Capabilities:
+    """
+    Features a peer supports, exchanged as a trailer on CONNECT.\n
+    Encoded as tag-length-value fields so that peers simply skip tags they do not know. A peer that sends no trailer
+    is a legacy peer and only ever gets the original protocol
+    """
+
+    HEADER_VERSION = 1  # int
+    MAX_DATAGRAM_SIZE = 2  # int
+    FEATURES = 3  # bitmask
+    COMPRESSION = 4  # codec ids, in order of preference
+    KEY_EXCHANGE = 5  # key agreement ids, in order of preference
+    KEY_SHARE = 6  # sender's public key for the first agreement it offers
+    TICKET = 7  # resumption ticket a returning client presents
+    TICKET_NONCE = 8  # sender's fresh nonce for the resumed session's key
+
+    # FEATURES
+    FLOW_CONTROL = 1 << 0
+    ACK_AGGREGATION = 1 << 1
+    BUNDLING = 1 << 2
+    GROUP_BROADCAST = 1 << 3
+    RESUMPTION = 1 << 4
+    CHUNKED_AEAD = 1 << 5
+
+    def __init__(self, header_version: int = 1,
+                 max_datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES, features: int = 0,
+                 compression: Tuple[int, ...] = (), key_exchange: Tuple[int, ...] = (), key_share: bytes = b'',
+                 ticket: bytes = b'', ticket_nonce: bytes = b''):
+        self.header_version = header_version
+        self.max_datagram_size = max_datagram_size
+        self.features = features
+        self.compression = compression
+        self.key_exchange = key_exchange
+        self.key_share = key_share
+        self.ticket = ticket
+        self.ticket_nonce = ticket_nonce
+
+    @classmethod
+    def local(cls) -> 'Capabilities':
+        """
+        Everything this build offers
+        """
+        features = 0
+        if NetworkCommunicationConstants.FLOW_CONTROL:
+            features |= Capabilities.FLOW_CONTROL
+        if NetworkCommunicationConstants.ACK_AGGREGATION:
+            features |= Capabilities.ACK_AGGREGATION
+        if NetworkCommunicationConstants.BUNDLING:
+            features |= Capabilities.BUNDLING
+        if NetworkCommunicationConstants.GROUP_BROADCAST:
+            features |= Capabilities.GROUP_BROADCAST
+        if NetworkCommunicationConstants.RESUMPTION:
+            features |= Capabilities.RESUMPTION
+        if NetworkCommunicationConstants.CHUNKED_AEAD:
+            features |= Capabilities.CHUNKED_AEAD
+        return Capabilities(header_version=NetworkCommunicationConstants.HEADER_VERSION,
+                            max_datagram_size=NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES,
+                            features=features,
+                            compression=Compression.AVAILABLE if NetworkCommunicationConstants.COMPRESSION else (),
+                            key_exchange=KEY_EXCHANGES if NetworkCommunicationConstants.KEY_EXCHANGE else ())
+
+    def agree(self, other: 'Capabilities') -> 'Capabilities':
+        """
+        The features both sides support, the key share and ticket nonce are left for the answering side to fill in.\n
+        Nothing the peer sent is trusted as is, the header version is clamped to one this build can pack and the
+        datagram size never drops below the default packet size every peer is sent anyway
+        """
+        header_version = min(max(min(self.header_version, other.header_version), Packet.HEADER_VERSION_1),
+                             Packet.LATEST_HEADER_VERSION)
+        max_datagram_size = max(min(self.max_datagram_size, other.max_datagram_size),
+                                NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES)
+        return Capabilities(header_version=header_version, max_datagram_size=max_datagram_size,
+                            features=self.features & other.features,
+                            compression=tuple(codec for codec in self.compression if codec in other.compression),
+                            key_exchange=tuple(method for method in self.key_exchange if method in other.key_exchange))
+
+    def supports(self, feature: int) -> bool:
+        return bool(self.features & feature)
+
+    def compression_codec(self) -> int | None:
+        """
+        The agreed codec, None if compression was not agreed and payloads carry no codec flag at all
+        """
+        return self.compression[0] if self.compression else None
+
+    def key_exchange_method(self) -> int | None:
+        """
+        The agreed key agreement, None if both sides fall back to the finite field DH exchange
+        """
+        return self.key_exchange[0] if self.key_exchange else None
+
+    def fields(self) -> Dict[int, bytes]:
+        return {Capabilities.HEADER_VERSION: bytes((self.header_version,)),
+                Capabilities.MAX_DATAGRAM_SIZE: self.max_datagram_size.to_bytes(length=2, byteorder='big'),
+                Capabilities.FEATURES: self.features.to_bytes(length=4, byteorder='big'),
+                Capabilities.COMPRESSION: bytes(self.compression),
+                Capabilities.KEY_EXCHANGE: bytes(self.key_exchange),
+                Capabilities.KEY_SHARE: self.key_share,
+                Capabilities.TICKET: self.ticket,
+                Capabilities.TICKET_NONCE: self.ticket_nonce}
+
+    def to_bytes(self) -> bytes:
+        return CAPABILITIES_MAGIC + b''.join(FIELD.pack(tag, len(value)) + value for tag, value in self.fields().items())
+
+    @classmethod
+    def from_bytes(cls, trailer: bytes) -> 'Capabilities':
+        """
+        Fields that are empty, the wrong length or cut short by the end of the trailer are treated as absent
+        """
+        fields: Dict[int, bytes] = {}
+        offset = len(CAPABILITIES_MAGIC)
+        while offset + FIELD.size <= len(trailer):
+            tag, length = FIELD.unpack_from(trailer, offset)
+            offset += FIELD.size
+            if offset + length > len(trailer):
+                break
+            fields[tag] = bytes(trailer[offset:offset + length])
+            offset += length
+        capabilities = Capabilities()
+        if len(fields.get(Capabilities.HEADER_VERSION, b'')) == 1:
+            capabilities.header_version = fields[Capabilities.HEADER_VERSION][0]
+        if len(fields.get(Capabilities.MAX_DATAGRAM_SIZE, b'')) == 2:
+            capabilities.max_datagram_size = int.from_bytes(fields[Capabilities.MAX_DATAGRAM_SIZE], byteorder='big')
+        if fields.get(Capabilities.FEATURES):  # Any width, so later builds can add features
+            capabilities.features = int.from_bytes(fields[Capabilities.FEATURES], byteorder='big')
+        if Capabilities.COMPRESSION in fields:
+            capabilities.compression = tuple(fields[Capabilities.COMPRESSION])
+        if Capabilities.KEY_EXCHANGE in fields:
+            capabilities.key_exchange = tuple(fields[Capabilities.KEY_EXCHANGE])
+        if Capabilities.KEY_SHARE in fields:
+            capabilities.key_share = fields[Capabilities.KEY_SHARE]
+        if Capabilities.TICKET in fields:
+            capabilities.ticket = fields[Capabilities.TICKET]
+        if Capabilities.TICKET_NONCE in fields:
+            capabilities.ticket_nonce = fields[Capabilities.TICKET_NONCE]
+        return capabilities
+
+    @classmethod
+    def split(cls, payload: bytes) -> Tuple[bytes, 'Capabilities | None']:
+        """
+        Separates a CONNECT payload into its original content and the capability trailer, if there is one
+        """
+        payload = bytes(payload)
+        index = payload.find(CAPABILITIES_MAGIC)
+        if index < 0:
+            return payload, None
+        return payload[:index], Capabilities.from_bytes(payload[index:])
+
+    def __str__(self) -> str:
+        return (f"CAPABILITIES:\n    HeaderVersion: {self.header_version}\n    MaxDatagramSize: {self.max_datagram_size}"
+                f"\n    Features: {self.features:#x}\n    Compression: {self.compression}"
+                f"\n    KeyExchange: {self.key_exchange}")
@@ -1,37 +1,78 @@
-import time
+import os
 
+import AsyncNetworkHandler
+import Compression
 import NetworkCommunicationConstants
 import NetworkHandler
 import Packet
-from typing import Tuple
+from typing import Set, Tuple
 import BetterLog
 import threading
-from EncryptionHandler import EncryptionHandler
+from Capabilities import Capabilities
+import EncryptionHandler
+from EncryptionHandler import GroupKey, GroupKeyring
+from NetworkImpairment import NetworkImpairment
 
 
 class Client:
-    def __init__(self, serverip: str, user_id: int, port: int = 8888):
-        self.handler = NetworkHandler.NetworkHandler(port, self.__recv__, user_id, host=serverip)
+    def __init__(self, serverip: str, user_id: int, port: int = 8888,
+                 single_loop: bool = NetworkCommunicationConstants.SINGLE_LOOP_ENGINE, local_port: int | None = None,
+                 impairment: NetworkImpairment | None = None):
+        """
+        local_port keeps clients on the server's host from binding the server's port, 0 picks any free one.\n
+        impairment impairs everything the client sends, for testing recovery on a lossy network
+        """
+        handler_type = AsyncNetworkHandler.AsyncNetworkHandler if single_loop else NetworkHandler.NetworkHandler
+        self.handler = handler_type(port, self.__recv__, user_id, host=serverip, local_port=local_port,
+                                    impairment=impairment)
         self.user_id = user_id
-        self.encryption_handler = EncryptionHandler(None)
-
-        self.handler.send_message(
-            Packet.Message(self.encryption_handler.dh_parameters_bytes, Packet.PayloadType.CONNECT, self.user_id), None)
-
-        t = threading.Thread(target=self.generate_dh_and_send_public)
-        t.daemon = True
-        t.start()
+        self.encryption_handler = EncryptionHandler.EncryptionHandler(None)
+        self.compression: int | None = None
+        self.group_keys = GroupKeyring()
+        self.ticket: Tuple[bytes, bytes] | None = None  # Resumption secret and the ticket carrying it
+        self.ticket_nonce: bytes | None = None
+        self.server_peers: Set[Tuple[str, int]] = set()  # Every address the server answered from
+        self.connect()
 
         threading.Timer(NetworkCommunicationConstants.HEARTBEAT_FREQUENCY_S, self.send_heartbeat).start()
 
+    def connect(self):
+        """
+        Starts a session with the server, resuming the last one if the server issued a ticket for it, a rejected
+        ticket falls back to the DH exchange
+        """
+        self.encryption_handler = EncryptionHandler.EncryptionHandler(None)
+        self.compression = None  # Only the server's CONNECT reply says which codec this session uses
+        self.ticket_nonce = None
+        # Whatever was negotiated with the server before, it may have restarted and must be negotiated afresh
+        for peer in self.server_peers | {(self.handler.HOST, self.handler.PORT)}:
+            self.handler.PEERS.pop(peer)
+        self.server_peers = set()
+
+        # Capabilities trail the DH parameters, servers that predate them only read the PEM block. A ticket and an
+        # X25519 key share ride along, so a server that accepts either is prepared as soon as it has read CONNECT,
+        # and one that rejects the ticket still answers the key share instead of the finite field DH exchange
+        capabilities = Capabilities.local()
+        if self.ticket is not None:
+            self.ticket_nonce = os.urandom(NetworkCommunicationConstants.RESUMPTION_NONCE_LENGTH)
+            capabilities.ticket = self.ticket[1]
+            capabilities.ticket_nonce = self.ticket_nonce
+        if capabilities.key_exchange_method() == EncryptionHandler.X25519:
+            capabilities.key_share = self.encryption_handler.generate_x25519_keys()
+        self.handler.send_message(
+            Packet.Message(self.encryption_handler.dh_parameters_bytes + capabilities.to_bytes(),
+                           Packet.PayloadType.CONNECT, self.user_id), None)
+
     def generate_dh_and_send_public(self):
-        time.sleep(0.01)
         dh_public, is_prepared = self.encryption_handler.generate_dh_keys()
         self.send_message(Packet.PayloadType.DH_KEY, dh_public)
         if is_prepared:
             self.send_message(Packet.PayloadType.PREPARED)
 
     def receive_other_dh_public(self, other_public_key: bytes):
+        # Only a server that did not agree to X25519 sends its DH key, so the client's own waits until then
+        if self.encryption_handler.needs_dh_keys():
+            self.generate_dh_and_send_public()
         is_prepared = self.encryption_handler.received_other_public_key(other_public_key)
         if is_prepared:
             self.send_message(Packet.PayloadType.PREPARED)
@@ -39,11 +80,13 @@ class Client:
     def send_message(self, payload_type: Packet.PayloadType, payload: bytes = b''):
         if payload_type.should_encrypt():
             if self.encryption_handler.is_prepared():
+                if self.compression is not None:
+                    payload = Compression.compress(payload, self.compression)
                 payload = self.encryption_handler.encrypt(payload)
                 message = Packet.Message(payload, payload_type, self.user_id)
                 self.handler.send_message(message, None)
             else:
-                BetterLog.log_text('COULD NOT SEND MESSAGE: ENCRYPTION NOT READY')
+                BetterLog.log_text('COULD NOT SEND MESSAGE: ENCRYPTION NOT READY', level=BetterLog.WARNING)
         else:
             message = Packet.Message(payload, payload_type, self.user_id)
             self.handler.send_message(message, None)
@@ -57,6 +100,12 @@ class Client:
     def send(self, message: str):
         self.send_message(Packet.PayloadType.CHAT, message.encode())
 
+    def show_chat(self, payload: bytes, user_id: int):
+        if user_id == self.user_id:
+            BetterLog.log_message_text(payload.decode(), str(user_id), True)
+        else:
+            BetterLog.log_message_text(payload.decode(), str(user_id))
+
     def __recv__(self, message: Packet.Message):
         messageid: bytes = message.messageid
         sender: Tuple[str, int] = message.sender
@@ -64,14 +113,29 @@ class Client:
         payload = message.payload
         if message.payloadtype.should_encrypt():
             payload = self.encryption_handler.decrypt(message.payload)
+            if self.compression is not None:
+                payload = Compression.decompress(payload)
 
         if message.payloadtype == Packet.PayloadType.CONNECT:
             # CONNECT
-            pass
+            _, capabilities = Capabilities.split(message.payload)
+            if capabilities is not None:
+                self.compression = capabilities.compression_codec()
+                self.encryption_handler.chunked = capabilities.supports(Capabilities.CHUNKED_AEAD)
+                if capabilities.ticket_nonce and self.ticket is not None and self.ticket_nonce is not None:
+                    self.encryption_handler.resume(self.ticket[0], self.ticket_nonce, capabilities.ticket_nonce)
+                    self.send_message(Packet.PayloadType.PREPARED)
+                elif capabilities.key_exchange_method() == EncryptionHandler.X25519 and capabilities.key_share:
+                    if self.encryption_handler.received_other_x25519_key(capabilities.key_share):
+                        self.send_message(Packet.PayloadType.PREPARED)
+                # The server may answer from a different spelling of the address the client sends to
+                self.server_peers = {sender, (self.handler.HOST, self.handler.PORT)}
+                for peer in self.server_peers:
+                    self.handler.set_peer_capabilities(peer, capabilities)
 
         elif message.payloadtype == Packet.PayloadType.DISCONNECT:
             # DISCONNECT
-            pass
+            BetterLog.log_text("DISCONNECTED BY SERVER")
 
         elif message.payloadtype == Packet.PayloadType.HEARTBEAT:
             # HEARTBEAT
@@ -79,10 +143,25 @@ class Client:
 
         elif message.payloadtype == Packet.PayloadType.CHAT:
             # CHAT
-            if message.userid == self.user_id:
-                BetterLog.log_message_text(payload.decode(), str(message.userid), True)
-            else:
-                BetterLog.log_message_text(payload.decode(), str(message.userid))
+            self.show_chat(payload, message.userid)
+
+        elif message.payloadtype == Packet.PayloadType.GROUP_CHAT:
+            # GROUP CHAT
+            payload = self.group_keys.decrypt(message)
+            if payload is not None:
+                if self.compression is not None:
+                    payload = Compression.decompress(payload)
+                self.show_chat(payload, message.userid)
+
+        elif message.payloadtype == Packet.PayloadType.TICKET:
+            # TICKET
+            self.ticket = (payload[:EncryptionHandler.RESUMPTION_SECRET_LENGTH],
+                           payload[EncryptionHandler.RESUMPTION_SECRET_LENGTH:])
+
+        elif message.payloadtype == Packet.PayloadType.GROUP_KEY:
+            # GROUP KEY
+            for held in self.group_keys.add(GroupKey.from_bytes(payload)):
+                self.__recv__(held)
 
         elif message.payloadtype == Packet.PayloadType.DH_KEY:
             # DH KEY
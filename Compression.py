@@ -0,0 +1,77 @@
+import zlib
+from typing import Callable, Dict, Tuple
+
+import NetworkCommunicationConstants
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+
+AVAILABLE: Tuple[int, ...] = (ZLIB, LZMA)
+''' Codecs this build can use, in order of preference '''
+
+
+class DecompressionError(Exception):
+    pass
+
+
+def decompress_zlib(data: bytes, limit: int) -> bytes:
+    decompressor = zlib.decompressobj()
+    payload = decompressor.decompress(data, limit)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise DecompressionError(f"zlib payload truncated or larger than {limit} bytes")
+    return payload
+
+
+def compress_lzma(payload: bytes) -> bytes:
+    import lzma  # Only a peer that negotiated lzma pays for loading it
+    return lzma.compress(payload)
+
+
+def decompress_lzma(data: bytes, limit: int) -> bytes:
+    import lzma
+    decompressor = lzma.LZMADecompressor()
+    try:
+        payload = decompressor.decompress(data, max_length=limit)
+    except lzma.LZMAError as e:
+        raise DecompressionError(str(e))
+    if not decompressor.eof:
+        raise DecompressionError(f"lzma payload truncated or larger than {limit} bytes")
+    return payload
+
+
+COMPRESSORS: Dict[int, Callable[[bytes], bytes]] = {
+    ZLIB: lambda payload: zlib.compress(payload, NetworkCommunicationConstants.ZLIB_COMPRESSION_LEVEL),
+    LZMA: compress_lzma,
+}
+
+DECOMPRESSORS: Dict[int, Callable[[bytes, int], bytes]] = {
+    ZLIB: decompress_zlib,
+    LZMA: decompress_lzma,
+}
+
+
+def compress(payload: bytes, codec: int) -> bytes:
+    """
+    Prefixes payload with the codec it was compressed with. Payloads below the threshold, or that would not shrink,
+    are flagged NONE and left as they are
+    """
+    if codec != NONE and len(payload) >= NetworkCommunicationConstants.COMPRESSION_THRESHOLD_BYTES:
+        compressed = COMPRESSORS[codec](payload)
+        if len(compressed) < len(payload):
+            return bytes((codec,)) + compressed
+    return bytes((NONE,)) + payload
+
+
+def decompress(frame: bytes) -> bytes:
+    """
+    Reverses compress, refusing anything that would expand past MAXIMUM_DECOMPRESSED_BYTES
+    """
+    if len(frame) == 0:
+        raise DecompressionError("Empty compression frame")
+    codec = frame[0]
+    if codec == NONE:
+        return bytes(frame[1:])
+    if codec not in DECOMPRESSORS:
+        raise DecompressionError(f"Unknown compression codec {codec}")
+    return DECOMPRESSORS[codec](bytes(frame[1:]), NetworkCommunicationConstants.MAXIMUM_DECOMPRESSED_BYTES)
@@ -2,6 +2,7 @@ import time
 from typing import Tuple, Dict, List
 
 import BetterLog
+import Metrics
 from EncryptionHandler import EncryptionHandler
 import NetworkCommunicationConstants
 
@@ -12,6 +13,11 @@ class ConnectedClient:
         self.should_hear_from_time = 0
         self.heard_from()
         self.encryption_handler = EncryptionHandler(payload)
+        self.compression: int | None = None
+        self.group_broadcast = False
+        self.group_key_id: int | None = None  # Group key this client has been sent
+        self.resumption = False
+        self.ticket_issued = False
 
     def heard_from(self):
         self.should_hear_from_time = time.time_ns() + NetworkCommunicationConstants.HEARTBEAT_TIMEOUT_NS
@@ -25,19 +31,20 @@ class ClientList:
         self.client_dictionary: Dict[Tuple[str, int], ConnectedClient] = {}
 
     def received_connection(self, client: Tuple[str, int], user_id: int | None, payload: bytes):
-        BetterLog.log_text(f"ADDED NEW CLIENT: {client}")
+        BetterLog.log_text("ADDED NEW CLIENT: {}", client)
         self.client_dictionary[client] = ConnectedClient(user_id, payload)
 
     def received_heartbeat(self, client: Tuple[str, int]):
         if client in self.client_dictionary:
-            BetterLog.log_text(f"RECEIVED HEARTBEAT: {client}")
+            BetterLog.log_debug("RECEIVED HEARTBEAT: {}", client)
             self.client_dictionary[client].heard_from()
         else:
             self.received_connection(client, None)
 
     def force_disconnect(self, client: Tuple[str, int]):
-        BetterLog.log_text(f"DISCONNECTING CLIENT: {client}")
+        BetterLog.log_text("DISCONNECTING CLIENT: {}", client)
         self.client_dictionary.pop(client, None)
+        Metrics.REGISTRY.forget(client)
 
     def disconnect_inactive(self) -> List[Tuple[str, int]]:
         current = time.time_ns()
@@ -1,13 +1,74 @@
+import itertools
 import os
-from typing import Tuple
+import struct
+import threading
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import List, Sequence, Tuple
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.dh import DHPrivateKey, DHParameters
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
+import NetworkCommunicationConstants
+
+NONCE_LENGTH = 12
+NONCE_PREFIX_LENGTH = 4
+NONCE_COUNTER_LENGTH = NONCE_LENGTH - NONCE_PREFIX_LENGTH
+TAG_LENGTH = 16
+NONCE = struct.Struct('>4sQ')  # PREFIX, COUNTER
+BLOCK_COUNTERS = 1 << (8 * NONCE_COUNTER_LENGTH - 1)
+''' Counters from here up are handed out in contiguous blocks, those below one at a time without taking a lock '''
+CHUNK_SIZE_LENGTH = 4
+INITIATOR_NONCE_BIT = 0x80
+''' Set in the nonce prefix of the side that started the session and clear in the other, so their counters never meet '''
+
+CHUNK_EXECUTOR: Executor | None = None
+CHUNK_EXECUTOR_LOCK = threading.Lock()
+
+
+def chunk_threads() -> int:
+    return min(NetworkCommunicationConstants.AEAD_CHUNK_THREADS, os.cpu_count() or 1)
+
+
+def chunk_executor() -> Executor:
+    """
+    Threads shared by every session for chunked AEAD, AES GCM releases the GIL so chunks really run side by side
+    """
+    global CHUNK_EXECUTOR
+    with CHUNK_EXECUTOR_LOCK:
+        if CHUNK_EXECUTOR is None:
+            CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=chunk_threads())
+        return CHUNK_EXECUTOR
+
+
+def seal_into(aesgcm: AESGCM, nonce: bytes, plaintext: bytes, associated_data: bytes | None,
+              buffer: memoryview) -> int:
+    """
+    Writes ciphertext and tag straight into buffer where the installed cryptography can, returning their length
+    """
+    if hasattr(aesgcm, 'encrypt_into'):
+        return aesgcm.encrypt_into(nonce, plaintext, associated_data, buffer)
+    ciphertext = aesgcm.encrypt(nonce, plaintext, associated_data)
+    buffer[:len(ciphertext)] = ciphertext
+    return len(ciphertext)
+
+
+def open_into(aesgcm: AESGCM, nonce: bytes, ciphertext: bytes, associated_data: bytes | None,
+              buffer: memoryview) -> int:
+    if hasattr(aesgcm, 'decrypt_into'):
+        return aesgcm.decrypt_into(nonce, ciphertext, associated_data, buffer)
+    plaintext = aesgcm.decrypt(nonce, ciphertext, associated_data)
+    buffer[:len(plaintext)] = plaintext
+    return len(plaintext)
+
+
+class NoncesExhausted(Exception):
+    pass
+
 
 class CryptWrapper:
     @classmethod
@@ -17,10 +78,52 @@ class CryptWrapper:
                                                           format=serialization.PublicFormat.SubjectPublicKeyInfo)
 
     @classmethod
-    def generate_aes_gcm_key(cls, self_private_dh: DHPrivateKey, other_public_dh: bytes) -> AESGCM:
+    def generate_serialized_dh_keys(cls, dh_parameters: bytes) -> Tuple[bytes, bytes]:
+        """
+        generate_dh_keys in a form that can cross a process boundary, the private key as DER
+        """
+        private, public = cls.generate_dh_keys(serialization.load_pem_parameters(dh_parameters,
+                                                                                  backend=default_backend()))
+        return private.private_bytes(encoding=serialization.Encoding.DER, format=serialization.PrivateFormat.PKCS8,
+                                     encryption_algorithm=serialization.NoEncryption()), public
+
+    @classmethod
+    def derive_serialized_aes_gcm_key(cls, self_private_dh: bytes, other_public_dh: bytes) -> bytes:
+        """
+        generate_aes_gcm_key from a DER private key, returning the raw AES GCM key
+        """
+        private = serialization.load_der_private_key(self_private_dh, password=None, backend=default_backend())
+        received_public_key = serialization.load_pem_public_key(other_public_dh, backend=default_backend())
         hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=None, backend=default_backend())
+        return hkdf.derive(private.exchange(received_public_key))
+
+    @classmethod
+    def generate_x25519_keys(cls) -> Tuple[X25519PrivateKey, bytes]:
+        private = X25519PrivateKey.generate()
+        return private, private.public_key().public_bytes(encoding=serialization.Encoding.Raw,
+                                                          format=serialization.PublicFormat.Raw)
+
+    @classmethod
+    def generate_aes_gcm_key(cls, self_private_dh: DHPrivateKey, other_public_dh: bytes) -> AESGCM:
         received_public_key = serialization.load_pem_public_key(other_public_dh, backend=default_backend())
-        shared_key = self_private_dh.exchange(received_public_key)
+        return cls.derive_aes_gcm_key(self_private_dh.exchange(received_public_key))
+
+    @classmethod
+    def generate_aes_gcm_key_x25519(cls, self_private: X25519PrivateKey, other_public: bytes) -> AESGCM:
+        return cls.derive_aes_gcm_key(self_private.exchange(X25519PublicKey.from_public_bytes(bytes(other_public))))
+
+    @classmethod
+    def derive_resumed_aes_gcm_key(cls, resumption_secret: bytes, client_nonce: bytes, server_nonce: bytes) -> AESGCM:
+        """
+        Fresh session key from a resumed secret, both nonces make it differ on every resumption of the same ticket
+        """
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=client_nonce + server_nonce, info=b'resumption',
+                    backend=default_backend())
+        return AESGCM(hkdf.derive(resumption_secret))
+
+    @classmethod
+    def derive_aes_gcm_key(cls, shared_key: bytes) -> AESGCM:
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=None, backend=default_backend())
         aesgcm_key = hkdf.derive(shared_key)
         # TODO: Force overwrite other_public, self_private, shared_key, and aesgcm_key
         return AESGCM(aesgcm_key)
@@ -32,5 +135,162 @@ class CryptWrapper:
 
     @classmethod
     def decrypt(cls, aesgcm: AESGCM, ciphertext: bytes) -> bytes:
-        nonce, ciphertext = ciphertext[:12], ciphertext[12:]
-        return aesgcm.decrypt(nonce, ciphertext, None)
+        view = memoryview(ciphertext)
+        return aesgcm.decrypt(view[:NONCE_LENGTH], view[NONCE_LENGTH:], None)
+
+
+class SessionCipher:
+    """
+    AES GCM for one session. Nonces are a per-sender prefix followed by a message counter, so none costs a syscall and
+    none repeats under the key. Frames stay nonce || ciphertext, so peers that decrypt with CryptWrapper.decrypt read
+    them unchanged.\n
+    A chunked frame is the first chunk's nonce, the chunk size and then every chunk sealed on its own under the
+    following counters, with its index and whether it is the last as associated data
+    """
+
+    def __init__(self, aesgcm: AESGCM, initiator: bool):
+        self.aesgcm = aesgcm
+        prefix = bytearray(os.urandom(NONCE_PREFIX_LENGTH))
+        if initiator:
+            prefix[0] |= INITIATOR_NONCE_BIT
+        else:
+            prefix[0] &= ~INITIATOR_NONCE_BIT & 0xFF
+        self.prefix = bytes(prefix)
+        self._counters = itertools.count()  # next() on a count is atomic, so single nonces need no lock
+        self._block = BLOCK_COUNTERS
+        self._lock = threading.Lock()
+
+    def reserve(self, count: int = 1) -> int:
+        """
+        Claims count consecutive counters, returning the first
+        """
+        if count == 1:
+            counter = next(self._counters)
+            if counter >= BLOCK_COUNTERS:
+                raise NoncesExhausted
+            return counter
+        with self._lock:
+            first = self._block
+            if first + count > 1 << (8 * NONCE_COUNTER_LENGTH):
+                raise NoncesExhausted
+            self._block = first + count
+            return first
+
+    def nonce(self, counter: int) -> bytes:
+        return NONCE.pack(self.prefix, counter)
+
+    @classmethod
+    def frame_length(cls, plaintext_length: int) -> int:
+        return NONCE_LENGTH + plaintext_length + TAG_LENGTH
+
+    def encrypt(self, plaintext: bytes) -> bytes | bytearray:
+        if len(plaintext) < NetworkCommunicationConstants.AEAD_COPY_FREE_BYTES:
+            # Below this, one concatenation costs less than setting up the buffer
+            nonce = NONCE.pack(self.prefix, self.reserve())
+            return nonce + self.aesgcm.encrypt(nonce, plaintext, None)
+        frame = bytearray(SessionCipher.frame_length(len(plaintext)))
+        self.encrypt_into(plaintext, frame)
+        return frame
+
+    def encrypt_into(self, plaintext: bytes, buffer: bytearray | memoryview) -> int:
+        """
+        Writes nonce || ciphertext into buffer, returning its length
+        """
+        nonce = self.nonce(self.reserve())
+        view = memoryview(buffer)
+        view[:NONCE_LENGTH] = nonce
+        return NONCE_LENGTH + seal_into(self.aesgcm, nonce, plaintext, None, view[NONCE_LENGTH:])
+
+    def decrypt(self, frame: bytes) -> bytes:
+        if len(frame) < NetworkCommunicationConstants.AEAD_COPY_FREE_BYTES:
+            return self.aesgcm.decrypt(frame[:NONCE_LENGTH], frame[NONCE_LENGTH:], None)
+        view = memoryview(frame)
+        return self.aesgcm.decrypt(view[:NONCE_LENGTH], view[NONCE_LENGTH:], None)
+
+    def decrypt_into(self, frame: bytes, buffer: bytearray | memoryview) -> int:
+        view = memoryview(frame)
+        return open_into(self.aesgcm, view[:NONCE_LENGTH], view[NONCE_LENGTH:], None, memoryview(buffer))
+
+    def encrypt_batch(self, plaintexts: Sequence[bytes]) -> List[bytes]:
+        """
+        Encrypts every plaintext under one block of consecutive counters, claimed with a single lock
+        """
+        first = self.reserve(len(plaintexts))
+        pack, prefix, encrypt = NONCE.pack, self.prefix, self.aesgcm.encrypt
+        frames: List[bytes] = []
+        for counter, plaintext in enumerate(plaintexts, first):
+            nonce = pack(prefix, counter)
+            frames.append(nonce + encrypt(nonce, plaintext, None))
+        return frames
+
+    def decrypt_batch(self, frames: Sequence[bytes]) -> List[bytes]:
+        decrypt = self.aesgcm.decrypt
+        return [decrypt(frame[:NONCE_LENGTH], frame[NONCE_LENGTH:], None) for frame in frames]
+
+    @classmethod
+    def chunk_associated_data(cls, index: int, last: bool) -> bytes:
+        return index.to_bytes(length=4, byteorder='big') + (b'\x01' if last else b'\x00')
+
+    def encrypt_chunked(self, plaintext: bytes,
+                        chunk_size: int = NetworkCommunicationConstants.AEAD_CHUNK_SIZE_BYTES) -> bytearray:
+        """
+        Seals plaintext chunk by chunk, on the shared chunk threads once it is large enough to be worth it
+        """
+        source = memoryview(plaintext)
+        count = max(1, -(-len(source) // chunk_size))
+        first = self.reserve(count)
+        header = NONCE_LENGTH + CHUNK_SIZE_LENGTH
+        frame = bytearray(header + len(source) + count * TAG_LENGTH)
+        view = memoryview(frame)
+        view[:NONCE_LENGTH] = self.nonce(first)
+        view[NONCE_LENGTH:header] = chunk_size.to_bytes(length=CHUNK_SIZE_LENGTH, byteorder='big')
+
+        def seal(index: int):
+            start = index * chunk_size
+            chunk = source[start:start + chunk_size]
+            offset = header + start + index * TAG_LENGTH
+            seal_into(self.aesgcm, self.nonce(first + index), chunk,
+                      SessionCipher.chunk_associated_data(index, index == count - 1),
+                      view[offset:offset + len(chunk) + TAG_LENGTH])
+
+        self.__run_chunks__(seal, count)
+        return frame
+
+    def decrypt_chunked(self, frame: bytes) -> bytearray:
+        view = memoryview(frame)
+        header = NONCE_LENGTH + CHUNK_SIZE_LENGTH
+        if len(view) < header + TAG_LENGTH:
+            raise ValueError("Chunked frame too short")
+        prefix = bytes(view[:NONCE_PREFIX_LENGTH])
+        first = int.from_bytes(view[NONCE_PREFIX_LENGTH:NONCE_LENGTH], byteorder='big')
+        chunk_size = int.from_bytes(view[NONCE_LENGTH:header], byteorder='big')
+        if chunk_size == 0:
+            raise ValueError("Chunked frame has no chunk size")
+        sealed_size = chunk_size + TAG_LENGTH
+        body = len(view) - header
+        count = max(1, -(-body // sealed_size))
+        plaintext_length = body - count * TAG_LENGTH
+        if plaintext_length < 0 or first + count > 1 << (8 * NONCE_COUNTER_LENGTH):
+            raise ValueError("Malformed chunked frame")
+        plaintext = bytearray(plaintext_length)
+        output = memoryview(plaintext)
+
+        def open_chunk(index: int):
+            offset = header + index * sealed_size
+            sealed = view[offset:offset + sealed_size]
+            start = index * chunk_size
+            open_into(self.aesgcm, prefix + (first + index).to_bytes(length=NONCE_COUNTER_LENGTH, byteorder='big'),
+                      sealed, SessionCipher.chunk_associated_data(index, index == count - 1),
+                      output[start:start + len(sealed) - TAG_LENGTH])
+
+        self.__run_chunks__(open_chunk, count)
+        return plaintext
+
+    @classmethod
+    def __run_chunks__(cls, work, count: int):
+        if count < NetworkCommunicationConstants.AEAD_PARALLEL_CHUNKS or chunk_threads() < 2:
+            for index in range(count):
+                work(index)
+        else:
+            # list() re-raises the first failure, an InvalidTag from any chunk rejects the whole frame
+            list(chunk_executor().map(work, range(count)))
@@ -1,32 +1,78 @@
+import functools
+import os
+import threading
 import time
+from collections import OrderedDict, deque
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import dh
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 
 import BetterLog
-from CryptWrapper import CryptWrapper
-from typing import Tuple
+import Metrics
+import NetworkCommunicationConstants
+import Packet
+from Capabilities import KEY_EXCHANGES, X25519
+from CryptWrapper import CryptWrapper, SessionCipher
+from typing import Deque, List, Tuple
 
 
 class AESGCMKeyHasNotBeenGenerated(Exception):
     pass
 
 
+RFC3526_GROUP_14_PRIME = int(
+    'FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74020BBEA63B139B22514A08798E3404DD'
+    'EF9519B3CD3A431B302B0A6DF25F14374FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED'
+    'EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF0598DA48361C55D39A69163FA8FD24CF5F'
+    '83655D23DCA3AD961C62F356208552BB9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B'
+    'E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF6955817183995497CEA956AE515D2261898FA0510'
+    '15728E5A8AACAA68FFFFFFFFFFFFFFFF', 16)
+''' 2048-bit MODP group 14 from RFC 3526, used rather than generating parameters on every client start '''
+
+
+@functools.lru_cache(maxsize=1)
+def rfc3526_group_14() -> Tuple[dh.DHParameters, bytes]:
+    parameters = dh.DHParameterNumbers(RFC3526_GROUP_14_PRIME, 2).parameters(default_backend())
+    return parameters, parameters.parameter_bytes(encoding=serialization.Encoding.PEM,
+                                                  format=serialization.ParameterFormat.PKCS3)
+
+
+@functools.lru_cache(maxsize=NetworkCommunicationConstants.DH_PARAMETER_CACHE_SIZE)
+def load_dh_parameters(dh_parameters: bytes) -> dh.DHParameters:
+    """
+    Clients mostly send the same well-known group, so their parameters are only parsed and checked once
+    """
+    return serialization.load_pem_parameters(dh_parameters, backend=default_backend())
+
+
+GROUP_KEY_ID_LENGTH = 4
+GROUP_KEYS_KEPT = 4
+''' Group keys a client keeps after a rotation, so broadcasts still in flight under an older key decrypt '''
+
+
 class EncryptionHandler:
     def __init__(self, dh_parameters: bytes | None):
         self.self_prepared = False
         self.other_prepared = False
         self.aes_gcm_shared_key: AESGCM | None = None
+        self.cipher: SessionCipher | None = None
+        self.initiator = dh_parameters is None  # Only the side that starts the session picks the parameters
+        self.chunked = False  # Both sides agreed to chunked AEAD frames
         self.dh_public_key = None
         self.dh_other_key = None
         self.dh_private_key = None
+        self.x25519_private_key: X25519PrivateKey | None = None
+        self.serialized_dh_private_key: bytes | None = None  # Set instead of dh_private_key by accept_dh_keys
+        self.exchanging = False
+        self._lock = threading.Lock()
         if dh_parameters is None:
-            self.dh_parameters = dh.generate_parameters(generator=2, key_size=2048, backend=default_backend())
-            self.dh_parameters_bytes = self.dh_parameters.parameter_bytes(encoding=serialization.Encoding.PEM, format=serialization.ParameterFormat.PKCS3)
+            self.dh_parameters, self.dh_parameters_bytes = rfc3526_group_14()
         else:
             self.dh_parameters_bytes = dh_parameters
-            self.dh_parameters = serialization.load_pem_parameters(dh_parameters, backend=default_backend())
+            self.dh_parameters = load_dh_parameters(bytes(dh_parameters))
 
     def generate_dh_keys(self) -> Tuple[bytes, bool]:
         BetterLog.log_text('GENERATING DH KEYS')
@@ -41,15 +87,74 @@ class EncryptionHandler:
                     BetterLog.log_text('GENERATING AES GCM KEYS')
                     self.aes_gcm_shared_key = CryptWrapper.generate_aes_gcm_key(self.dh_private_key, self.dh_other_key)
                     BetterLog.log_text('AES GCM KEYS GENERATED')
-                    self.dh_other_key = None
-                    self.dh_private_key = None
-                    self.dh_public_key = None
-                    self.dh_parameters_bytes = None
-                    self.dh_parameters = None
-                    self.self_prepared = True
+                    self.__clear_key_exchange__()
                     return True
         return False
 
+    def __clear_key_exchange__(self):
+        self.dh_other_key = None
+        self.dh_private_key = None
+        self.dh_public_key = None
+        self.dh_parameters_bytes = None
+        self.dh_parameters = None
+        self.x25519_private_key = None
+        self.serialized_dh_private_key = None
+        self.cipher = SessionCipher(self.aes_gcm_shared_key, self.initiator)
+        self.self_prepared = True
+        Metrics.KEYS_AGREED.inc()
+
+    def needs_dh_keys(self) -> bool:
+        """
+        True until this side has either generated its DH keys or agreed a key some other way
+        """
+        return self.aes_gcm_shared_key is None and self.dh_private_key is None
+
+    def accept_dh_keys(self, private_key: bytes, public_key: bytes) -> Tuple[bytes, bytes] | None:
+        """
+        Takes keys generated elsewhere, returns the private key and other public key to derive from once both are known
+        """
+        with self._lock:
+            self.serialized_dh_private_key = private_key
+            self.dh_public_key = public_key
+            return self.__take_exchange__()
+
+    def accept_other_public_key(self, other_public_key: bytes) -> Tuple[bytes, bytes] | None:
+        BetterLog.log_text('OTHER DH KEY RECEIVED')
+        with self._lock:
+            self.dh_other_key = other_public_key
+            return self.__take_exchange__()
+
+    def __take_exchange__(self) -> Tuple[bytes, bytes] | None:
+        # Whichever of the two keys arrives last hands out the exchange, and only once
+        if self.exchanging or self.aes_gcm_shared_key is not None:
+            return None
+        if self.serialized_dh_private_key is None or self.dh_other_key is None:
+            return None
+        self.exchanging = True
+        return self.serialized_dh_private_key, self.dh_other_key
+
+    def accept_aes_gcm_key(self, aes_gcm_key: bytes):
+        self.aes_gcm_shared_key = AESGCM(aes_gcm_key)
+        BetterLog.log_text('AES GCM KEYS GENERATED')
+        self.__clear_key_exchange__()
+
+    def resume(self, resumption_secret: bytes, client_nonce: bytes, server_nonce: bytes):
+        self.aes_gcm_shared_key = CryptWrapper.derive_resumed_aes_gcm_key(resumption_secret, client_nonce, server_nonce)
+        BetterLog.log_text('AES GCM KEYS RESUMED')
+        self.__clear_key_exchange__()
+
+    def generate_x25519_keys(self) -> bytes:
+        self.x25519_private_key, public_key = CryptWrapper.generate_x25519_keys()
+        return public_key
+
+    def received_other_x25519_key(self, other_public_key: bytes) -> bool:
+        if self.aes_gcm_shared_key is not None or self.x25519_private_key is None:
+            return False
+        self.aes_gcm_shared_key = CryptWrapper.generate_aes_gcm_key_x25519(self.x25519_private_key, other_public_key)
+        BetterLog.log_text('AES GCM KEYS GENERATED')
+        self.__clear_key_exchange__()
+        return True
+
     def is_prepared(self):
         return self.self_prepared and self.other_prepared
 
@@ -59,11 +164,128 @@ class EncryptionHandler:
         return self.__attempt_aes_gcm_generation__()
 
     def encrypt(self, plaintext: bytes) -> bytes:
-        if self.aes_gcm_shared_key is None:
+        if self.cipher is None:
             raise AESGCMKeyHasNotBeenGenerated
-        return CryptWrapper.encrypt(self.aes_gcm_shared_key, plaintext)
+        Metrics.ENCRYPTED_BYTES.inc(amount=len(plaintext))
+        if self.chunked:
+            return self.cipher.encrypt_chunked(plaintext)
+        return self.cipher.encrypt(plaintext)
 
     def decrypt(self, ciphertext: bytes) -> bytes:
-        if self.aes_gcm_shared_key is None:
+        if self.cipher is None:
             raise AESGCMKeyHasNotBeenGenerated
-        return CryptWrapper.decrypt(self.aes_gcm_shared_key, ciphertext)
+        Metrics.DECRYPTED_BYTES.inc(amount=len(ciphertext))
+        try:
+            if self.chunked:
+                return self.cipher.decrypt_chunked(ciphertext)
+            return self.cipher.decrypt(ciphertext)
+        except (InvalidTag, ValueError):
+            Metrics.DECRYPT_FAILURES.inc()
+            raise
+
+
+RESUMPTION_SECRET_LENGTH = 32
+TICKET_EXPIRY_LENGTH = 8
+
+
+class ResumptionTickets:
+    """
+    Issues and opens resumption tickets. A ticket is the session's resumption secret and its expiry sealed under a key
+    only this server holds, so the server keeps nothing per client and a restart simply invalidates every ticket
+    """
+
+    def __init__(self, lifetime_ns: int = NetworkCommunicationConstants.RESUMPTION_TICKET_LIFETIME_NS):
+        self.lifetime_ns = lifetime_ns
+        self.ticket_key = AESGCM(AESGCM.generate_key(bit_length=256))
+
+    def issue(self) -> Tuple[bytes, bytes]:
+        """
+        A new resumption secret and the ticket carrying it
+        """
+        resumption_secret = os.urandom(RESUMPTION_SECRET_LENGTH)
+        expiry = time.time_ns() + self.lifetime_ns
+        ticket = CryptWrapper.encrypt(self.ticket_key,
+                                      expiry.to_bytes(length=TICKET_EXPIRY_LENGTH, byteorder='big') + resumption_secret)
+        return resumption_secret, ticket
+
+    def open(self, ticket: bytes) -> bytes | None:
+        """
+        The resumption secret in ticket, None if it was not issued by this server or has expired
+        """
+        try:
+            plaintext = CryptWrapper.decrypt(self.ticket_key, bytes(ticket))
+        except (InvalidTag, ValueError):
+            return None
+        if int.from_bytes(plaintext[:TICKET_EXPIRY_LENGTH], byteorder='big') < time.time_ns():
+            return None
+        return plaintext[TICKET_EXPIRY_LENGTH:]
+
+
+class GroupKey:
+    """
+    Key shared by every member of the room, a broadcast is encrypted under it once rather than once per member.\n
+    Each key is sent to members over their own AES GCM channel and is replaced whenever a member leaves
+    """
+
+    def __init__(self, key_id: int, key: bytes):
+        self.key_id = key_id
+        self.key = key
+        self.aes_gcm = AESGCM(key)
+        self.cipher = SessionCipher(self.aes_gcm, False)  # Only the server ever encrypts under a group key
+
+    @classmethod
+    def generate(cls, previous: 'GroupKey | None' = None) -> 'GroupKey':
+        if previous is None:
+            key_id = int.from_bytes(os.urandom(GROUP_KEY_ID_LENGTH), byteorder='big')
+        else:
+            key_id = (previous.key_id + 1) % (1 << (8 * GROUP_KEY_ID_LENGTH))
+        return GroupKey(key_id, AESGCM.generate_key(bit_length=256))
+
+    def to_bytes(self) -> bytes:
+        return self.key_id.to_bytes(length=GROUP_KEY_ID_LENGTH, byteorder='big') + self.key
+
+    @classmethod
+    def from_bytes(cls, b: bytes) -> 'GroupKey':
+        return GroupKey(int.from_bytes(b[:GROUP_KEY_ID_LENGTH], byteorder='big'), bytes(b[GROUP_KEY_ID_LENGTH:]))
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        payload = bytearray(GROUP_KEY_ID_LENGTH + SessionCipher.frame_length(len(plaintext)))
+        payload[:GROUP_KEY_ID_LENGTH] = self.key_id.to_bytes(length=GROUP_KEY_ID_LENGTH, byteorder='big')
+        self.cipher.encrypt_into(plaintext, memoryview(payload)[GROUP_KEY_ID_LENGTH:])
+        return payload
+
+
+class GroupKeyring:
+    """
+    Group keys a client has been sent, along with group messages that arrived ahead of the key they need
+    """
+
+    def __init__(self):
+        self.keys: OrderedDict[int, AESGCM] = OrderedDict()
+        self.pending: Deque[Tuple[int, Packet.Message]] = deque(maxlen=NetworkCommunicationConstants.GROUP_PENDING_MESSAGES)
+        self._lock = threading.Lock()
+
+    def add(self, group_key: GroupKey) -> List[Packet.Message]:
+        """
+        Stores group_key, returns the held messages that can now be decrypted
+        """
+        with self._lock:
+            self.keys[group_key.key_id] = group_key.aes_gcm
+            while len(self.keys) > GROUP_KEYS_KEPT:
+                self.keys.popitem(last=False)
+            ready = [message for key_id, message in self.pending if key_id == group_key.key_id]
+            self.pending = deque(((key_id, message) for key_id, message in self.pending
+                                  if key_id != group_key.key_id), maxlen=self.pending.maxlen)
+            return ready
+
+    def decrypt(self, message: Packet.Message) -> bytes | None:
+        """
+        None, with the message held until its key arrives, if the key it was encrypted under is not known yet
+        """
+        key_id = int.from_bytes(message.payload[:GROUP_KEY_ID_LENGTH], byteorder='big')
+        with self._lock:
+            aes_gcm = self.keys.get(key_id)
+            if aes_gcm is None:
+                self.pending.append((key_id, message))
+                return None
+        return CryptWrapper.decrypt(aes_gcm, memoryview(message.payload)[GROUP_KEY_ID_LENGTH:])
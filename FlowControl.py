@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Set, Tuple
+
+import NetworkCommunicationConstants
+
+
+class SendWindow:
+    """
+    Per-peer congestion window over packets in flight.\n
+    Packets of tracked messages are queued here and released while fewer than window packets are unacknowledged,
+    paced by a token bucket refilled at window packets per round trip. The window grows additively as packets are
+    acknowledged (through PROGRESS or ACKNOWLEDGE) and halves on loss, at most once per round trip
+    """
+
+    def __init__(self):
+        self.window: float = NetworkCommunicationConstants.FLOW_INITIAL_WINDOW_PACKETS
+        self.in_flight: int = 0
+        self.round_trip_ns: int = NetworkCommunicationConstants.FLOW_PACING_ROUND_TRIP_NS
+        # Queued packets are named by (message id, sequence number), never by the packet object, which selective
+        # repeat and resends may hand back as a different copy or slice
+        self._pending: Deque[Tuple[bytes, int]] = deque()
+        self._queued: Dict[bytes, Set[int]] = {}
+        self._packets: Dict[bytes, List[bytes]] = {}
+        # Per message: packets in total, transmissions since the last loss, and packets the receiver reported
+        self._total: Dict[bytes, int] = {}
+        self._released: Dict[bytes, int] = {}
+        self._acknowledged: Dict[bytes, int] = {}
+        self._released_at: Dict[bytes, int] = {}
+        self._tokens: float = NetworkCommunicationConstants.FLOW_PACING_BURST_PACKETS
+        self._last_refill: int = time.time_ns()
+        self._last_decrease: int = 0
+        self._lock = threading.Lock()
+
+    def submit(self, message_id: bytes, packets: List[bytes]) -> List[bytes]:
+        """
+        Queues a message's packets, returns those that may be sent right away
+        """
+        with self._lock:
+            self._pending.extend((message_id, sequence_number) for sequence_number in range(len(packets)))
+            self._queued[message_id] = set(range(len(packets)))
+            self._packets[message_id] = packets
+            self._total[message_id] = len(packets)
+            self._released[message_id] = 0
+            self._acknowledged[message_id] = 0
+            return self.__release__()
+
+    def progress(self, message_id: bytes, received: int) -> List[bytes]:
+        """
+        The receiver reported holding received packets of message_id
+        """
+        with self._lock:
+            if message_id not in self._total:
+                return []
+            before = self.__outstanding__(message_id)
+            acknowledged = min(received, self._total[message_id])
+            if acknowledged > self._acknowledged[message_id]:
+                self._acknowledged[message_id] = acknowledged
+                self.in_flight += self.__outstanding__(message_id) - before
+                self.__grow__(before - self.__outstanding__(message_id))
+            return self.__release__()
+
+    def acknowledged(self, message_id: bytes) -> List[bytes]:
+        with self._lock:
+            outstanding = self.__forget__(message_id)
+            self.__grow__(outstanding)
+            return self.__release__()
+
+    def lost(self, message_id: bytes, sequence_numbers: Iterable[int]) -> List[bytes]:
+        """
+        The packets of message_id at sequence_numbers are presumed lost and queued again ahead of new traffic.\n
+        Loss is only ever declared after the receiver or sender has been left waiting, so nothing else of the message
+        is still considered in flight
+        """
+        with self._lock:
+            if message_id not in self._total:
+                return []
+            queued = self._queued[message_id]  # Packets that were never released are not lost, just still queued
+            lost = [sequence_number for sequence_number in dict.fromkeys(sequence_numbers)
+                    if 0 <= sequence_number < self._total[message_id] and sequence_number not in queued]
+            self.in_flight -= self.__outstanding__(message_id)
+            self._released[message_id] = self._acknowledged[message_id]
+            self._pending.extendleft((message_id, sequence_number) for sequence_number in reversed(lost))
+            queued.update(lost)
+            self.__decrease__()
+            return self.__release__()
+
+    def forget(self, message_id: bytes):
+        """
+        Drops everything belonging to a message that failed or was closed
+        """
+        with self._lock:
+            self.__forget__(message_id)
+
+    def released_at(self, message_id: bytes) -> int:
+        """
+        When the most recent packet of message_id left the window, 0 if none has
+        """
+        return self._released_at.get(message_id, 0)
+
+    def has_pending(self, message_id: bytes) -> bool:
+        return bool(self._queued.get(message_id))
+
+    def __contains__(self, message_id: bytes) -> bool:
+        """
+        False for messages sent before the window existed, those are resent around it
+        """
+        return message_id in self._total
+
+    def release(self) -> List[bytes]:
+        with self._lock:
+            return self.__release__()
+
+    def __outstanding__(self, message_id: bytes) -> int:
+        # Duplicate transmissions of a packet the receiver already holds are never reported, so a message never has
+        # more packets outstanding than it has packets left to deliver
+        return max(min(self._released[message_id], self._total[message_id]) - self._acknowledged[message_id], 0)
+
+    def __forget__(self, message_id: bytes) -> int:
+        if message_id not in self._total:
+            return 0
+        outstanding = self.__outstanding__(message_id)
+        self.in_flight -= outstanding
+        for table in (self._total, self._released, self._acknowledged, self._released_at, self._packets):
+            table.pop(message_id, None)
+        if self._queued.pop(message_id, None):
+            self._pending = deque(item for item in self._pending if item[0] != message_id)
+        return outstanding
+
+    def __grow__(self, packets: int):
+        if packets > 0:
+            self.window = min(self.window + packets / self.window,
+                              NetworkCommunicationConstants.FLOW_MAXIMUM_WINDOW_PACKETS)
+
+    def __decrease__(self):
+        now = time.time_ns()
+        if now - self._last_decrease > self.round_trip_ns:
+            self._last_decrease = now
+            self.window = max(self.window / 2, NetworkCommunicationConstants.FLOW_MINIMUM_WINDOW_PACKETS)
+
+    def __release__(self) -> List[bytes]:
+        now = time.time_ns()
+        rate = self.window / self.round_trip_ns
+        self._tokens = min(self._tokens + (now - self._last_refill) * rate,
+                           max(NetworkCommunicationConstants.FLOW_PACING_BURST_PACKETS, 1.0))
+        self._last_refill = now
+        released: List[bytes] = []
+        while self._pending and self.in_flight < self.window and self._tokens >= 1:
+            message_id, sequence_number = self._pending.popleft()
+            self._queued[message_id].discard(sequence_number)
+            before = self.__outstanding__(message_id)
+            self._released[message_id] += 1
+            self.in_flight += self.__outstanding__(message_id) - before
+            self._released_at[message_id] = now
+            self._tokens -= 1
+            released.append(self._packets[message_id][sequence_number])
+        return released
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+
+class RoundTripEstimator:
+    """
+    Smoothed round trip time and variance of one peer (RFC 6298), sampled only from acknowledgements of messages
+    that were never retransmitted or repeated, since those cannot tell which transmission is being acknowledged
+    """
+
+    def __init__(self):
+        self.smoothed_ns: int | None = None
+        self.variance_ns: int = 0
+        self.timeout_ns: int = NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS
+        self.samples: int = 0
+        self._backed_off_at: int = 0
+
+    def sample(self, round_trip_ns: int):
+        if self.smoothed_ns is None:
+            self.smoothed_ns = round_trip_ns
+            self.variance_ns = round_trip_ns // 2
+        else:
+            self.variance_ns = (3 * self.variance_ns + abs(self.smoothed_ns - round_trip_ns)) // 4
+            self.smoothed_ns = (7 * self.smoothed_ns + round_trip_ns) // 8
+        self.samples += 1
+        timeout = self.smoothed_ns + max(NetworkCommunicationConstants.FIND_RESEND_REPEAT_FAIL_POLL_TIME_NS,
+                                         4 * self.variance_ns)
+        self.timeout_ns = min(max(timeout, NetworkCommunicationConstants.MINIMUM_RESPONSE_TIME_NS),
+                              NetworkCommunicationConstants.MAXIMUM_RESPONSE_TIME_NS)
+
+    def timed_out(self):
+        """
+        A resend timer ran out, the timeout doubles until the next sample recomputes it (RFC 6298 5.5). Timers that run
+        out together only double it once, a burst of messages queued behind each other is one congestion event
+        """
+        now = time.time_ns()
+        if now - self._backed_off_at >= self.timeout_ns:
+            self._backed_off_at = now
+            self.timeout_ns = min(self.timeout_ns * 2, NetworkCommunicationConstants.MAXIMUM_RESPONSE_TIME_NS)
+
+    def resend_timeout(self, attempts: int = 0) -> int:
+        """
+        Time to wait for a response, doubled for every attempt that already went unanswered
+        """
+        return min(self.timeout_ns << attempts, NetworkCommunicationConstants.MAXIMUM_RESPONSE_TIME_NS)
+
+    def repeat_wait(self) -> int:
+        """
+        Silence tolerated after the most recent packet before asking for a repeat, a round trip and two variances once
+        the peer has been measured
+        """
+        if self.smoothed_ns is None:
+            return min(NetworkCommunicationConstants.WAIT_TIME_BEFORE_REPEAT_REQUEST_NS, self.timeout_ns)
+        wait = max(self.smoothed_ns + 2 * self.variance_ns, NetworkCommunicationConstants.MINIMUM_REPEAT_WAIT_NS)
+        return min(wait, self.timeout_ns)
@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import BrokenExecutor, Executor, Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict
+
+import BetterLog
+import Metrics
+import NetworkCommunicationConstants
+
+
+def create_pool(workers: int, processes: bool) -> Executor:
+    """
+    Worker processes come from a fork server, or are spawned where there is none, but are never forked from this
+    process, whose logging and network threads may hold locks that a fork would copy while held.\n
+    Each worker imports the main module, so a script that starts a server must guard itself with __main__
+    """
+    if not processes:
+        return ThreadPoolExecutor(max_workers=workers)
+    import multiprocessing  # Imported here, with the process pool, as most servers never need either
+    from concurrent.futures import ProcessPoolExecutor
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['CryptWrapper'])  # Workers fork from a server that already loaded the crypto
+    else:
+        context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context)
+
+
+class HandshakeExecutor:
+    """
+    Runs the CPU bound half of key exchanges away from the network threads, in worker processes so that a reconnect
+    storm spreads across cores rather than starving chat traffic under the GIL.\n
+    At most queue_size handshake steps may be waiting or running at once, anything past that is turned away.\n
+    The pool is only created by the first submit, X25519 and resumed sessions are agreed within CONNECT and never use
+    it, so only a finite field DH fallback waits on a worker starting
+    """
+
+    def __init__(self, workers: int = NetworkCommunicationConstants.HANDSHAKE_WORKERS,
+                 queue_size: int = NetworkCommunicationConstants.HANDSHAKE_QUEUE_SIZE,
+                 processes: bool = NetworkCommunicationConstants.HANDSHAKE_PROCESSES):
+        self.pool: Executor | None = None
+        self.workers = workers
+        self.processes = processes
+        self.queue_size = queue_size
+        self.pending = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.latencies_ns: Deque[int] = deque(maxlen=NetworkCommunicationConstants.HANDSHAKE_LATENCY_SAMPLES)
+        self._lock = threading.Lock()
+
+    def submit(self, work: Callable[..., Any], *args, callback: Callable[[Any], None]) -> bool:
+        """
+        Runs work(*args) in the pool and hands its result to callback, False if the queue is full
+        """
+        with self._lock:
+            if self.pending >= self.queue_size:
+                self.rejected += 1
+                return False
+            self.pending += 1
+            self.submitted += 1
+            if self.pool is None:
+                self.pool = create_pool(self.workers, self.processes)
+            pool = self.pool
+        started = time.perf_counter_ns()
+        try:
+            future = pool.submit(work, *args)
+        except (BrokenExecutor, RuntimeError) as e:  # A worker died, or the pool was shut down
+            with self._lock:
+                self.pending -= 1
+            self.__failed__(pool, e)
+            return False
+        future.add_done_callback(lambda done: self.__done__(done, pool, started, callback))
+        return True
+
+    def __done__(self, future: Future, pool: Executor, started: int, callback: Callable[[Any], None]):
+        latency_ns = time.perf_counter_ns() - started
+        with self._lock:
+            self.pending -= 1
+            self.latencies_ns.append(latency_ns)
+        Metrics.HANDSHAKE_LATENCY.observe(latency_ns)
+        try:
+            result = future.result()
+        except Exception as e:
+            self.__failed__(pool, e)
+            return
+        with self._lock:
+            self.completed += 1
+        try:
+            callback(result)
+        except Exception as e:
+            BetterLog.log_text("HANDSHAKE CALLBACK FAILED: {}", e, level=BetterLog.ERROR)
+
+    def __failed__(self, pool: Executor, error: Exception):
+        """
+        Counts a step that did not run to completion, a broken pool is dropped so the next submit starts a new one
+        """
+        with self._lock:
+            self.failed += 1
+            dropped = isinstance(error, BrokenExecutor) and self.pool is pool
+            if dropped:
+                self.pool = None
+        if dropped:
+            pool.shutdown(wait=False, cancel_futures=True)
+        BetterLog.log_text("HANDSHAKE FAILED: {}", error, level=BetterLog.ERROR)
+
+    def statistics(self) -> Dict[str, int | float | None]:
+        """
+        Queue depth, admission counters and latency from submit to result over recent handshake steps, for monitoring
+        """
+        with self._lock:
+            latencies = sorted(self.latencies_ns)
+            return {
+                'queue_depth': self.pending,
+                'queue_size': self.queue_size,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'latency_mean_ns': sum(latencies) / len(latencies) if latencies else None,
+                'latency_p99_ns': latencies[int(0.99 * (len(latencies) - 1))] if latencies else None,
+                'latency_max_ns': latencies[-1] if latencies else None,
+            }
+
+    def shutdown(self, wait: bool = False):
+        """
+        wait until the worker processes have exited, they hold on to the standard streams until then
+        """
+        if self.pool is not None:
+            self.pool.shutdown(wait=wait, cancel_futures=True)
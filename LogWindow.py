@@ -0,0 +1,39 @@
+import threading
+
+import eel
+
+import BetterLog
+
+
+@eel.expose
+def submit_message(text):
+    BetterLog.submit_message(text)
+
+
+class LogWindow:
+    """
+    BetterLog sink calling the JavaScript functions exposed by the log page
+    """
+
+    def add_log_message(self, text: str):
+        eel.add_log_message(text)
+
+    def add_outgoing_message(self, text: str):
+        eel.add_outgoing_message(text)
+
+    def add_incoming_message(self, text: str):
+        eel.add_incoming_message(text)
+
+    def add_message_text(self, text: str, sender: str, isself: bool):
+        eel.add_message_text(text, sender, isself)
+
+
+def start(page: str = 'log.html') -> LogWindow:
+    # Initialize Eel with your HTML file
+    eel.init('web')
+
+    # Start the Eel application
+    thread = threading.Thread(target=eel.start, args=(page,))
+    thread.daemon = True
+    thread.start()
+    return LogWindow()
@@ -0,0 +1,267 @@
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import NetworkCommunicationConstants
+
+Peer = Tuple[str, int]
+
+
+def peer_label(peer: Peer) -> str:
+    return f"{peer[0]}:{peer[1]}"
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """
+    Monotonic count kept globally and per peer
+    """
+    TYPE = 'counter'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.total = 0
+        self.peers: Dict[Peer, int] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, peer: Peer | None = None, amount: int = 1):
+        with self._lock:
+            self.total += amount
+            if peer is not None:
+                self.peers[peer] = self.peers.get(peer, 0) + amount
+
+    def inc_batch(self, batch: Iterable[Tuple[object, Peer]]):
+        """
+        Counts one for every (item, peer) pair under a single lock, for whole send batches
+        """
+        with self._lock:
+            peers = self.peers
+            for _, peer in batch:
+                self.total += 1
+                peers[peer] = peers.get(peer, 0) + 1
+
+    def forget(self, peer: Peer):
+        with self._lock:
+            self.peers.pop(peer, None)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {'total': self.total, 'peers': dict(self.peers)}
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        snapshot = self.snapshot()
+        samples = [(self.name, {}, snapshot['total'])]
+        samples.extend((self.name, {'peer': peer_label(peer)}, value) for peer, value in snapshot['peers'].items())
+        return samples
+
+
+class Histogram:
+    """
+    Distribution of observed values over fixed buckets, kept globally and per peer
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: Tuple[int, ...]):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.total = self.__empty__()
+        self.peers: Dict[Peer, List] = {}
+        self._lock = threading.Lock()
+
+    def __empty__(self) -> List:
+        return [[0] * (len(self.buckets) + 1), 0, 0]  # BUCKET COUNTS (+INF LAST), SUM, COUNT
+
+    def observe(self, value: int | float, peer: Peer | None = None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            targets = (self.total,) if peer is None else (self.total, self.peers.setdefault(peer, self.__empty__()))
+            for target in targets:
+                target[0][index] += 1
+                target[1] += value
+                target[2] += 1
+
+    def forget(self, peer: Peer):
+        with self._lock:
+            self.peers.pop(peer, None)
+
+    def __summary__(self, state: List) -> Dict:
+        counts, total, count = state
+        cumulative = 0
+        buckets = {}
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += bucket_count
+            buckets[bound] = cumulative
+        return {'buckets': buckets, 'sum': total, 'count': count, 'mean': total / count if count else None}
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            total = [list(self.total[0]), self.total[1], self.total[2]]
+            peers = {peer: [list(state[0]), state[1], state[2]] for peer, state in self.peers.items()}
+        return {'total': self.__summary__(total), 'peers': {peer: self.__summary__(state) for peer, state in peers.items()}}
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        snapshot = self.snapshot()
+        samples = []
+        for labels, summary in [({}, snapshot['total'])] + [({'peer': peer_label(peer)}, summary)
+                                                             for peer, summary in snapshot['peers'].items()]:
+            for bound, count in summary['buckets'].items():
+                samples.append((self.name + '_bucket', {**labels, 'le': '+Inf' if bound == float('inf') else str(bound)},
+                                count))
+            samples.append((self.name + '_sum', labels, summary['sum']))
+            samples.append((self.name + '_count', labels, summary['count']))
+        return samples
+
+
+class Gauge:
+    """
+    Current values read from their owners whenever the registry is collected, nothing is updated on the hot path.\n
+    Each source returns its values keyed by label value, so one gauge covers every handler or peer in the process
+    """
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, description: str, label: str):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.sources: Dict[object, Callable[[], Dict[str, int | float | None]]] = {}
+        self._lock = threading.Lock()
+
+    def track(self, owner: object, source: Callable[[], Dict[str, int | float | None]]):
+        with self._lock:
+            self.sources[owner] = source
+
+    def untrack(self, owner: object):
+        with self._lock:
+            self.sources.pop(owner, None)
+
+    def snapshot(self) -> Dict[str, int | float]:
+        with self._lock:
+            sources = list(self.sources.values())
+        values = {}
+        for source in sources:
+            try:
+                values.update(source())
+            except Exception:
+                continue  # An owner that is shutting down must not break collection
+        return {label: value for label, value in values.items() if value is not None}
+
+    def samples(self) -> List[Tuple[str, Dict[str, str], float]]:
+        return [(self.name, {self.label: label}, value) for label, value in self.snapshot().items()]
+
+
+class Registry:
+    def __init__(self, namespace: str = NetworkCommunicationConstants.METRICS_NAMESPACE):
+        self.namespace = namespace
+        self.metrics: Dict[str, Counter | Histogram | Gauge] = {}
+        self._lock = threading.Lock()
+
+    def __register__(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self.__register__(Counter(f"{self.namespace}_{name}", description))
+
+    def histogram(self, name: str, description: str,
+                  buckets: Tuple[int, ...] = NetworkCommunicationConstants.METRICS_LATENCY_BUCKETS_NS) -> Histogram:
+        return self.__register__(Histogram(f"{self.namespace}_{name}", description, buckets))
+
+    def gauge(self, name: str, description: str, label: str) -> Gauge:
+        return self.__register__(Gauge(f"{self.namespace}_{name}", description, label))
+
+    def forget(self, peer: Peer):
+        """
+        Drops a departed peer's series so per-peer views do not grow without bound
+        """
+        for metric in list(self.metrics.values()):
+            if not isinstance(metric, Gauge):
+                metric.forget(peer)
+
+    def snapshot(self) -> Dict[str, Dict]:
+        """
+        Pull API, every metric's global and per-peer values keyed by metric name
+        """
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def to_prometheus(self) -> str:
+        """
+        Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    name += '{' + ','.join(f'{key}="{escape(label)}"' for key, label in labels.items()) + '}'
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int = NetworkCommunicationConstants.METRICS_PORT,
+              host: str = NetworkCommunicationConstants.METRICS_HOST) -> 'ThreadingHTTPServer':
+        """
+        Serves to_prometheus() over HTTP from a daemon thread, bound to the local host unless told otherwise
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer  # Only paid for once serving
+        registry = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # Scrapes would otherwise be printed to stderr
+
+        server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+REGISTRY = Registry()
+''' Process wide registry every component records into '''
+
+# TRANSPORT
+PACKETS_SENT = REGISTRY.counter('packets_sent_total', 'Datagrams handed to the socket')
+PACKETS_RECEIVED = REGISTRY.counter('packets_received_total', 'Packets received, bundled packets counted separately')
+MESSAGES_SENT = REGISTRY.counter('messages_sent_total', 'Messages packetized for sending')
+MESSAGES_RECEIVED = REGISTRY.counter('messages_received_total', 'Messages fully received, transport messages included')
+PACKETS_RETRANSMITTED = REGISTRY.counter('packets_retransmitted_total',
+                                         'Packets sent again after a timeout or selective repeat')
+SELECTIVE_REPEATS_SENT = REGISTRY.counter('selective_repeats_sent_total', 'Selective repeat requests sent')
+SELECTIVE_REPEATS_RECEIVED = REGISTRY.counter('selective_repeats_received_total', 'Selective repeat requests received')
+TRANSACTIONS_FAILED = REGISTRY.counter('transactions_failed_total', 'Transactions given up after GIVE_UP_REATTEMPTS')
+REASSEMBLY_LATENCY = REGISTRY.histogram('reassembly_latency_ns',
+                                        'Time (ns) from the first to the last packet of a multi-packet message')
+ACTIVE_TRANSACTIONS = REGISTRY.gauge('active_transactions', 'Open transactions per handler', 'handler')
+INCOMING_QUEUE_DEPTH = REGISTRY.gauge('incoming_queue_depth', 'Datagrams received and waiting to be processed',
+                                     'handler')
+OUTGOING_QUEUE_DEPTH = REGISTRY.gauge('outgoing_queue_depth', 'Packets waiting to be sent', 'handler')
+ROUND_TRIP = REGISTRY.gauge('round_trip_ns', 'Smoothed round trip (ns) per peer', 'peer')
+
+# SERVER
+CONNECTED_CLIENTS = REGISTRY.gauge('connected_clients', 'Clients connected per server', 'server')
+HANDSHAKE_QUEUE_DEPTH = REGISTRY.gauge('handshake_queue_depth', 'Handshake steps waiting or running per server',
+                                       'server')
+HANDSHAKES_REJECTED = REGISTRY.counter('handshakes_rejected_total', 'Clients turned away with the handshake queue full')
+HANDSHAKE_LATENCY = REGISTRY.histogram('handshake_latency_ns', 'Time (ns) from submit to result of a handshake step')
+SESSIONS_RESUMED = REGISTRY.counter('sessions_resumed_total', 'Sessions resumed from a ticket')
+TICKETS_REJECTED = REGISTRY.counter('tickets_rejected_total', 'Resumption tickets that did not open')
+GROUP_KEY_ROTATIONS = REGISTRY.counter('group_key_rotations_total', 'Group keys replaced after a member left')
+
+# ENCRYPTION
+ENCRYPTED_BYTES = REGISTRY.counter('encrypted_bytes_total', 'Plaintext bytes encrypted by session ciphers')
+DECRYPTED_BYTES = REGISTRY.counter('decrypted_bytes_total', 'Ciphertext bytes decrypted by session ciphers')
+DECRYPT_FAILURES = REGISTRY.counter('decrypt_failures_total', 'Ciphertexts that failed authentication')
+KEYS_AGREED = REGISTRY.counter('keys_agreed_total', 'Session keys agreed by any key exchange or resumption')
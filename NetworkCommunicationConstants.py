@@ -8,7 +8,14 @@ def ns_to_s(ns): return float(ns / 1_000_000_000)
 
 
 MAXIMUM_PACKET_SIZE_BYTES: int = 982 - 512
-''' Maximum packet size (bytes) sent by our protocol, keep in mind that this does not include UDP headers '''
+''' Default packet size (bytes) sent by our protocol, keep in mind that this does not include UDP headers.
+Peers start at, and fall back to, this size until a larger one is probed '''
+
+DATAGRAM_PROBE_SIZES_BYTES: tuple = (1_200, 1_472)
+''' Packet sizes (bytes) probed after CONNECT, the largest one acknowledged becomes the peer's packet size '''
+
+MAXIMUM_DATAGRAM_SIZE_BYTES: int = max(MAXIMUM_PACKET_SIZE_BYTES, *DATAGRAM_PROBE_SIZES_BYTES)
+''' Largest packet (bytes) this side can receive, sizes the receive buffers and is advertised during CONNECT '''
 
 HEARTBEAT_FREQUENCY_NS: int = 30_000_000_000
 ''' Frequency (ns) of heartbeats sent by client to server '''
@@ -21,11 +28,102 @@ HEARTBEAT_POLL_TIME_NS: int = 20_000_000_000
 ''' Time (ns) between polls to determine if a client should be forcefully disconnected '''
 HEARTBEAT_POLL_TIME_S = ns_to_s(HEARTBEAT_POLL_TIME_NS)
 
+HEADER_VERSION: int = 2
+''' Highest packet header version (int) offered during CONNECT, peers that do not negotiate stay on version 1 '''
+
+COMPRESSION: bool = True
+''' Offer payload compression during CONNECT, encrypted payloads to peers that agree carry a codec flag '''
+
+COMPRESSION_THRESHOLD_BYTES: int = 128
+''' Smallest payload (bytes) worth compressing, smaller ones are flagged as uncompressed '''
+
+ZLIB_COMPRESSION_LEVEL: int = 6
+''' zlib level (int) used when zlib is the agreed codec '''
+
+MAXIMUM_DECOMPRESSED_BYTES: int = 64 * 1024 * 1024
+''' Largest payload (bytes) a compressed payload may expand to before it is rejected '''
+
+MAXIMUM_MESSAGE_BYTES: int = MAXIMUM_DECOMPRESSED_BYTES
+''' Largest message payload (bytes) that is sent or reassembled, a header claiming more is dropped before its
+reassembly buffer is allocated '''
+
+KEY_EXCHANGE: bool = True
+''' Offer X25519 key agreement during CONNECT, peers that agree skip the finite field DH exchange entirely '''
+
+DH_PARAMETER_CACHE_SIZE: int = 16
+''' Distinct DH parameter sets (int) kept parsed, clients on a well-known group all share one entry '''
+
+CHUNKED_AEAD: bool = True
+''' Offer chunked AEAD during CONNECT, encrypted payloads to peers that agree are sealed as independent chunks '''
+
+AEAD_CHUNK_SIZE_BYTES: int = 65_536
+''' Plaintext (bytes) sealed per chunk of a chunked AEAD frame '''
+
+AEAD_PARALLEL_CHUNKS: int = 4
+''' Fewest chunks (int) a frame needs before they are sealed and opened on the chunk threads '''
+
+AEAD_CHUNK_THREADS: int = 4
+''' Most threads (int) shared by every session for sealing and opening chunks, never more than there are cores '''
+
+AEAD_COPY_FREE_BYTES: int = 16_384
+''' Smallest payload (bytes) sealed straight into its frame, smaller ones are cheaper to concatenate '''
+
+RESUMPTION: bool = True
+''' Offer session resumption during CONNECT, a returning client with a ticket skips the key exchange '''
+
+RESUMPTION_TICKET_LIFETIME_NS: int = 86_400_000_000_000
+''' Time (ns) a resumption ticket is accepted for after it was issued '''
+
+RESUMPTION_NONCE_LENGTH: int = 16
+''' Size (bytes) of the fresh nonce each side adds when deriving a resumed session's key '''
+
+HANDSHAKE_WORKERS: int = 4
+''' Worker processes (int) the server runs finite field DH key generation and agreement on '''
+
+HANDSHAKE_QUEUE_SIZE: int = 512
+''' Most handshake steps (int) waiting or running at once, connections past that are turned away '''
+
+HANDSHAKE_PROCESSES: bool = True
+''' Run handshakes in worker processes started from a fork server, or spawned, rather than in threads '''
+
+HANDSHAKE_LATENCY_SAMPLES: int = 1024
+''' Recent handshake steps (int) kept for the latency statistics '''
+
+GROUP_BROADCAST: bool = True
+''' Offer group broadcasts during CONNECT, peers that agree are sent a group key and get broadcasts encrypted once '''
+
+GROUP_PENDING_MESSAGES: int = 64
+''' Most group messages (int) a client holds while waiting for the group key they were encrypted under '''
+
 OUTGOING_BUFFER_SIZE_BYTES: int = 16_384
 ''' Size (bytes) of the output / send buffer '''
 
-INCOMING_BUFFER_SIZE_BYTES: int = 16_384
-''' Size (bytes) of the input / receive buffer '''
+INCOMING_BUFFER_SIZE_BYTES: int = 1_048_576
+''' Size (bytes) of the input / receive buffer, large enough to hold a burst while the receiving thread is busy '''
+
+SINGLE_LOOP_ENGINE: bool = False
+''' Run Client / Server on the single event loop AsyncNetworkHandler instead of the threaded NetworkHandler '''
+
+SHUTDOWN_TIMEOUT_S: float = 5.0
+''' Longest time (s) shutdown waits for a handler's threads to close its socket '''
+
+BATCHED_RECEIVE: bool = True
+''' Drain every ready datagram per wakeup and process them as one batch (only where recvmsg_into is available) '''
+
+RECEIVE_BATCH_SIZE: int = 64
+''' Maximum number (count) of datagrams handed to the processing stage in one batch '''
+
+RECEIVE_BUFFER_RING_SIZE: int = 512
+''' Number (count) of preallocated receive buffers kept in the ring '''
+
+SEND_BATCH_SIZE: int = 256
+''' Maximum number (count) of packets coalesced into a single flush of the outgoing queue '''
+
+OUTGOING_QUEUE_SIZE_PACKETS: int = 10_000
+''' Most packets (count) waiting in the outgoing queue, senders wait for room past that rather than dropping them '''
+
+TRANSACTION_SHARD_COUNT: int = 16
+''' Number (count) of independently locked shards the active transaction table is split into '''
 
 COMPLETED_MESSAGE_BUFFER_SIZE: int = 1000
 ''' Size (count) of the buffer that stores id's of previously completed communications '''
@@ -35,12 +133,78 @@ WAIT_TIME_BEFORE_REPEAT_REQUEST_NS: int = 50_000_000
 WAIT_TIME_BEFORE_REPEAT_REQUEST_S: float = ns_to_s(WAIT_TIME_BEFORE_REPEAT_REQUEST_NS)
 
 WAIT_RESPONSE_TIME_NS: int = 200_000_000
-''' Time (ns) waited for response before resending a message '''
+''' Time (ns) waited for response before resending a message, until the peer's round trip has been measured '''
 WAIT_RESPONSE_TIME_S: float = ns_to_s(WAIT_RESPONSE_TIME_NS)
 
+MINIMUM_RESPONSE_TIME_NS: int = 30_000_000
+''' Time (ns) a peer's measured response timeout never drops below, two polls for resends so that one late poll alone
+never resends '''
+
+MINIMUM_REPEAT_WAIT_NS: int = 15_000_000
+''' Time (ns) a peer's measured repeat wait never drops below, one poll for repeats '''
+
+MAXIMUM_RESPONSE_TIME_NS: int = 5_000_000_000
+''' Time (ns) a peer's response timeout, including backoff, never exceeds '''
+
 GIVE_UP_REATTEMPTS: int = 3
 ''' Attempts before giving up (int) '''
 
+GIVE_UP_TIME_NS: int = 2_000_000_000
+''' Least time (ns) since the peer was last heard from before giving up, however quickly the attempts ran out '''
+
+FLOW_CONTROL: bool = True
+''' Offer the congestion window during CONNECT, tracked messages to peers that agree are paced through it '''
+
+FLOW_INITIAL_WINDOW_PACKETS: int = 32
+''' Packets (count) a peer's congestion window starts with '''
+
+FLOW_MINIMUM_WINDOW_PACKETS: int = 8
+''' Packets (count) the congestion window never shrinks below, must exceed FLOW_PROGRESS_INTERVAL_PACKETS '''
+
+FLOW_MAXIMUM_WINDOW_PACKETS: int = 4_096
+''' Packets (count) the congestion window never grows beyond '''
+
+FLOW_PROGRESS_INTERVAL_PACKETS: int = 4
+''' Packets (count) of a multi-packet message received between PROGRESS reports to a flow controlled sender '''
+
+FLOW_PACING_ROUND_TRIP_NS: int = 10_000_000
+''' Round trip (ns) the window is spread over when pacing packets out, until the peer's round trip has been measured '''
+
+FLOW_MINIMUM_PACING_ROUND_TRIP_NS: int = 1_000_000
+''' Floor (ns) on the measured round trip used for pacing, a loopback peer would otherwise never be paced at all '''
+
+FLOW_PACING_BURST_PACKETS: int = 16
+''' Packets (count) that may leave back to back before pacing kicks in '''
+
+ACK_AGGREGATION: bool = True
+''' Offer multi message acknowledgements during CONNECT, completed ids for peers that agree are acknowledged together '''
+
+ACK_DELAY_NS: int = 2_000_000
+''' Longest time (ns) a completed message id waits for others to share its acknowledgement '''
+ACK_DELAY_S: float = ns_to_s(ACK_DELAY_NS)
+
+BUNDLING: bool = True
+''' Offer bundling during CONNECT, small packets to peers that agree share datagrams '''
+
+BUNDLE_DELAY_NS: int = 1_000_000
+''' Longest time (ns) a small packet waits for others to the same peer to share its datagram '''
+BUNDLE_DELAY_S: float = ns_to_s(BUNDLE_DELAY_NS)
+
+BUNDLE_MAXIMUM_PACKET_BYTES: int = 256
+''' Largest packet (bytes) that is held back for bundling, larger ones are sent straight away '''
+
 FIND_RESEND_REPEAT_FAIL_POLL_TIME_NS: int = 15_000_000
 ''' Time (ns) between polls for resend, repeats, and failed messages'''
 FIND_RESEND_REPEAT_FAIL_POLL_TIME_S = ns_to_s(FIND_RESEND_REPEAT_FAIL_POLL_TIME_NS)
+
+METRICS_NAMESPACE: str = 'chat'
+''' Prefix of every metric name the registry exposes '''
+
+METRICS_HOST: str = '127.0.0.1'
+''' Address the Prometheus text endpoint binds to, local only unless deliberately widened '''
+
+METRICS_PORT: int = 9464
+''' Port the Prometheus text endpoint listens on once started '''
+
+METRICS_LATENCY_BUCKETS_NS: tuple = tuple(10 ** exponent * step for exponent in range(4, 10) for step in (1, 2, 5)) + (10_000_000_000,)
+''' Upper bounds (ns) of the latency histogram buckets, 10 us to 10 s '''
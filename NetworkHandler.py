@@ -1,26 +1,73 @@
 import asyncio
 import socket
 import threading
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Tuple
+from typing import Callable, Deque, Dict, Iterable, List, Tuple
 import BetterLog
+import Bundling
+import Metrics
 import NetworkCommunicationConstants
 import Packet
+from Capabilities import Capabilities
+from NetworkImpairment import NetworkImpairment
 from TransactionHandler import TransactionHandler
 
 
+class ReceiveBufferRing:
+    """
+    Ring of preallocated receive buffers, a buffer is handed back once the batch it was received in is processed
+    """
+
+    def __init__(self, count: int, size: int):
+        self.count = count
+        self.size = size
+        self._free = deque(bytearray(size) for _ in range(count))
+
+    def acquire(self) -> bytearray:
+        try:
+            return self._free.popleft()
+        except IndexError:  # Every buffer is still in flight, fall back to a fresh one rather than stalling
+            return bytearray(self.size)
+
+    def release(self, buffers: Iterable[bytearray]):
+        for buffer in buffers:
+            if len(self._free) < self.count:
+                self._free.append(buffer)
+
+
+SEND_FLAGS: int = getattr(socket, 'MSG_DONTWAIT', 0)
+''' Per-call flags making sendto non-blocking where the platform supports it '''
+
+
+def create_socket(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('', port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, NetworkCommunicationConstants.OUTGOING_BUFFER_SIZE_BYTES)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, NetworkCommunicationConstants.INCOMING_BUFFER_SIZE_BYTES)
+    return sock
+
+
+def supports_batched_receive() -> bool:
+    return hasattr(socket.socket, 'recvmsg_into') and hasattr(socket, 'MSG_DONTWAIT')
+
+
 class NetworkHandler:
-    def __init__(self, port: int, listener: Callable[[Packet.Message], None], user_id: int, host: str = ''):
+    def __init__(self, port: int, listener: Callable[[Packet.Message], None], user_id: int, host: str = '',
+                 batched_receive: bool = NetworkCommunicationConstants.BATCHED_RECEIVE, local_port: int | None = None,
+                 impairment: NetworkImpairment | None = None):
+        """
+        The socket binds local_port, port itself when None and any free port when 0.\n
+        impairment, for testing, sits in front of the socket and impairs every outgoing datagram
+        """
         self.USER_ID = user_id
         self.PORT = port
         self.HOST = host
-        self.SOCKET = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.SOCKET.bind(('', self.PORT))
-        self.SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
-                               NetworkCommunicationConstants.OUTGOING_BUFFER_SIZE_BYTES)
-        self.SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
-                               NetworkCommunicationConstants.INCOMING_BUFFER_SIZE_BYTES)
+        self.SOCKET = create_socket(self.PORT if local_port is None else local_port)
+        self.IMPAIRMENT = impairment
+        if impairment is not None:
+            impairment.attach(self.__send_raw_packet)
 
         # Set the message listener
         self.MESSAGE_LISTENER = listener
@@ -36,20 +83,45 @@ class NetworkHandler:
         t.start()
 
         # Create the queue to handle outgoing items
-        self.OUTGOING_QUEUE = asyncio.Queue(maxsize=10000)
+        self.OUTGOING_QUEUE = asyncio.Queue(maxsize=NetworkCommunicationConstants.OUTGOING_QUEUE_SIZE_PACKETS)
         self.OUTGOING_LOOP = asyncio.new_event_loop()
-        t = threading.Thread(target=self.__outgoing_looper__)
-        t.daemon = True
-        t.start()
+        # Packets the full send buffer turned away, sent from a writer callback once the socket is writable again
+        self.SEND_BLOCKED: Deque[Tuple[bytes, Tuple[str, int]]] = deque()
+        self.SEND_WRITABLE = asyncio.Event()
+        self.SEND_WRITABLE.set()
+        self.OUTGOING_THREAD = threading.Thread(target=self.__outgoing_looper__)
+        self.OUTGOING_THREAD.daemon = True
+        self.OUTGOING_THREAD.start()
+
+        # Small packets waiting to share a datagram
+        self.BUNDLER = Bundling.Bundler()
 
         # Create a transaction history handler
-        self.TRANSACTION_HANDLER = TransactionHandler(self.OUTGOING_QUEUE, self.OUTGOING_LOOP, self.USER_ID)
-        self.find_repeats_resends_and_fails()
+        self.TRANSACTION_HANDLER = TransactionHandler(self.__send_packets__, self.USER_ID, schedule=self.__schedule__)
+        self.PEERS = self.TRANSACTION_HANDLER.peers
+        self.CLOSED = threading.Event()
+        self.POLL_THREAD = threading.Thread(target=self.find_repeats_resends_and_fails)
+        self.POLL_THREAD.daemon = True
+        self.POLL_THREAD.start()
 
         # Listen for packets
-        t = threading.Thread(target=self.__listen__)
-        t.daemon = True
-        t.start()
+        self.RECEIVE_PENDING = 0
+        self.RECEIVE_PENDING_LOCK = threading.Lock()
+        self.BATCHED_RECEIVE = batched_receive and supports_batched_receive()
+        if self.BATCHED_RECEIVE:
+            self.RECEIVE_RING = ReceiveBufferRing(NetworkCommunicationConstants.RECEIVE_BUFFER_RING_SIZE,
+                                                  NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES)
+            self.LISTEN_THREAD = threading.Thread(target=self.__listen_batched__)
+        else:
+            self.LISTEN_THREAD = threading.Thread(target=self.__listen__)
+        self.LISTEN_THREAD.daemon = True
+        self.LISTEN_THREAD.start()
+
+        # Report to the metrics registry, read only when it is collected
+        label = str(self.SOCKET.getsockname()[1])  # PORT is the remote port on a client
+        self.TRANSACTION_HANDLER.track_metrics(label)
+        Metrics.INCOMING_QUEUE_DEPTH.track(self, lambda: {label: self.__incoming_depth__()})
+        Metrics.OUTGOING_QUEUE_DEPTH.track(self, lambda: {label: self.OUTGOING_QUEUE.qsize() + len(self.SEND_BLOCKED)})
 
     def __incoming_looper__(self):
         asyncio.set_event_loop(self.INCOMING_LOOP)
@@ -62,17 +134,70 @@ class NetworkHandler:
         self.OUTGOING_LOOP.run_forever()
 
     def find_repeats_resends_and_fails(self):
-        fails = self.TRANSACTION_HANDLER.fix_ongoing()
-
-        # Create a timer to re-call this method in N ns
-        threading.Timer(NetworkCommunicationConstants.FIND_RESEND_REPEAT_FAIL_POLL_TIME_S,
-                        self.find_repeats_resends_and_fails).start()
+        # One long-lived thread polls the deadline heap until shutdown, rather than a new timer thread per poll
+        while not self.CLOSED.wait(NetworkCommunicationConstants.FIND_RESEND_REPEAT_FAIL_POLL_TIME_S):
+            try:
+                self.TRANSACTION_HANDLER.fix_ongoing()
+            except Exception as e:
+                BetterLog.log_text("Failed To Poll Transactions: {}", e, level=BetterLog.ERROR)
 
     def __listen__(self):
         while True:
-            asyncio.run_coroutine_threadsafe(
-                self.INCOMING_QUEUE.put(self.SOCKET.recvfrom(NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES)),
-                self.INCOMING_LOOP)
+            try:
+                received = self.SOCKET.recvfrom(NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES)
+            except OSError:
+                if self.CLOSED.is_set():
+                    return
+                raise
+            if self.CLOSED.is_set():
+                return
+            asyncio.run_coroutine_threadsafe(self.INCOMING_QUEUE.put(received), self.INCOMING_LOOP)
+
+    def __listen_batched__(self):
+        # Block for the first datagram, then drain whatever else is ready without blocking and hand the whole batch
+        # to the executor in a single submit
+        while True:
+            batch: List[Tuple[bytearray, int, Tuple[str, int]]] = []
+            buffer = self.RECEIVE_RING.acquire()
+            flags = 0
+            while len(batch) < NetworkCommunicationConstants.RECEIVE_BATCH_SIZE:
+                try:
+                    nbytes, _, _, sender = self.SOCKET.recvmsg_into([buffer], 0, flags)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    if self.CLOSED.is_set():
+                        return
+                    raise
+                if self.CLOSED.is_set():
+                    return
+                batch.append((buffer, nbytes, sender))
+                buffer = self.RECEIVE_RING.acquire()
+                flags = socket.MSG_DONTWAIT
+            self.RECEIVE_RING.release((buffer,))
+            with self.RECEIVE_PENDING_LOCK:
+                self.RECEIVE_PENDING += len(batch)
+            self.EXECUTOR.submit(self.__received_batch__, batch)
+
+    def __received_batch__(self, batch: List[Tuple[bytearray, int, Tuple[str, int]]]):
+        try:
+            for buffer, nbytes, sender in batch:
+                try:
+                    self.__received_packet__(memoryview(buffer)[:nbytes], sender)
+                except Exception as e:
+                    BetterLog.log_incoming("Failed To Process Packet From {}: {}", sender, e, level=BetterLog.WARNING)
+        finally:
+            self.RECEIVE_RING.release(buffer for buffer, _, _ in batch)
+            with self.RECEIVE_PENDING_LOCK:
+                self.RECEIVE_PENDING -= len(batch)
+
+    def __incoming_depth__(self) -> int:
+        """
+        Datagrams received but not yet processed, the batched path hands them to the executor without INCOMING_QUEUE
+        """
+        if self.BATCHED_RECEIVE:
+            return self.RECEIVE_PENDING
+        return self.INCOMING_QUEUE.qsize()
 
     async def __incoming_queue_consume(self):
         while True:
@@ -81,64 +206,194 @@ class NetworkHandler:
 
     async def __outgoing_queue_consume(self):
         while True:
-            raw_packet, recipient = await self.OUTGOING_QUEUE.get()
-            self.__send_raw_packet(raw_packet, recipient)
+            # Nothing more is taken off the queue while the send buffer is full, so senders wait on the queue instead
+            await self.SEND_WRITABLE.wait()
+            batch = [await self.OUTGOING_QUEUE.get()]
+            # Coalesce everything else already queued into the same flush
+            while len(batch) < NetworkCommunicationConstants.SEND_BATCH_SIZE and not self.OUTGOING_QUEUE.empty():
+                batch.append(self.OUTGOING_QUEUE.get_nowait())
+            self.__flush__(batch)
+
+    def __flush__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        send = self.__send_raw_packet if self.IMPAIRMENT is None else self.IMPAIRMENT.sendto
+        for raw_packet, recipient in batch:
+            send(raw_packet, recipient)
+        Metrics.PACKETS_SENT.inc_batch(batch)
+        if BetterLog.LEVEL <= BetterLog.DEBUG:  # Checked once per batch, not per packet
+            for raw_packet, _ in batch:
+                BetterLog.log_packet_sent_bytes(raw_packet)
 
     def __send_raw_packet(self, raw_packet: bytes, recipient: Tuple[str, int]):
+        if not SEND_FLAGS:
+            self.__send_blocking__(raw_packet, recipient)
+        elif threading.current_thread() is self.OUTGOING_THREAD:
+            self.__send_nonblocking__(raw_packet, recipient)
+        else:  # Delayed datagrams are released from the impairment's thread
+            self.OUTGOING_LOOP.call_soon_threadsafe(self.__send_nonblocking__, raw_packet, recipient)
+
+    def __send_blocking__(self, raw_packet: bytes, recipient: Tuple[str, int]):
         try:
             self.SOCKET.sendto(raw_packet, recipient)
-            BetterLog.log_packet_sent_bytes(raw_packet)
-            return True
         except socket.error as e:
             BetterLog.log_failed_packet_send_bytes(raw_packet, e)
+
+    def __send_nonblocking__(self, raw_packet: bytes, recipient: Tuple[str, int]):
+        """
+        Sends without ever blocking the outgoing loop. Once the send buffer is full packets wait in SEND_BLOCKED, in
+        order, until the loop reports the socket writable again
+        """
+        if not self.SEND_BLOCKED and self.__try_send__(raw_packet, recipient):
+            return
+        self.SEND_BLOCKED.append((raw_packet, recipient))
+        if self.SEND_WRITABLE.is_set():
+            self.SEND_WRITABLE.clear()
+            self.OUTGOING_LOOP.add_writer(self.SOCKET, self.__writable__)
+
+    def __try_send__(self, raw_packet: bytes, recipient: Tuple[str, int]) -> bool:
+        """
+        False only if the send buffer is full, a packet that fails for any other reason is logged and dropped
+        """
+        # The socket stays blocking for the listener, so only this call is made non-blocking
+        try:
+            self.SOCKET.sendto(raw_packet, SEND_FLAGS, recipient)
+        except BlockingIOError:
             return False
+        except socket.error as e:
+            BetterLog.log_failed_packet_send_bytes(raw_packet, e)
+        return True
+
+    def __writable__(self):
+        while self.SEND_BLOCKED:
+            raw_packet, recipient = self.SEND_BLOCKED[0]
+            if not self.__try_send__(raw_packet, recipient):
+                return  # Still full, called again once it is writable
+            self.SEND_BLOCKED.popleft()
+        self.OUTGOING_LOOP.remove_writer(self.SOCKET)
+        self.SEND_WRITABLE.set()
 
     def __received_packet__(self, raw_packet: bytes, sender: Tuple[str, int]):
-        if not raw_packet:
-            BetterLog.log_incoming("Lame Packet")
+        if Bundling.is_bundle(raw_packet) and self.PEERS.is_versioned(sender):
+            for packet in Bundling.unbundle(raw_packet):
+                self.__received_packet__(packet, sender)
+            return
+        if Packet.PacketCodec.is_truncated(raw_packet, self.PEERS.is_versioned(sender)):
+            BetterLog.log_incoming("Lame Packet", level=BetterLog.WARNING)
             return
-        packet = Packet.Packet.from_bytes(raw_packet)
         message: Packet.Message | None
-        message = self.TRANSACTION_HANDLER.receive_packet(packet, sender)
+        message = self.TRANSACTION_HANDLER.receive_raw_packet(raw_packet, sender)
         if message is not None:
             self.__received_message__(message)
 
+    def __schedule__(self, delay_s: float, callback: Callable[[], None]):
+        self.OUTGOING_LOOP.call_soon_threadsafe(self.OUTGOING_LOOP.call_later, delay_s, callback)
+
     def send_ack(self, messageid: bytes, recipient: Tuple[str, int]):
-        self.send_message(Packet.Message(b'', Packet.PayloadType.ACKNOWLEDGE, self.USER_ID, messageid=messageid), recipient,
-                          should_track=False)
-        self.TRANSACTION_HANDLER.force_close(messageid)
+        self.TRANSACTION_HANDLER.acknowledge(messageid, recipient)
 
     def __received_message__(self, message: Packet.Message):
         self.MESSAGE_LISTENER(message)
 
-    def __add_to_outgoing__(self, packet: bytes, recipient: Tuple[str, int]):
-        asyncio.run_coroutine_threadsafe(self.OUTGOING_QUEUE.put((packet, recipient)), self.OUTGOING_LOOP)
+    async def __enqueue__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        """
+        Queues every packet of batch, waiting for room once the queue is full rather than dropping any
+        """
+        for item in batch:
+            if self.OUTGOING_QUEUE.full():
+                BetterLog.log_text("OUTGOING QUEUE FULL", level=BetterLog.WARNING)
+            await self.OUTGOING_QUEUE.put(item)
 
-    def __send_packet__(self, packet: bytes, recipient: Tuple[str, int]) -> bool:
-        try:
-            self.__add_to_outgoing__(packet, recipient)
-            return True
-        except asyncio.QueueFull:
-            BetterLog.log_text("OUTGOING QUEUE FULL")
-            return False
+    def __add_to_outgoing__(self, batch: List[Tuple[bytes, Tuple[str, int]]]):
+        batch = self.__bundle__(batch)
+        if batch:
+            asyncio.run_coroutine_threadsafe(self.__enqueue__(batch), self.OUTGOING_LOOP)
+
+    def __bundle__(self, batch: List[Tuple[bytes, Tuple[str, int]]]) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """
+        Holds back small packets to peers that accept bundles, returns what should be sent straight away
+        """
+        immediate, started = self.BUNDLER.hold(batch, self.PEERS)
+        if started:
+            self.__schedule__(NetworkCommunicationConstants.BUNDLE_DELAY_S, self.__flush_bundles__)
+        return immediate
+
+    def __flush_bundles__(self):
+        batch = self.BUNDLER.drain()
+        if batch:
+            self.OUTGOING_LOOP.create_task(self.__enqueue__(batch))
+
+    def __send_packets__(self, packets: List[bytes], recipient: Tuple[str, int]):
+        self.__add_to_outgoing__([(packet, recipient) for packet in packets])
 
     def send_message(self, message: Packet.Message, recipient=None, should_track=True) -> bool:
-        if recipient is None:
-            recipient = (self.HOST, self.PORT)
-        sent = []
-        for packet in message.to_packet_list():
-            bytepacket = packet.to_bytes()
-            sent.append(bytepacket)
-            if not self.__send_packet__(bytepacket, recipient):
+        return self.send_messages([(message, recipient)], should_track)
+
+    def send_messages(self, messages: List[Tuple[Packet.Message, Tuple[str, int] | None]], should_track=True) -> bool:
+        """
+        Packetizes every message and hands all of their packets to the outgoing queue in a single enqueue.\n
+        Stops at the first message that is too large and returns False, the messages before it are still sent
+        """
+        batch: List[Tuple[bytes, Tuple[str, int]]] = []
+        for message, recipient in messages:
+            if recipient is None:
+                recipient = (self.HOST, self.PORT)
+            try:
+                sent = self.TRANSACTION_HANDLER.prepare_message(message, recipient, should_track)
+            except Packet.MessageTooLarge as e:
                 BetterLog.log_failed_message_send(message)
+                BetterLog.log_text("{}", e, level=BetterLog.WARNING)
+                self.__add_to_outgoing__(batch)  # Earlier messages are already tracked
                 return False
+            batch.extend((bytepacket, recipient) for bytepacket in sent)
+            BetterLog.log_message_sent(message)
+        self.__add_to_outgoing__(batch)
+        return True
+
+    def send_shared(self, message: Packet.Message, recipients: List[Tuple[str, int]], should_track=True) -> bool:
+        """
+        Sends message to every recipient from one set of packets, each recipient still gets its own transaction
+        """
+        try:
+            batch = self.TRANSACTION_HANDLER.prepare_shared(message, recipients, should_track)
+        except Packet.MessageTooLarge as e:
+            BetterLog.log_failed_message_send(message)
+            BetterLog.log_text("{}", e, level=BetterLog.WARNING)
+            return False
         BetterLog.log_message_sent(message)
-        if should_track:
-            self.TRANSACTION_HANDLER.sent_message(message.messageid, sent, recipient)
+        self.__add_to_outgoing__(batch)
         return True
 
+    def set_peer_capabilities(self, peer: Tuple[str, int] | None, capabilities: Capabilities, confirmed: bool = True):
+        if peer is None:
+            peer = (self.HOST, self.PORT)
+        self.PEERS.get(peer).set_capabilities(capabilities, confirmed)
+        if confirmed:
+            self.TRANSACTION_HANDLER.probe_datagram_size(peer)
+
+    def probe_peer(self, peer: Tuple[str, int]):
+        """
+        Probes the datagram size of a peer whose capabilities were set unconfirmed, once the reply carrying the
+        agreement is on its way
+        """
+        self.TRANSACTION_HANDLER.probe_datagram_size(peer)
+
+    def peer_statistics(self) -> Dict[Tuple[str, int], Dict[str, int | float | None]]:
+        return self.TRANSACTION_HANDLER.peer_statistics()
+
     def shutdown(self):
+        self.TRANSACTION_HANDLER.untrack_metrics()
+        Metrics.INCOMING_QUEUE_DEPTH.untrack(self)
+        Metrics.OUTGOING_QUEUE_DEPTH.untrack(self)
+        if self.IMPAIRMENT is not None:
+            self.IMPAIRMENT.close()
         self.INCOMING_LOOP.call_soon_threadsafe(self.INCOMING_LOOP.stop)
+        # A listener blocked in a receive keeps the socket, and so the port, alive after close, wake it up first
+        self.CLOSED.set()
+        try:
+            self.SOCKET.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # Not every platform allows shutting down an unconnected datagram socket
+        if threading.current_thread() is not self.LISTEN_THREAD:
+            self.LISTEN_THREAD.join(NetworkCommunicationConstants.SHUTDOWN_TIMEOUT_S)
         self.EXECUTOR.shutdown(wait=True)
         self.SOCKET.close()
         # TODO: Does not handle all of the active threads
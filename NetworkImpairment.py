@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+
+class NetworkImpairment:
+    """
+    Sits between a network handler and its socket and impairs every outgoing datagram: loss, delay with jitter,
+    reordering, duplication and a bandwidth cap.\n
+    Every decision is drawn from one generator seeded with seed, a fixed number of draws per datagram, so the same
+    sequence of sends is always impaired the same way. Datagrams that are delayed are sent from the shim's own thread
+    """
+
+    def __init__(self, loss: float = 0.0, delay_s: float = 0.0, jitter_s: float = 0.0, reorder: float = 0.0,
+                 reorder_delay_s: float = 0.01, duplicate: float = 0.0, bandwidth_bytes_per_s: int | None = None,
+                 seed: int = 0):
+        """
+        loss, reorder and duplicate are per datagram probabilities, a reordered datagram is held back an extra
+        reorder_delay_s so the ones sent after it overtake it
+        """
+        self.loss = loss
+        self.delay_s = delay_s
+        self.jitter_s = jitter_s
+        self.reorder = reorder
+        self.reorder_delay_s = reorder_delay_s
+        self.duplicate = duplicate
+        self.bandwidth_bytes_per_s = bandwidth_bytes_per_s
+        self.random = random.Random(seed)
+        self.send: Callable[[bytes, Tuple[str, int]], None] | None = None
+        self.link_free_at = 0.0
+        self.counters: Dict[str, int] = {'offered': 0, 'offered_bytes': 0, 'dropped': 0, 'duplicated': 0,
+                                         'reordered': 0, 'delivered': 0, 'delivered_bytes': 0}
+        self._queue: List[Tuple[float, int, bytes, Tuple[str, int]]] = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread: threading.Thread | None = None
+
+    def attach(self, send: Callable[[bytes, Tuple[str, int]], None]):
+        """
+        send must put one datagram on the wire and be safe to call from any thread
+        """
+        self.send = send
+
+    def immediate(self) -> bool:
+        return not self.delay_s and not self.jitter_s and not self.reorder and self.bandwidth_bytes_per_s is None
+
+    def sendto(self, raw_packet: bytes, recipient: Tuple[str, int]):
+        with self._condition:
+            lost = self.random.random() < self.loss
+            duplicated = self.random.random() < self.duplicate
+            reordered = self.random.random() < self.reorder
+            jitter = self.random.uniform(-self.jitter_s, self.jitter_s)
+            self.counters['offered'] += 1
+            self.counters['offered_bytes'] += len(raw_packet)
+            if lost:
+                self.counters['dropped'] += 1
+                return
+            copies = 2 if duplicated else 1
+            self.counters['duplicated'] += copies - 1
+            if self.immediate():
+                self.counters['delivered'] += copies
+                self.counters['delivered_bytes'] += copies * len(raw_packet)
+            else:
+                raw_packet = bytes(raw_packet)  # The caller may reuse its buffer before this goes out
+                now = time.perf_counter()
+                for _ in range(copies):
+                    due = self.__transmitted_at__(now, len(raw_packet)) + max(self.delay_s + jitter, 0.0)
+                    if reordered:
+                        self.counters['reordered'] += 1
+                        due += self.reorder_delay_s
+                    heapq.heappush(self._queue, (due, next(self._sequence), raw_packet, recipient))
+                self.__start__()
+                self._condition.notify()
+                return
+        for _ in range(copies):
+            self.send(raw_packet, recipient)
+
+    def __transmitted_at__(self, now: float, length: int) -> float:
+        """
+        When the last bit of a datagram leaves a link capped at bandwidth_bytes_per_s, queued behind earlier ones
+        """
+        if self.bandwidth_bytes_per_s is None:
+            return now
+        self.link_free_at = max(self.link_free_at, now) + length / self.bandwidth_bytes_per_s
+        return self.link_free_at
+
+    def __start__(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.__deliver__)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __deliver__(self):
+        while True:
+            with self._condition:
+                while not self._closed and (not self._queue or self._queue[0][0] > time.perf_counter()):
+                    self._condition.wait(None if not self._queue else self._queue[0][0] - time.perf_counter())
+                if self._closed:
+                    return
+                _, _, raw_packet, recipient = heapq.heappop(self._queue)
+                self.counters['delivered'] += 1
+                self.counters['delivered_bytes'] += len(raw_packet)
+            try:
+                self.send(raw_packet, recipient)
+            except OSError:
+                continue  # The socket closed underneath a delayed datagram
+
+    def statistics(self) -> Dict[str, int]:
+        with self._condition:
+            return {**self.counters, 'queued': len(self._queue)}
+
+    def close(self):
+        """
+        Discards whatever is still delayed and stops the delivery thread
+        """
+        with self._condition:
+            self._closed = True
+            self._queue.clear()
+            self._condition.notify()
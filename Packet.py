@@ -1,5 +1,6 @@
 import math
 import random
+import struct
 import time
 from enum import Enum
 from typing import List, Tuple
@@ -45,6 +46,25 @@ class FooterFormat:
         arr[self.offset: self.offset + self.length] = item
 
 
+HEADER_VERSION_1 = 1
+''' Original header: 3 byte message id, 1 byte packet count, 1 byte sequence number (no version byte) '''
+HEADER_VERSION_2 = 2
+''' Versioned header: version/flags byte, 3 byte message id, 2 byte packet count, 2 byte sequence number '''
+LATEST_HEADER_VERSION = HEADER_VERSION_2
+
+VERSIONED_HEADER_FLAG = 0x80
+''' Set on the first byte of a versioned header, message ids generated by versioned peers always have it clear '''
+HEADER_VERSION_MASK = 0x0F
+
+
+class UnsupportedHeaderVersion(Exception):
+    pass
+
+
+class MessageTooLarge(Exception):
+    pass
+
+
 class Header:
     """
     Automatically create a packet header and transform it into a serialized object.
@@ -52,49 +72,57 @@ class Header:
     * Message ID - bytes representing the random message id
     * Packet Count - int representing the number of packets in this message
     * Packet Sequence Number - int representing the sequence number of this packet
+    * Version - int representing the header layout, only written for versions after HEADER_VERSION_1
     """
 
     MESSAGE_ID = HeaderFormat(3)  # bytes
     PACKET_COUNT = HeaderFormat(1)  # int
     PACKET_SEQUENCE_NUMBER = HeaderFormat(1)  # int
 
-    def __init__(self, messageid: bytes, packetcount: int, packetsequencenumber: int):
+    def __init__(self, messageid: bytes, packetcount: int, packetsequencenumber: int, version: int = HEADER_VERSION_1):
         self.messageid = messageid
         self.packetcount = packetcount
         self.packetsequencenumber = packetsequencenumber
+        self.version = version
+
+    def size(self) -> int:
+        return PacketCodec.header_struct(self.version).size
 
     def to_bytes(self) -> bytes:
         """
         Converts this header into it's byte represented form that can be stored or sent over the network.
         """
-        arr = bytearray(b'\x00' * HeaderFormat.HEADER_LENGTH)
-
-        Header.MESSAGE_ID.set_to(arr, bytearray(self.messageid))
+        if self.version == HEADER_VERSION_1:
+            return PacketCodec.HEADER.pack(self.messageid, self.packetcount, self.packetsequencenumber)
+        return PacketCodec.header_struct(self.version).pack(VERSIONED_HEADER_FLAG | self.version, self.messageid,
+                                                            self.packetcount, self.packetsequencenumber)
 
-        packetcount = self.packetcount.to_bytes(length=Header.PACKET_COUNT.length, byteorder='big')
-        Header.PACKET_COUNT.set_to(arr, bytearray(packetcount))
-
-        packetsequencenumber = self.packetsequencenumber.to_bytes(length=Header.PACKET_SEQUENCE_NUMBER.length,
-                                                                  byteorder='big')
-        Header.PACKET_SEQUENCE_NUMBER.set_to(arr, bytearray(packetsequencenumber))
-
-        return bytes(arr)
+    def pack_into(self, buffer: bytearray | memoryview, offset: int = 0) -> int:
+        """
+        Writes this header directly into buffer at offset, returns the number of bytes written
+        """
+        if self.version == HEADER_VERSION_1:
+            PacketCodec.HEADER.pack_into(buffer, offset, self.messageid, self.packetcount, self.packetsequencenumber)
+            return PacketCodec.HEADER.size
+        codec = PacketCodec.header_struct(self.version)
+        codec.pack_into(buffer, offset, VERSIONED_HEADER_FLAG | self.version, self.messageid, self.packetcount,
+                        self.packetsequencenumber)
+        return codec.size
 
     @classmethod
-    def from_bytes(cls, header: bytes):
+    def from_bytes(cls, header: bytes | memoryview, versioned: bool = False):
         """
-        Constructs a PacketHeader from its byte representation
+        Constructs a PacketHeader from its byte representation, versioned headers are only recognised for peers
+        that negotiated them
         """
-        arr = bytearray(header)
-
-        messageid = bytes(Header.MESSAGE_ID.get_from(arr))
-        packetcount = int.from_bytes(bytes(Header.PACKET_COUNT.get_from(arr)), byteorder='big')
-        packetsequencenumber = int.from_bytes(bytes(Header.PACKET_SEQUENCE_NUMBER.get_from(arr)), byteorder='big')
-
-        return Header(messageid, packetcount, packetsequencenumber)
+        version = PacketCodec.version_of(header, versioned)
+        if version == HEADER_VERSION_1:
+            return Header(*PacketCodec.HEADER.unpack_from(header))
+        _, messageid, packetcount, packetsequencenumber = PacketCodec.header_struct(version).unpack_from(header)
+        return Header(messageid, packetcount, packetsequencenumber, version)
 
     def __str__(self) -> str:
-        return f"HEADER:\n    MessageID: {self.messageid}\n    PacketCount: {self.packetcount}\n    SequenceNumber: {self.packetsequencenumber}"
+        return f"HEADER:\n    Version: {self.version}\n    MessageID: {self.messageid}\n    PacketCount: {self.packetcount}\n    SequenceNumber: {self.packetsequencenumber}"
 
 
 class PayloadType(Enum):
@@ -106,8 +134,13 @@ class PayloadType(Enum):
         * CHAT
         * ACKNOWLEDGE
         * SELECTIVE_REPEAT
-        *
-        *
+        * DH_KEY
+        * PREPARED
+        * PROBE
+        * PROGRESS
+        * GROUP_KEY
+        * GROUP_CHAT
+        * TICKET
     """
 
     # CONNECTION
@@ -126,6 +159,17 @@ class PayloadType(Enum):
     DH_KEY = 6, False
     PREPARED = 7, False
 
+    # TRANSPORT
+    PROBE = 8, False
+    PROGRESS = 9, False
+
+    # GROUP
+    GROUP_KEY = 10, True  # Key id and group key, sent over the pairwise channel
+    GROUP_CHAT = 11, False  # Key id then a payload already encrypted once under that group key
+
+    # RESUMPTION
+    TICKET = 12, True  # Resumption secret then the ticket that carries it back to the server
+
     def __new__(cls, value: int, should_encrypt):
         obj = object.__new__(cls)
         obj._value_ = value
@@ -170,79 +214,154 @@ class Footer:
         """
         Converts this footer into it's byte represented form that can be stored or sent over the network.
         """
-        arr = bytearray(b'\x00' * FooterFormat.FOOTER_LENGTH)
+        return PacketCodec.FOOTER.pack(self.payloadtype.value, self.userid, self.unixtime)
 
-        Footer.PAYLOAD_TYPE.set_to(arr, bytearray(self.payloadtype.to_bytes()))
+    def pack_into(self, buffer: bytearray | memoryview, offset: int = 0) -> int:
+        """
+        Writes this footer directly into buffer at offset, returns the number of bytes written
+        """
+        PacketCodec.FOOTER.pack_into(buffer, offset, self.payloadtype.value, self.userid, self.unixtime)
+        return PacketCodec.FOOTER.size
+
+    @classmethod
+    def from_bytes(cls, footer: bytes | memoryview, offset: int = 0):
+        """
+        Constructs a PacketFooter from its byte representation
+        """
+        payloadtype, userid, unixtime = PacketCodec.FOOTER.unpack_from(footer, offset)
+        return Footer(PayloadType(payloadtype), userid, unixtime)
+
+    def __str__(self) -> str:
+        return f"FOOTER:\n    PayloadType: {self.payloadtype}\n    UserID: {self.userid}\n    UnixTime: {self.unixtime}"
 
-        userid = self.userid.to_bytes(length=Footer.USER_ID.length, byteorder='big')
-        Footer.USER_ID.set_to(arr, bytearray(userid))
 
-        unixtime = self.unixtime.to_bytes(length=Footer.UNIX_TIME.length, byteorder='big')
-        Footer.UNIX_TIME.set_to(arr, bytearray(unixtime))
+class PacketCodec:
+    """
+    Precompiled struct based codec for the packet header & footer.\n
+    Works directly on bytes / bytearray / memoryview objects so that packets can be packed straight into a send
+    buffer and inspected without copying the payload
+    """
 
-        return bytes(arr)
+    HEADER = struct.Struct('>3sBB')  # MESSAGE_ID, PACKET_COUNT, PACKET_SEQUENCE_NUMBER
+    HEADER_V2 = struct.Struct('>B3sHH')  # VERSION, MESSAGE_ID, PACKET_COUNT, PACKET_SEQUENCE_NUMBER
+    FOOTER = struct.Struct('>BII')  # PAYLOAD_TYPE, USER_ID, UNIX_TIME
+
+    @classmethod
+    def header_struct(cls, version: int) -> struct.Struct:
+        if version == HEADER_VERSION_1:
+            return cls.HEADER
+        if version == HEADER_VERSION_2:
+            return cls.HEADER_V2
+        raise UnsupportedHeaderVersion(f"No header with version {version}")
 
     @classmethod
-    def from_bytes(cls, footer: bytes):
+    def version_of(cls, packet: bytes | memoryview, versioned: bool = False) -> int:
+        if versioned and packet[0] & VERSIONED_HEADER_FLAG:
+            return packet[0] & HEADER_VERSION_MASK
+        return HEADER_VERSION_1
+
+    @classmethod
+    def is_truncated(cls, packet: bytes | memoryview, versioned: bool = False) -> bool:
         """
-        Constructs a PacketFooter from its byte representation
+        Whether packet is too short for the header it claims, versioned headers are longer than version 1
         """
-        arr = bytearray(footer)
-        payloadtype = PayloadType.from_bytes(bytes(Footer.PAYLOAD_TYPE.get_from(arr)))
-        userid = int.from_bytes(bytes(Footer.USER_ID.get_from(arr)), byteorder='big')
-        unixtime = int.from_bytes(bytes(Footer.UNIX_TIME.get_from(arr)), byteorder='big')
+        return len(packet) < cls.HEADER.size or len(packet) < cls.header_struct(cls.version_of(packet, versioned)).size
 
-        return Footer(payloadtype, userid, unixtime)
+    @classmethod
+    def max_packet_count(cls, version: int) -> int:
+        return 0xFF if version == HEADER_VERSION_1 else 0xFFFF
 
-    def __str__(self) -> str:
-        return f"FOOTER:\n    PayloadType: {self.payloadtype}\n    UserID: {self.userid}\n    UnixTime: {self.unixtime}"
+    @classmethod
+    def peek_header(cls, packet: bytes | memoryview, versioned: bool = False) -> Tuple[bytes, int, int]:
+        """
+        Reads (message id, packet count, packet sequence number) without decoding the footer or touching the payload
+        """
+        version = cls.version_of(packet, versioned)
+        if version == HEADER_VERSION_1:
+            return cls.HEADER.unpack_from(packet)
+        return cls.header_struct(version).unpack_from(packet)[1:]
+
+    @classmethod
+    def peek_messageid(cls, packet: bytes | memoryview, versioned: bool = False) -> bytes:
+        """
+        Reads only the message id of a raw packet
+        """
+        return cls.peek_header(packet, versioned)[0]
+
+    @classmethod
+    def has_footer(cls, packetcount: int, packetsequencenumber: int) -> bool:
+        return packetcount == packetsequencenumber + 1
+
+    @classmethod
+    def packed_size(cls, payload_length: int, has_footer: bool, version: int = HEADER_VERSION_1) -> int:
+        return cls.header_struct(version).size + payload_length + (cls.FOOTER.size if has_footer else 0)
+
+
+# The codec must agree with the field layout declared on Header & Footer
+assert PacketCodec.HEADER.size == HeaderFormat.HEADER_LENGTH
+assert PacketCodec.FOOTER.size == FooterFormat.FOOTER_LENGTH
 
 
 class Packet:
-    def __init__(self, header: Header, payload: bytes, footer: Footer = None):
+    def __init__(self, header: Header, payload: bytes | memoryview, footer: Footer = None):
         self.header = header
         self.payload = payload
         self.footer = footer
 
+    def size(self) -> int:
+        return PacketCodec.packed_size(len(self.payload), self.footer is not None, self.header.version)
+
+    def pack_into(self, buffer: bytearray | memoryview, offset: int = 0) -> int:
+        """
+        Writes this packet directly into a caller supplied buffer at offset, returns the number of bytes written
+        """
+        end = offset + self.header.pack_into(buffer, offset)
+        payload_end = end + len(self.payload)
+        buffer[end:payload_end] = self.payload
+        if self.footer is not None:
+            payload_end += self.footer.pack_into(buffer, payload_end)
+        return payload_end - offset
+
     def to_bytes(self) -> bytes:
         if self.footer is None:
-            return self.header.to_bytes() + self.payload
+            return b''.join((self.header.to_bytes(), self.payload))
         else:
-            return self.header.to_bytes() + self.payload + self.footer.to_bytes()
+            return b''.join((self.header.to_bytes(), self.payload, self.footer.to_bytes()))
 
     @classmethod
-    def from_bytes(cls, packet: bytes) -> 'Packet':
-        header = Header.from_bytes(packet[:HeaderFormat.HEADER_LENGTH])
+    def from_bytes(cls, packet: bytes | memoryview, versioned: bool = False) -> 'Packet':
+        """
+        Decodes a raw packet, the payload is returned as a memoryview into packet rather than a copy
+        """
+        view = memoryview(packet)
+        header = Header.from_bytes(view, versioned)
+        headerlength = header.size()
         footer = None
-        payload: bytes
-        if header.packetcount == header.packetsequencenumber + 1:
-            footerstart = len(packet) - FooterFormat.FOOTER_LENGTH
-            payload = packet[HeaderFormat.HEADER_LENGTH:footerstart]
-            footer = Footer.from_bytes(packet[footerstart:])
+        if PacketCodec.has_footer(header.packetcount, header.packetsequencenumber):
+            footerstart = len(view) - FooterFormat.FOOTER_LENGTH
+            payload = view[headerlength:footerstart]
+            footer = Footer.from_bytes(view, footerstart)
         else:
-            payload = packet[HeaderFormat.HEADER_LENGTH:]
+            payload = view[headerlength:]
         return Packet(header, payload, footer)
 
     def __str__(self):
         if self.footer is None:
-            return self.header.__str__() + "\n" + f"PAYLOAD:\n    {self.payload}"
+            return self.header.__str__() + "\n" + f"PAYLOAD:\n    {bytes(self.payload)}"
         else:
-            return self.header.__str__() + "\n" + f"PAYLOAD:\n    {self.payload}" + "\n" + self.footer.__str__()
+            return self.header.__str__() + "\n" + f"PAYLOAD:\n    {bytes(self.payload)}" + "\n" + self.footer.__str__()
 
 
 class Message:
-    MAX_PAYLOAD_SIZE_NO_FOOTER = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES - HeaderFormat.HEADER_LENGTH
-
     def __init__(self, payload: bytes, payloadtype: PayloadType, userid: int, messageid: bytes = None,
                  _packetcount: int = None, _unixtime=None, sender: Tuple[str, int] = None):
         if messageid is None:  # If message id is none, assume new message and create a random id
-            messageid = random.getrandbits(8 * Header.MESSAGE_ID.length).to_bytes(length=Header.MESSAGE_ID.length,
-                                                                                  byteorder='big')
+            # The top bit stays clear so a versioned header's first byte can never be mistaken for a message id
+            messageid = random.getrandbits(8 * Header.MESSAGE_ID.length - 1).to_bytes(length=Header.MESSAGE_ID.length,
+                                                                                      byteorder='big')
         self.messageid = messageid
         if _packetcount is None:
-            self.packetcount = math.ceil(
-                (len(payload) + FooterFormat.FOOTER_LENGTH) / (
-                            NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES - HeaderFormat.HEADER_LENGTH))
+            self.packetcount = Message.count_packets(len(payload))
         else:
             self.packetcount = _packetcount
 
@@ -258,43 +377,60 @@ class Message:
 
         self.sender = sender
 
-    """
-    def to_bytes_list(self) -> List[bytes]:
-        byteslist: List[bytes] = [None] * self.packetcount
-        header = Header(self.messageid, self.packetcount, 0)
-
-        # CONSTRUCT MIDDLE PACKETS
-        for psn in range(self.packetcount - 1):
-            payloadstart = psn * Payload.MAX_PAYLOAD_SIZE_NO_FOOTER
-            header.packetsequencenumber = psn
-            packet = Packet(header,
-                            Payload(self.payload[payloadstart:payloadstart + Payload.MAX_PAYLOAD_SIZE_NO_FOOTER]))
-            byteslist[psn] = packet.to_bytes()
+    @classmethod
+    def max_payload_size(cls, header_version: int = HEADER_VERSION_1,
+                         datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES) -> int:
+        """
+        Payload bytes that fit in a packet without a footer, the header is sized by header_version
+        """
+        return datagram_size - PacketCodec.header_struct(header_version).size
 
-        # CONSTRUCT LAST PACKET
-        header.packetsequencenumber = self.packetcount - 1
-        footer = Footer(self.payloadtype, self.userid, self.unixtime)
-        packet = Packet(header, Payload(self.payload[(self.packetcount - 1) * Payload.MAX_PAYLOAD_SIZE_NO_FOOTER:]),
-                        footer)
-        byteslist[self.packetcount - 1] = packet.to_bytes()
+    @classmethod
+    def count_packets(cls, payload_length: int, header_version: int = HEADER_VERSION_1,
+                      datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES) -> int:
+        return math.ceil((payload_length + FooterFormat.FOOTER_LENGTH) /
+                         Message.max_payload_size(header_version, datagram_size))
 
+    def to_bytes_list(self, header_version: int = HEADER_VERSION_1,
+                      datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES) -> List[memoryview]:
+        """
+        Packs every packet of this message into a single preallocated buffer, returning a view per packet
+        """
+        packetlist = self.to_packet_list(header_version, datagram_size)
+        buffer = bytearray(sum(packet.size() for packet in packetlist))
+        view = memoryview(buffer)
+        byteslist: List[memoryview] = [None] * self.packetcount
+        offset = 0
+        for psn, packet in enumerate(packetlist):
+            length = packet.pack_into(view, offset)
+            byteslist[psn] = view[offset:offset + length]
+            offset += length
         return byteslist
-    """
 
-    def to_packet_list(self) -> List[Packet]:
+    def to_packet_list(self, header_version: int = HEADER_VERSION_1,
+                       datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES) -> List[Packet]:
+        if len(self.payload) > NetworkCommunicationConstants.MAXIMUM_MESSAGE_BYTES:
+            raise MessageTooLarge(f"{len(self.payload)} bytes is over the "
+                                  f"{NetworkCommunicationConstants.MAXIMUM_MESSAGE_BYTES} byte message limit")
+        size = Message.max_payload_size(header_version, datagram_size)
+        self.packetcount = Message.count_packets(len(self.payload), header_version, datagram_size)
+        if self.packetcount > PacketCodec.max_packet_count(header_version):
+            raise MessageTooLarge(f"{len(self.payload)} bytes needs {self.packetcount} packets, header version "
+                                  f"{header_version} allows {PacketCodec.max_packet_count(header_version)}")
         packetlist: List[Packet] | List[None] = [None] * self.packetcount
+        payload = memoryview(self.payload)  # Slice fragments without copying them
 
         # CONSTRUCT MIDDLE PACKETS
         for psn in range(self.packetcount - 1):
-            payloadstart = psn * Message.MAX_PAYLOAD_SIZE_NO_FOOTER
-            packetlist[psn] = Packet(Header(self.messageid, self.packetcount, psn),
-                                     self.payload[payloadstart:payloadstart + Message.MAX_PAYLOAD_SIZE_NO_FOOTER])
+            payloadstart = psn * size
+            packetlist[psn] = Packet(Header(self.messageid, self.packetcount, psn, header_version),
+                                     payload[payloadstart:payloadstart + size])
 
         # CONSTRUCT LAST PACKET
-        packetlist[self.packetcount - 1] = Packet(Header(self.messageid, self.packetcount, self.packetcount - 1),
-                                                  self.payload[
-                                                  (self.packetcount - 1) * Message.MAX_PAYLOAD_SIZE_NO_FOOTER:],
-                                                  Footer(self.payloadtype, self.userid, self.unixtime))
+        packetlist[self.packetcount - 1] = Packet(
+            Header(self.messageid, self.packetcount, self.packetcount - 1, header_version),
+            payload[(self.packetcount - 1) * size:],
+            Footer(self.payloadtype, self.userid, self.unixtime))
 
         return packetlist
 
@@ -318,9 +454,7 @@ class Message:
 
     @classmethod
     def from_packet_list(cls, packetlist: List[Packet], sender: Tuple[str, int] = None) -> 'Message':
-        payload = b''
-        for packet in packetlist:
-            payload += packet.payload
+        payload = b''.join(packet.payload for packet in packetlist)
         footer = packetlist[-1].footer
         header = packetlist[-1].header
         return Message(payload, footer.payloadtype, footer.userid, header.messageid, header.packetcount,
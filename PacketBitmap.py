@@ -0,0 +1,103 @@
+import struct
+from typing import List, Tuple
+
+REPEAT_MARKER = 0xFF
+''' First byte of a compact selective repeat payload, legacy payloads list increasing indices so never start with it '''
+REPEAT_RANGES = 0
+REPEAT_BITMAP = 1
+
+RANGE = struct.Struct('>HH')  # START, LENGTH
+
+
+class PacketBitmap:
+    """
+    Fixed size bitmap of packet sequence numbers with a running count of set bits
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.count = 0
+
+    def set(self, index: int) -> bool:
+        """
+        Marks index, returns False if it was already marked
+        """
+        if not 0 <= index < self.size:
+            raise IndexError(f"Sequence number {index} outside of bitmap of size {self.size}")
+        byte, bit = index >> 3, 1 << (index & 7)
+        if self.bits[byte] & bit:
+            return False
+        self.bits[byte] |= bit
+        self.count += 1
+        return True
+
+    def __contains__(self, index: int) -> bool:
+        return 0 <= index < self.size and bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def is_full(self) -> bool:
+        return self.count == self.size
+
+    def missing(self) -> List[int]:
+        return [index for start, length in self.missing_ranges() for index in range(start, start + length)]
+
+    def missing_ranges(self) -> List[Tuple[int, int]]:
+        """
+        Runs of unset bits as (start, length), whole bytes that are complete are skipped without looking at bits
+        """
+        ranges: List[Tuple[int, int]] = []
+        start = None
+        for byte_index, byte in enumerate(self.bits):
+            if byte == 0xFF:
+                if start is not None:
+                    ranges.append((start, byte_index * 8 - start))
+                    start = None
+                continue
+            for bit in range(8):
+                index = byte_index * 8 + bit
+                if index >= self.size:
+                    break
+                if byte & (1 << bit):
+                    if start is not None:
+                        ranges.append((start, index - start))
+                        start = None
+                elif start is None:
+                    start = index
+        if start is not None:
+            ranges.append((start, self.size - start))
+        return ranges
+
+
+def encode_selective_repeat(bitmap: PacketBitmap, max_length: int) -> bytes:
+    """
+    Encodes the missing packets of bitmap as either run-length ranges or a missing-packet bitmap, whichever is smaller.
+    Ranges that do not fit in max_length are left for the next repeat request
+    """
+    ranges = bitmap.missing_ranges()
+    if RANGE.size * len(ranges) > len(bitmap.bits) and len(bitmap.bits) + 2 <= max_length:
+        missing = bytes(~byte & 0xFF for byte in bitmap.bits)
+        if bitmap.size & 7:  # Clear the padding bits past the end of the bitmap
+            missing = missing[:-1] + bytes((missing[-1] & ((1 << (bitmap.size & 7)) - 1),))
+        return bytes((REPEAT_MARKER, REPEAT_BITMAP)) + missing
+    ranges = ranges[:(max_length - 2) // RANGE.size]
+    return bytes((REPEAT_MARKER, REPEAT_RANGES)) + b''.join(RANGE.pack(start, length) for start, length in ranges)
+
+
+def encode_legacy_selective_repeat(bitmap: PacketBitmap, max_length: int) -> bytes:
+    """
+    Encodes the missing packets of bitmap one byte per index, the only form peers that never negotiated capabilities
+    read. Those only send version 1 headers, so every index fits in a byte
+    """
+    return bytes(bitmap.missing()[:max_length])
+
+
+def decode_selective_repeat(payload: bytes) -> List[int]:
+    """
+    Decodes a selective repeat payload into the requested sequence numbers, accepting the legacy one byte per index form
+    """
+    if len(payload) < 2 or payload[0] != REPEAT_MARKER:
+        return list(payload)
+    if payload[1] == REPEAT_BITMAP:
+        return [byte_index * 8 + bit for byte_index, byte in enumerate(payload[2:]) if byte
+                for bit in range(8) if byte & (1 << bit)]
+    return [index for start, length in RANGE.iter_unpack(payload[2:]) for index in range(start, start + length)]
@@ -0,0 +1,155 @@
+import threading
+from typing import Dict, Tuple
+
+import BetterLog
+import NetworkCommunicationConstants
+import Packet
+from Capabilities import Capabilities
+from FlowControl import RoundTripEstimator, SendWindow
+
+
+class PeerState:
+    """
+    Everything the transport knows about one remote address
+    """
+
+    def __init__(self):
+        self.capabilities: Capabilities | None = None
+        self.confirmed: bool = False
+        self.header_version: int = Packet.HEADER_VERSION_1
+        self.datagram_size: int = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES
+        self.probes: Dict[bytes, int] = {}
+        self.window: SendWindow | None = None
+        self.round_trip = RoundTripEstimator()
+
+    def set_capabilities(self, capabilities: Capabilities, confirmed: bool = True):
+        """
+        An unconfirmed peer is parsed as versioned straight away, but is only sent versioned headers once it has
+        sent one itself, proving it received the agreement
+        """
+        self.capabilities = capabilities
+        if capabilities.supports(Capabilities.FLOW_CONTROL):
+            if self.window is None:
+                self.window = SendWindow()
+                if self.round_trip.smoothed_ns is not None:
+                    self.window.round_trip_ns = max(self.round_trip.smoothed_ns, NetworkCommunicationConstants.FLOW_MINIMUM_PACING_ROUND_TRIP_NS)
+        else:
+            self.window = None
+        if confirmed:
+            self.confirmed = True
+            self.header_version = capabilities.header_version
+
+    def confirm_header_version(self, version: int):
+        if self.capabilities is not None and version <= self.capabilities.header_version:
+            self.confirmed = True
+            self.header_version = version
+
+    def probe_sizes(self) -> list:
+        """
+        Datagram sizes worth probing, larger than the current size and within what both sides can receive
+        """
+        if self.capabilities is None:
+            return []
+        limit = min(self.capabilities.max_datagram_size, NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES)
+        return [size for size in NetworkCommunicationConstants.DATAGRAM_PROBE_SIZES_BYTES
+                if self.datagram_size < size <= limit]
+
+    def acknowledged(self, message_id: bytes):
+        size = self.probes.pop(message_id, None)
+        if size is not None and size > self.datagram_size:
+            BetterLog.log_text("Datagram Size Probe Acknowledged: {}", size)
+            self.datagram_size = size
+
+    def datagram_lost(self):
+        """
+        Falls back to the default datagram size when traffic sent with a probed size goes unacknowledged
+        """
+        if self.datagram_size > NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES:
+            BetterLog.log_text("Datagram Size Falling Back: {}", self.datagram_size, level=BetterLog.WARNING)
+            self.datagram_size = NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES
+            self.probes.clear()
+
+    def aggregates_acknowledgements(self) -> bool:
+        return self.capabilities is not None and self.capabilities.supports(Capabilities.ACK_AGGREGATION)
+
+    def acknowledgements_per_datagram(self) -> int:
+        """
+        Message ids one acknowledgement can carry, the first in its header and the rest in its payload
+        """
+        payload = Packet.Message.max_payload_size(self.header_version, self.datagram_size) - \
+            Packet.FooterFormat.FOOTER_LENGTH
+        return 1 + payload // Packet.Header.MESSAGE_ID.length
+
+    def accepts_bundles(self) -> bool:
+        """
+        Only a peer known to hold the agreement can unpack a bundle
+        """
+        return self.confirmed and self.capabilities.supports(Capabilities.BUNDLING)
+
+    def sample_round_trip(self, round_trip_ns: int):
+        self.round_trip.sample(round_trip_ns)
+        if self.window is not None:  # Pace over the measured round trip rather than the default
+            self.window.round_trip_ns = max(self.round_trip.smoothed_ns, NetworkCommunicationConstants.FLOW_MINIMUM_PACING_ROUND_TRIP_NS)
+
+    def statistics(self) -> Dict[str, int | float | None]:
+        return {
+            "header_version": self.header_version,
+            "datagram_size": self.datagram_size,
+            "round_trip_ns": self.round_trip.smoothed_ns,
+            "round_trip_variance_ns": self.round_trip.variance_ns,
+            "resend_timeout_ns": self.round_trip.timeout_ns,
+            "round_trip_samples": self.round_trip.samples,
+            "window_packets": None if self.window is None else self.window.window,
+            "in_flight_packets": None if self.window is None else self.window.in_flight,
+            "queued_packets": None if self.window is None else len(self.window),
+        }
+
+    def is_versioned(self) -> bool:
+        """
+        Peers that negotiated capabilities may send versioned headers, legacy peers never do
+        """
+        return self.capabilities is not None
+
+    def reports_progress(self) -> bool:
+        """
+        Flow controlled peers wait on PROGRESS reports to move their window along large messages
+        """
+        return self.capabilities is not None and self.capabilities.supports(Capabilities.FLOW_CONTROL)
+
+
+class PeerTable:
+    def __init__(self):
+        self._peers: Dict[Tuple[str, int], PeerState] = {}
+        self._lock = threading.Lock()
+
+    def get(self, peer: Tuple[str, int]) -> PeerState:
+        state = self._peers.get(peer)
+        if state is None:
+            with self._lock:
+                state = self._peers.setdefault(peer, PeerState())
+        return state
+
+    def find(self, peer: Tuple[str, int]) -> PeerState | None:
+        return self._peers.get(peer)
+
+    def datagram_size(self, peer: Tuple[str, int]) -> int:
+        state = self._peers.get(peer)
+        return NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES if state is None else state.datagram_size
+
+    def header_version(self, peer: Tuple[str, int]) -> int:
+        state = self._peers.get(peer)
+        return Packet.HEADER_VERSION_1 if state is None else state.header_version
+
+    def is_versioned(self, peer: Tuple[str, int]) -> bool:
+        state = self._peers.get(peer)
+        return state is not None and state.is_versioned()
+
+    def pop(self, peer: Tuple[str, int]) -> PeerState | None:
+        with self._lock:
+            return self._peers.pop(peer, None)
+
+    def __contains__(self, peer: Tuple[str, int]) -> bool:
+        return peer in self._peers
+
+    def __iter__(self):
+        return iter(list(self._peers.items()))
@@ -1,46 +1,202 @@
-from typing import Tuple
+import os
+from typing import Dict, List, Tuple
+import AsyncNetworkHandler
+import Compression
 import ConnectedClient
 import NetworkCommunicationConstants
 import NetworkHandler
 import Packet
 import BetterLog
+import Metrics
 import threading
+from Capabilities import Capabilities
+from CryptWrapper import CryptWrapper
+import EncryptionHandler
+from EncryptionHandler import GroupKey, ResumptionTickets
+from HandshakeExecutor import HandshakeExecutor
+from NetworkImpairment import NetworkImpairment
 
 
 class Server:
-    def __init__(self, user_id: int = 0, port: int = 8888):
-        self.handler = NetworkHandler.NetworkHandler(port, self.__recv__, user_id)
+    def __init__(self, user_id: int = 0, port: int = 8888,
+                 single_loop: bool = NetworkCommunicationConstants.SINGLE_LOOP_ENGINE, metrics_port: int | None = None,
+                 impairment: NetworkImpairment | None = None):
+        """
+        metrics_port starts a local Prometheus text endpoint on that port, metrics() works either way.\n
+        impairment impairs everything the server sends, for testing recovery on a lossy network
+        """
+        handler_type = AsyncNetworkHandler.AsyncNetworkHandler if single_loop else NetworkHandler.NetworkHandler
+        self.handshakes = HandshakeExecutor()
+        self.handler = handler_type(port, self.__recv__, user_id, impairment=impairment)
         self.user_id = user_id
         self.clients: ConnectedClient.ClientList = ConnectedClient.ClientList()
+        self.group_key = GroupKey.generate()
+        self.group_lock = threading.Lock()
+        self.tickets = ResumptionTickets()
+        label = str(port)
+        Metrics.CONNECTED_CLIENTS.track(self, lambda: {label: len(self.clients.client_dictionary)})
+        Metrics.HANDSHAKE_QUEUE_DEPTH.track(self, lambda: {label: self.handshakes.pending})
+        self.metrics_server = None if metrics_port is None else Metrics.REGISTRY.serve(metrics_port)
         self.disconnect_inactive()
 
     def generate_dh_and_send_public(self, client: Tuple[str, int]):
-        dh_public, is_prepared = self.clients.client_dictionary[client].encryption_handler.generate_dh_keys()
-        self.send_message(Packet.PayloadType.DH_KEY, client, dh_public)
-        if is_prepared:
-            self.send_message(Packet.PayloadType.PREPARED, client)
+        dh_parameters = self.clients.client_dictionary[client].encryption_handler.dh_parameters_bytes
+        if not self.handshakes.submit(CryptWrapper.generate_serialized_dh_keys, bytes(dh_parameters),
+                                      callback=lambda keys: self.generated_dh_keys(client, *keys)):
+            self.reject_handshake(client)
+
+    def generated_dh_keys(self, client: Tuple[str, int], private_key: bytes, public_key: bytes):
+        connected_client = self.clients.client_dictionary.get(client)
+        if connected_client is None:
+            return
+        exchange = connected_client.encryption_handler.accept_dh_keys(private_key, public_key)
+        self.send_message(Packet.PayloadType.DH_KEY, client, public_key)
+        self.derive_aes_gcm_key(client, exchange)
 
     def receive_other_dh_public(self, other_public_key: bytes, client: Tuple[str, int]):
-        is_prepared = self.clients.client_dictionary[client].encryption_handler.received_other_public_key(other_public_key)
-        if is_prepared:
-            self.send_message(Packet.PayloadType.PREPARED, client)
+        connected_client = self.clients.client_dictionary.get(client)
+        if connected_client is None:
+            return
+        self.derive_aes_gcm_key(client, connected_client.encryption_handler.accept_other_public_key(other_public_key))
 
-    def send_message(self, payload_type: Packet.PayloadType, recipient: Tuple[str, int], payload: bytes = b'', unix_time: None | int = None, user_id: int | None = None):
+    def derive_aes_gcm_key(self, client: Tuple[str, int], exchange: Tuple[bytes, bytes] | None):
+        if exchange is None:  # Still waiting on the other key
+            return
+        if not self.handshakes.submit(CryptWrapper.derive_serialized_aes_gcm_key, *exchange,
+                                      callback=lambda aes_gcm_key: self.derived_aes_gcm_key(client, aes_gcm_key)):
+            self.reject_handshake(client)
+
+    def derived_aes_gcm_key(self, client: Tuple[str, int], aes_gcm_key: bytes):
+        connected_client = self.clients.client_dictionary.get(client)
+        if connected_client is None:
+            return
+        connected_client.encryption_handler.accept_aes_gcm_key(aes_gcm_key)
+        self.send_message(Packet.PayloadType.PREPARED, client)
+        self.client_prepared(client)
+
+    def reject_handshake(self, client: Tuple[str, int]):
+        """
+        The handshake queue is full, so the client is dropped rather than left waiting on a handshake that never runs
+        """
+        BetterLog.log_text("HANDSHAKE QUEUE FULL, REJECTING CLIENT: {}", client, level=BetterLog.WARNING)
+        Metrics.HANDSHAKES_REJECTED.inc(client)
+        self.clients.force_disconnect(client)
+        self.send_message(Packet.PayloadType.DISCONNECT, client)
+
+    def handshake_statistics(self) -> Dict[str, int | float | None]:
+        return self.handshakes.statistics()
+
+    def metrics(self) -> Dict[str, Dict]:
+        """
+        Every transport, handshake and encryption metric in this process, globally and per peer
+        """
+        return Metrics.REGISTRY.snapshot()
+
+    def resume_session(self, client: Tuple[str, int], capabilities: Capabilities, agreed: Capabilities) -> bool:
+        """
+        Derives the session key from the ticket the client presented, False if there is no ticket this server accepts
+        """
+        if not agreed.supports(Capabilities.RESUMPTION) or not capabilities.ticket:
+            return False
+        resumption_secret = self.tickets.open(capabilities.ticket)
+        if resumption_secret is None:
+            BetterLog.log_text("REJECTED RESUMPTION TICKET: {}", client, level=BetterLog.WARNING)
+            Metrics.TICKETS_REJECTED.inc(client)
+            return False
+        agreed.ticket_nonce = os.urandom(NetworkCommunicationConstants.RESUMPTION_NONCE_LENGTH)
+        self.clients.client_dictionary[client].encryption_handler.resume(resumption_secret, capabilities.ticket_nonce,
+                                                                         agreed.ticket_nonce)
+        Metrics.SESSIONS_RESUMED.inc(client)
+        return True
+
+    def agree_x25519(self, client: Tuple[str, int], capabilities: Capabilities, agreed: Capabilities) -> bool:
+        """
+        Answers the key share the client sent with CONNECT, X25519 is cheap enough to stay inline rather than go
+        through the handshake pool
+        """
+        if agreed.key_exchange_method() != EncryptionHandler.X25519 or not capabilities.key_share:
+            return False
+        encryption_handler = self.clients.client_dictionary[client].encryption_handler
+        agreed.key_share = encryption_handler.generate_x25519_keys()
+        return encryption_handler.received_other_x25519_key(capabilities.key_share)
+
+    def client_prepared(self, client: Tuple[str, int]):
+        """
+        Called wherever client's channel may just have become usable in both directions
+        """
+        self.issue_ticket(client)
+        self.share_group_key(client)
+
+    def issue_ticket(self, client: Tuple[str, int]):
+        with self.group_lock:
+            connected_client = self.clients.client_dictionary.get(client)
+            if connected_client is None or not connected_client.resumption or connected_client.ticket_issued:
+                return
+            if not connected_client.encryption_handler.is_prepared():
+                return
+            connected_client.ticket_issued = True
+        resumption_secret, ticket = self.tickets.issue()
+        self.send_message(Packet.PayloadType.TICKET, client, resumption_secret + ticket)
+
+    def share_group_key(self, client: Tuple[str, int]):
+        """
+        Sends the current group key over client's own channel once both sides of it are prepared
+        """
+        with self.group_lock:
+            connected_client = self.clients.client_dictionary.get(client)
+            if connected_client is None or not connected_client.group_broadcast:
+                return
+            if not connected_client.encryption_handler.is_prepared():
+                return
+            if connected_client.group_key_id == self.group_key.key_id:
+                return
+            connected_client.group_key_id = self.group_key.key_id
+            group_key = self.group_key
+        self.send_message(Packet.PayloadType.GROUP_KEY, client, group_key.to_bytes())
+
+    def rotate_group_key(self):
+        """
+        Replaces the group key after a member leaves, so it cannot read broadcasts sent after it left
+        """
+        with self.group_lock:
+            self.group_key = GroupKey.generate(self.group_key)
+        BetterLog.log_text("ROTATED GROUP KEY")
+        Metrics.GROUP_KEY_ROTATIONS.inc()
+        for client, _ in list(self.clients):
+            self.share_group_key(client)
+
+    def build_message(self, payload_type: Packet.PayloadType, recipient: Tuple[str, int], payload: bytes = b'', unix_time: None | int = None, user_id: int | None = None, compressed: Dict[int, bytes] | None = None) -> Packet.Message | None:
+        """
+        compressed caches the payload per codec, so a broadcast compresses it once per codec rather than per client
+        """
         if user_id is None:
             user_id = self.user_id
         if payload_type.should_encrypt():
-            if self.clients.client_dictionary[recipient].encryption_handler.is_prepared():
-                payload = self.clients.client_dictionary[recipient].encryption_handler.encrypt(payload)
-                message = Packet.Message(payload, payload_type, user_id, None, None, unix_time)
-                self.handler.send_message(message, recipient)
+            connected_client = self.clients.client_dictionary[recipient]
+            if connected_client.encryption_handler.is_prepared():
+                if connected_client.compression is not None:
+                    if compressed is None:
+                        compressed = {}
+                    if connected_client.compression not in compressed:
+                        compressed[connected_client.compression] = Compression.compress(payload,
+                                                                                        connected_client.compression)
+                    payload = compressed[connected_client.compression]
+                payload = connected_client.encryption_handler.encrypt(payload)
+                return Packet.Message(payload, payload_type, user_id, None, None, unix_time)
             else:
-                BetterLog.log_text('COULD NOT SEND MESSAGE: ENCRYPTION NOT READY')
+                BetterLog.log_text('COULD NOT SEND MESSAGE: ENCRYPTION NOT READY', level=BetterLog.WARNING)
+                return None
         else:
-            message = Packet.Message(payload, payload_type, user_id)
+            return Packet.Message(payload, payload_type, user_id)
+
+    def send_message(self, payload_type: Packet.PayloadType, recipient: Tuple[str, int], payload: bytes = b'', unix_time: None | int = None, user_id: int | None = None):
+        message = self.build_message(payload_type, recipient, payload, unix_time, user_id)
+        if message is not None:
             self.handler.send_message(message, recipient)
 
     def disconnect_inactive(self):
-        self.clients.disconnect_inactive()
+        if self.clients.disconnect_inactive():
+            self.rotate_group_key()
 
         # Create a timer to re-call this method in N ns
         threading.Timer(NetworkCommunicationConstants.HEARTBEAT_POLL_TIME_S, self.disconnect_inactive).start()
@@ -59,17 +215,41 @@ class Server:
         payload = message.payload
         if message.payloadtype.should_encrypt():
             payload = self.clients.client_dictionary[sender].encryption_handler.decrypt(message.payload)
+            if self.clients.client_dictionary[sender].compression is not None:
+                payload = Compression.decompress(payload)
 
         if message.payloadtype == Packet.PayloadType.CONNECT:
             # CONNECT
-            self.clients.received_connection(sender, message.userid, message.payload)
-            t = threading.Thread(target=self.generate_dh_and_send_public, args=(sender,))
-            t.daemon = True
-            t.start()
+            dh_parameters, capabilities = Capabilities.split(message.payload)
+            self.clients.received_connection(sender, message.userid, dh_parameters)
+            # A reconnecting client forgot what it negotiated before, so it is negotiated afresh from the first header
+            self.handler.PEERS.pop(sender)
+            if capabilities is not None:
+                # Accept the client's versioned packets before it can see the reply, but only send them once the
+                # client has, so the reply itself still goes out with the original header
+                agreed = Capabilities.local().agree(capabilities)
+                self.clients.client_dictionary[sender].compression = agreed.compression_codec()
+                self.clients.client_dictionary[sender].group_broadcast = agreed.supports(Capabilities.GROUP_BROADCAST)
+                self.clients.client_dictionary[sender].resumption = agreed.supports(Capabilities.RESUMPTION)
+                self.clients.client_dictionary[sender].encryption_handler.chunked = agreed.supports(
+                    Capabilities.CHUNKED_AEAD)
+                self.handler.set_peer_capabilities(sender, agreed, confirmed=False)
+                if self.resume_session(sender, capabilities, agreed) or self.agree_x25519(sender, capabilities, agreed):
+                    # Everything needed came with CONNECT, so the reply prepares both sides without any DH_KEY
+                    # exchange
+                    self.send_message(Packet.PayloadType.CONNECT, sender, agreed.to_bytes())
+                    self.send_message(Packet.PayloadType.PREPARED, sender)
+                    self.handler.probe_peer(sender)
+                    return
+                self.send_message(Packet.PayloadType.CONNECT, sender, agreed.to_bytes())
+                # Probes only follow the reply, so the client knows the agreed datagram size before any arrives
+                self.handler.probe_peer(sender)
+            self.generate_dh_and_send_public(sender)
 
         elif message.payloadtype == Packet.PayloadType.DISCONNECT:
             # DISCONNECT
             self.clients.force_disconnect(sender)
+            self.rotate_group_key()
 
         elif message.payloadtype == Packet.PayloadType.HEARTBEAT:
             # HEARTBEAT
@@ -81,17 +261,38 @@ class Server:
 
         elif message.payloadtype == Packet.PayloadType.DH_KEY:
             # DH KEY
-            t = threading.Thread(target=self.receive_other_dh_public, args=(message.payload, sender))
-            t.daemon = True
-            t.start()
+            self.receive_other_dh_public(bytes(message.payload), sender)
 
         elif message.payloadtype == Packet.PayloadType.PREPARED:
             # PREPARED
             self.clients.client_dictionary[sender].encryption_handler.other_prepared = True
+            self.client_prepared(sender)
 
         else:
             BetterLog.log_incoming("Received Packet with null Payload Type")
 
     def broadcast(self, payload_type: Packet.PayloadType, payload, unix_time: int | None, user_id: int):
-        for client, connected_client in self.clients:
-            self.send_message(payload_type, client, payload, unix_time, user_id)
+        """
+        Members holding the current group key share one message encrypted once under it per negotiated codec, everyone
+        else is sent their own copy over their pairwise channel
+        """
+        group_key = self.group_key
+        members: Dict[int | None, List[Tuple[str, int]]] = {}
+        messages = []
+        compressed: Dict[int, bytes] = {}
+        for client, connected_client in list(self.clients):
+            if payload_type == Packet.PayloadType.CHAT and connected_client.group_key_id == group_key.key_id:
+                members.setdefault(connected_client.compression, []).append(client)
+                continue
+            message = self.build_message(payload_type, client, payload, unix_time, user_id, compressed)
+            if message is not None:
+                messages.append((message, client))
+        for codec, recipients in members.items():
+            # Members that negotiated no codec are sent the bare payload, exactly as over their pairwise channel
+            if codec is not None and codec not in compressed:
+                compressed[codec] = Compression.compress(payload, codec)
+            shared = payload if codec is None else compressed[codec]
+            self.handler.send_shared(Packet.Message(group_key.encrypt(shared), Packet.PayloadType.GROUP_CHAT, user_id,
+                                                    None, None, unix_time), recipients)
+        if messages:
+            self.handler.send_messages(messages)
@@ -1,10 +1,16 @@
 
 from CryptWrapper import CryptWrapper
+from EncryptionHandler import rfc3526_group_14
 
-dh_private, dh_public = CryptWrapper.generate_dh_keys()
-print(dh_public)
-other_dh_public = bytes(input("Enter other public: "), "utf-8")
+# Both ends of a DH exchange in one process, a quick check of key agreement and the AES GCM round trip
+dh_parameters, _ = rfc3526_group_14()
+dh_private, dh_public = CryptWrapper.generate_dh_keys(dh_parameters)
+other_dh_private, other_dh_public = CryptWrapper.generate_dh_keys(dh_parameters)
+print(dh_public.decode())
 
 s_aes_gcm = CryptWrapper.generate_aes_gcm_key(dh_private, other_dh_public)
+other_aes_gcm = CryptWrapper.generate_aes_gcm_key(other_dh_private, dh_public)
 print("AES GCM KEYS GENERATED")
 
+assert CryptWrapper.decrypt(other_aes_gcm, CryptWrapper.encrypt(s_aes_gcm, b'TEST')) == b'TEST'
+print("AES GCM ROUND TRIP OK")
@@ -1,12 +1,21 @@
-import asyncio
+import heapq
+import itertools
 import threading
 import time
 from collections import OrderedDict
-from typing import Tuple, List, Dict
+from typing import Callable, Tuple, List, Dict
 
 import BetterLog
+import Metrics
 import NetworkCommunicationConstants
 import Packet
+import PacketBitmap
+from FlowControl import RoundTripEstimator
+from PeerState import PeerState, PeerTable
+
+
+TransactionKey = Tuple[bytes, Tuple[str, int]]
+''' (message id, peer), message ids are only unique per peer and a broadcast reuses one id for every recipient '''
 
 
 def create_response_time(nanoseconds: int) -> int:
@@ -19,9 +28,9 @@ class CompletedMessages:
         self._maxsize = maxsize
         self._lock = threading.Lock()
 
-    def add(self, messageid: bytes):
+    def add(self, key: TransactionKey):
         with self._lock:
-            self._cache[messageid] = None
+            self._cache[key] = None
             if len(self._cache) > self._maxsize:
                 self._cache.popitem(last=False)
 
@@ -30,18 +39,51 @@ class CompletedMessages:
             return item in self._cache
 
 
+class PendingAcknowledgements:
+    """
+    Completed message ids per peer waiting to share one acknowledgement
+    """
+
+    def __init__(self):
+        self._pending: Dict[Tuple[str, int], List[bytes]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, peer: Tuple[str, int], message_id: bytes, limit: int) -> Tuple[List[bytes] | None, bool]:
+        """
+        Queues message_id, returns the peer's ids once they fill an acknowledgement and whether it started a new one
+        """
+        with self._lock:
+            ids = self._pending.setdefault(peer, [])
+            ids.append(message_id)
+            if len(ids) >= limit:
+                return self._pending.pop(peer), False
+            return None, len(ids) == 1
+
+    def drain(self) -> List[Tuple[Tuple[str, int], List[bytes]]]:
+        with self._lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        return pending
+
+
 class TransactionRecord:
-    def __init__(self, incoming: bool, arg: int | List[bytes]):
+    def __init__(self, incoming: bool, arg: int | List[bytes], round_trip: RoundTripEstimator | None = None):
         self.is_incoming = incoming
         self.incoming: IncomingTransaction | None = None
         self.outgoing: OutgoingTransaction | None = None
         self.communicator: Tuple[str, int] | None = None
         self.lock: threading.Lock = threading.Lock()
         self.reattempts: int = 0
+        self.heard: int = time.time_ns()  # When the peer last made progress on this transaction
+        self.scheduled_deadline: int = 0
+        self.generation: int = 0  # Only the heap entry carrying the current generation is live
+        self.queued: bool = False  # Whether that entry is still in the heap
+        self.reported: int = 0
+        self.round_trip: RoundTripEstimator = RoundTripEstimator() if round_trip is None else round_trip
         if incoming:
-            self.incoming = IncomingTransaction(arg)
+            self.incoming = IncomingTransaction(arg, self.round_trip)
         else:
-            self.outgoing = OutgoingTransaction(arg)
+            self.outgoing = OutgoingTransaction(arg, self.round_trip)
 
     def release(self) -> bool:
         if self.lock.locked():
@@ -49,60 +91,178 @@ class TransactionRecord:
             return True
         return False
 
-    def is_overdue(self) -> bool:
+    def deadline(self) -> int:
         if self.is_incoming:
-            return time.time_ns() > self.incoming.selective_repeat_time
+            return self.incoming.selective_repeat_time
         else:
-            return time.time_ns() > self.outgoing.resend_time
-
-    def recv_packet(self, packet: Packet.Packet) -> List[Packet.Packet] | None:
-        self.incoming.recv_packet(packet)
+            return self.outgoing.resend_time
+
+    def is_overdue(self, now: int | None = None) -> bool:
+        if now is None:
+            now = time.time_ns()
+        return now > self.deadline()
+
+    def has_failed(self, now: int) -> bool:
+        """
+        Out of attempts and the peer has been silent for long enough, a short timeout alone never fails a transaction
+        """
+        return (self.reattempts >= NetworkCommunicationConstants.GIVE_UP_REATTEMPTS and
+                now - self.heard >= NetworkCommunicationConstants.GIVE_UP_TIME_NS)
+
+    def recv_packet(self, packet: Packet.Packet) -> bool:
+        """
+        Stores the packet, returns True only for the packet that completes the message
+        """
+        is_new = self.incoming.recv_packet(packet)
+        self.heard_from()
+        return is_new and self.incoming.is_completed()
+
+    def progress(self, interval: int) -> int:
+        """
+        Number of packets received so far once another interval of them has arrived since the last report, else 0
+        """
+        received = self.incoming.received.count
+        if interval and not self.incoming.is_completed() and received - self.reported >= interval:
+            self.reported = received
+            return received
+        return 0
+
+    def heard_from(self):
         self.reattempts = 0
-        if self.incoming.is_completed():
-            return self.incoming.received
-        return None
+        self.heard = time.time_ns()
+
+    def progressed(self):
+        self.heard_from()
+        self.held()
+
+    def held(self):
+        """
+        Pushes the resend back without counting an attempt, the message is still queued behind the congestion window
+        """
+        self.outgoing.resend_time = create_response_time(self.round_trip.resend_timeout())
 
     def sent_repeat(self):
         self.reattempts += 1
-        self.incoming.selective_repeat_time = create_response_time(NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
+        self.incoming.selective_repeat_time = create_response_time(self.round_trip.resend_timeout(self.reattempts))
 
     def resent(self):
         self.reattempts += 1
-        self.outgoing.resend_time = create_response_time(NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
+        self.outgoing.retransmitted = True
+        self.round_trip.timed_out()
+        self.outgoing.resend_time = create_response_time(self.round_trip.resend_timeout(self.reattempts))
+
+
+class DeadlineHeap:
+    """
+    Min-heap of transaction deadlines so a poll only touches transactions that are actually due.\n
+    Entries are not updated in place. A deadline that moves later is caught when its entry surfaces early and is
+    re-pushed, one that moves earlier (a selective repeat, progress, a smaller round trip) must be rescheduled so it is
+    not stuck behind the later entry. Every push or discard gives the record a new generation, so the entries it left
+    behind are stale and are dropped when popped, or all at once when they outnumber the live ones
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int, TransactionKey]] = []  # DEADLINE, GENERATION, KEY
+        self._generations = itertools.count(1)  # Shared by every record, a replaced record's entries never match
+        self._stale: int = 0
+
+    def push(self, key: TransactionKey, record: TransactionRecord, deadline: int | None = None):
+        if deadline is None:
+            deadline = record.deadline()
+        if record.queued:  # Its previous entry is still in the heap
+            self._stale += 1
+        record.generation = next(self._generations)
+        record.queued = True
+        record.scheduled_deadline = deadline
+        heapq.heappush(self._heap, (deadline, record.generation, key))
+
+    def discard(self, record: TransactionRecord):
+        """
+        Leaves the entry of a closed record behind as stale
+        """
+        if record.queued:
+            self._stale += 1
+        record.generation = 0
+        record.queued = False
+
+    def reschedule(self, key: TransactionKey, record: TransactionRecord):
+        """
+        Pushes record again only if its deadline moved earlier than the entry already in the heap
+        """
+        deadline = record.deadline()
+        if deadline < record.scheduled_deadline:
+            self.push(key, record, deadline)
+
+    def pop_due(self, now: int, records: Dict[TransactionKey, TransactionRecord]) -> List[
+            Tuple[TransactionKey, TransactionRecord]]:
+        due: List[Tuple[TransactionKey, TransactionRecord]] = []
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            deadline, generation, key = heapq.heappop(heap)
+            record = records.get(key)
+            if record is None or record.generation != generation:
+                self._stale -= 1
+                continue
+            record.queued = False
+            if not record.is_overdue(now):
+                self.push(key, record)
+                continue
+            due.append((key, record))
+        if self._stale > len(heap) // 2:
+            self.__compact__(records)
+        return due
+
+    def __compact__(self, records: Dict[TransactionKey, TransactionRecord]):
+        self._heap = [(deadline, generation, key) for deadline, generation, key in self._heap
+                      if key in records and records[key].generation == generation]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
 
 
 class LockedDictionary:
     def __init__(self):
-        self._dict: Dict[bytes, TransactionRecord] = {}
+        self._dict: Dict[TransactionKey, TransactionRecord] = {}
+        self._deadlines = DeadlineHeap()
         self._master_lock = threading.Lock()
 
-    def find_repeats_resends_and_fails(self) -> Tuple[
-        List[Tuple[List[int], Tuple[str, int], bytes]], List[Tuple[List[bytes], Tuple[str, int], bytes]], List[bytes]]:
-        repeats: List[Tuple[List[int], Tuple[str, int], bytes]] = []
+    def find_repeats_resends_and_fails(self, is_versioned: Callable[[Tuple[str, int]], bool]) -> Tuple[
+        List[Tuple[bytes, Tuple[str, int], bytes]], List[Tuple[List[bytes], Tuple[str, int], bytes]],
+            List[TransactionKey]]:
+        """
+        is_versioned tells which peers read compact selective repeats, legacy peers are sent the list of indices
+        """
+        repeats: List[Tuple[bytes, Tuple[str, int], bytes]] = []
         resends: List[Tuple[List[bytes], Tuple[str, int], bytes]] = []
-        fails: List[bytes] = []
+        fails: List[TransactionKey] = []
+        now = time.time_ns()
         with self._master_lock:
-            for message_id, transaction_record in self._dict.items():
-                if transaction_record.is_overdue():
-                    if transaction_record.reattempts >= NetworkCommunicationConstants.GIVE_UP_REATTEMPTS:
-                        fails.append(message_id)
-                        BetterLog.log_text(f"Transaction Failed (Surpassed Attempt Maximum): {message_id}")
+            for key, transaction_record in self._deadlines.pop_due(now, self._dict):
+                message_id = key[0]
+                if transaction_record.has_failed(now):
+                    fails.append(key)
+                    BetterLog.log_text("Transaction Failed (Surpassed Attempt Maximum): {}", message_id, level=BetterLog.WARNING)
+                else:
+                    if transaction_record.is_incoming:
+                        communicator = transaction_record.communicator
+                        repeat: Tuple[bytes, Tuple[str, int], bytes] = (
+                            transaction_record.incoming.repeat_request(is_versioned(communicator)), communicator,
+                            message_id)
+                        repeats.append(repeat)
+                        BetterLog.log_debug("Did Not Receive Full Message (Sending Repeat): {}", message_id)
                     else:
-                        if transaction_record.is_incoming:
-                            repeat: Tuple[List[int], Tuple[str, int], bytes] = (
-                                transaction_record.incoming.find_missing(), transaction_record.communicator, message_id)
-                            repeats.append(repeat)
-                            BetterLog.log_text(f"Did Not Receive Full Message (Sending Repeat): {message_id}")
-                        else:
-                            resend: Tuple[List[bytes], Tuple[str, int], bytes] = (
-                                transaction_record.outgoing.bytepackets, transaction_record.communicator, message_id)
-                            resends.append(resend)
-                            BetterLog.log_text(
-                                f"Did Not Receive form of Acknowledgement (Resending Packets): {message_id}")
+                        resend: Tuple[List[bytes], Tuple[str, int], bytes] = (
+                            transaction_record.outgoing.bytepackets, transaction_record.communicator, message_id)
+                        resends.append(resend)
+                        BetterLog.log_debug("Did Not Receive form of Acknowledgement (Resending Packets): {}", message_id)
+                    # Stays due until the caller re-arms it, the next poll then re-pushes the new deadline
+                    self._deadlines.push(key, transaction_record)
                 transaction_record.release()
         return repeats, resends, fails
 
-    def __getitem__(self, key: bytes) -> TransactionRecord | None:
+    def __getitem__(self, key: TransactionKey) -> TransactionRecord | None:
         with self._master_lock:
             if key in self._dict:
                 value = self._dict[key]
@@ -110,100 +270,301 @@ class LockedDictionary:
                 return value
             return None
 
-    def __setitem__(self, key: bytes, value: TransactionRecord):
+    def __setitem__(self, key: TransactionKey, value: TransactionRecord):
         with self._master_lock:
+            if key in self._dict:
+                self._deadlines.discard(self._dict[key])
             self._dict[key] = value
+            self._deadlines.push(key, value)
 
-    def pop(self, key: bytes) -> TransactionRecord | None:
+    def pop(self, key: TransactionKey) -> TransactionRecord | None:
         with self._master_lock:
-            return self._dict.pop(key, None)
-
-    def new_incoming_transaction(self, packet: Packet.Packet, sender: Tuple[str, int]):
-        BetterLog.log_text(f"New Incoming Transaction Created: {packet.header.messageid}")
-        transaction_record = TransactionRecord(True, packet.header.packetcount)
+            record = self._dict.pop(key, None)
+            if record is not None:
+                self._deadlines.discard(record)
+            return record
+
+    def new_incoming_transaction(self, packet: Packet.Packet, sender: Tuple[str, int],
+                                 round_trip: RoundTripEstimator | None = None):
+        BetterLog.log_debug("New Incoming Transaction Created: {}", packet.header.messageid)
+        transaction_record = TransactionRecord(True, packet.header.packetcount, round_trip)
         transaction_record.communicator = sender
         transaction_record.recv_packet(packet)
-        self._dict[packet.header.messageid] = transaction_record
+        key = (packet.header.messageid, sender)
+        self._dict[key] = transaction_record
+        self._deadlines.push(key, transaction_record)
 
-    def new_outgoing_transaction(self, message_id: bytes, bytepackets: List[bytes], recipient: Tuple[str, int]):
-        BetterLog.log_text(f"New Outgoing Transaction Created: {message_id}")
+    def new_outgoing_transaction(self, message_id: bytes, bytepackets: List[bytes], recipient: Tuple[str, int],
+                                 round_trip: RoundTripEstimator | None = None):
+        BetterLog.log_debug("New Outgoing Transaction Created: {}", message_id)
         with self._master_lock:
-            transaction_record = TransactionRecord(False, bytepackets)
+            transaction_record = TransactionRecord(False, bytepackets, round_trip)
             transaction_record.communicator = recipient
-            self._dict[message_id] = transaction_record
-
-    def recv_packet(self, message_id: bytes, packet: Packet.Packet, sender: Tuple[str, int]):
+            key = (message_id, recipient)
+            self._dict[key] = transaction_record
+            self._deadlines.push(key, transaction_record)
+
+    def recv_packet(self, message_id: bytes, packet: Packet.Packet, sender: Tuple[str, int],
+                    progress_interval: int = 0, round_trip: RoundTripEstimator | None = None
+                    ) -> Tuple[Packet.Message | None, int]:
+        """
+        Returns the message once complete, and the received packet count whenever it is due to be reported
+        """
+        key = (message_id, sender)
         with self._master_lock:
-            if message_id in self._dict:
-                record = self._dict[message_id]
-                packetlist = record.recv_packet(packet)
-                record.release()
-                message = Packet.Message.from_packet_list(packetlist, sender)
-                return message
-            else:
-                self.new_incoming_transaction(packet, sender)
-                return None
-
-    def __contains__(self, key: bytes):
+            try:
+                if key in self._dict:
+                    record = self._dict[key]
+                    completed = record.recv_packet(packet)
+                    record.release()
+                    self._deadlines.reschedule(key, record)  # The repeat wait restarts from this packet
+                    if completed:
+                        Metrics.REASSEMBLY_LATENCY.observe(time.time_ns() - record.incoming.started_time, sender)
+                        return record.incoming.to_message(message_id, sender), 0
+                    return None, record.progress(progress_interval)
+                else:
+                    self.new_incoming_transaction(packet, sender, round_trip)
+                    return None, 0
+            except Packet.MessageTooLarge as e:
+                BetterLog.log_incoming("Dropped Message {}: {}", message_id, e, level=BetterLog.WARNING)
+                record = self._dict.pop(key, None)
+                if record is not None:
+                    self._deadlines.discard(record)
+                return None, 0
+
+    def reschedule(self, key: TransactionKey):
+        """
+        Call after a record's deadline may have moved earlier, never while holding the record's lock
+        """
+        with self._master_lock:
+            record = self._dict.get(key)
+            if record is not None:
+                self._deadlines.reschedule(key, record)
+
+    def __contains__(self, key: TransactionKey):
         with self._master_lock:
             return key in self._dict
 
+    def __len__(self) -> int:
+        return len(self._dict)
+
+
+class ShardedDictionary:
+    """
+    Transaction table split into independently locked LockedDictionary shards keyed by (message id, peer), so packets of
+    unrelated messages are reassembled and acknowledged without serializing on a single master lock.
+    Every shard keeps its own retransmit deadlines
+    """
+
+    def __init__(self, shard_count: int):
+        self._shards: List[LockedDictionary] = [LockedDictionary() for _ in range(shard_count)]
+
+    def shard(self, key: TransactionKey) -> LockedDictionary:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def find_repeats_resends_and_fails(self, is_versioned: Callable[[Tuple[str, int]], bool]) -> Tuple[
+        List[Tuple[bytes, Tuple[str, int], bytes]], List[Tuple[List[bytes], Tuple[str, int], bytes]],
+            List[TransactionKey]]:
+        repeats: List[Tuple[bytes, Tuple[str, int], bytes]] = []
+        resends: List[Tuple[List[bytes], Tuple[str, int], bytes]] = []
+        fails: List[TransactionKey] = []
+        for shard in self._shards:
+            shard_repeats, shard_resends, shard_fails = shard.find_repeats_resends_and_fails(is_versioned)
+            repeats.extend(shard_repeats)
+            resends.extend(shard_resends)
+            fails.extend(shard_fails)
+        return repeats, resends, fails
+
+    def __getitem__(self, key: TransactionKey) -> TransactionRecord | None:
+        return self.shard(key)[key]
+
+    def __setitem__(self, key: TransactionKey, value: TransactionRecord):
+        self.shard(key)[key] = value
+
+    def pop(self, key: TransactionKey) -> TransactionRecord | None:
+        return self.shard(key).pop(key)
+
+    def new_outgoing_transaction(self, message_id: bytes, bytepackets: List[bytes], recipient: Tuple[str, int],
+                                 round_trip: RoundTripEstimator | None = None):
+        self.shard((message_id, recipient)).new_outgoing_transaction(message_id, bytepackets, recipient, round_trip)
+
+    def recv_packet(self, message_id: bytes, packet: Packet.Packet, sender: Tuple[str, int],
+                    progress_interval: int = 0, round_trip: RoundTripEstimator | None = None
+                    ) -> Tuple[Packet.Message | None, int]:
+        return self.shard((message_id, sender)).recv_packet(message_id, packet, sender, progress_interval, round_trip)
+
+    def reschedule(self, key: TransactionKey):
+        self.shard(key).reschedule(key)
+
+    def __contains__(self, key: TransactionKey):
+        return key in self.shard(key)
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
 
 class IncomingTransaction:
-    def __init__(self, packet_count: int):
-        self.received: List[None | Packet.Packet] = [None] * packet_count
-        self.selective_repeat_time = create_response_time(
-            NetworkCommunicationConstants.WAIT_TIME_BEFORE_REPEAT_REQUEST_NS)
+    def __init__(self, packet_count: int, round_trip: RoundTripEstimator):
+        # Fragments are written straight into one preallocated buffer at seq * fragment size. The footer can push the
+        # last fragment into a packet of its own, leaving the one before it short, so the payload ends where the
+        # received fragments add up to and the fragment size is only taken from a fragment known to be full
+        self.payload: bytearray | None = None
+        self.fragment_size: int = 0
+        self.payload_length: int = 0
+        self.footer: Packet.Footer | None = None
+        self.held: Dict[int, bytes | memoryview] = {}  # Fragments waiting for the fragment size
+        self.received = PacketBitmap.PacketBitmap(packet_count)
+        self.round_trip = round_trip
+        self.started_time: int = time.time_ns()
+        self.selective_repeat_time = create_response_time(round_trip.repeat_wait())
+
+    def recv_packet(self, packet: Packet.Packet) -> bool:
+        """
+        Copies the fragment into the reassembly buffer, returns False if it was a duplicate
+        """
+        self.selective_repeat_time = create_response_time(self.round_trip.repeat_wait())
+        sequence_number = packet.header.packetsequencenumber
+        if not self.received.set(sequence_number):
+            return False
+        self.payload_length += len(packet.payload)
+        if packet.footer is not None:
+            self.footer = packet.footer
+        if self.payload is None:
+            self.held[sequence_number] = packet.payload
+            fragment_size = self.__fragment_size__()
+            if fragment_size is None:
+                self.held[sequence_number] = bytes(packet.payload)  # The packet's buffer is reused once this returns
+                return True
+            # The packet count is unauthenticated, a message is only ever one short fragment longer than the limit
+            if fragment_size * (self.received.size - 1) > NetworkCommunicationConstants.MAXIMUM_MESSAGE_BYTES:
+                raise Packet.MessageTooLarge(f"{self.received.size} fragments of {fragment_size} bytes is over the "
+                                             f"{NetworkCommunicationConstants.MAXIMUM_MESSAGE_BYTES} byte message limit")
+            self.fragment_size = fragment_size
+            self.payload = bytearray(fragment_size * self.received.size)
+            for held_sequence_number, payload in self.held.items():
+                self.__store__(held_sequence_number, payload)
+            self.held.clear()
+            return True
+        self.__store__(sequence_number, packet.payload)
+        return True
+
+    def __fragment_size__(self) -> int | None:
+        """
+        The fragment size, once a fragment that must be full has arrived. Every fragment before the last two is full,
+        the one before the last is too unless the last carries no payload, and with two fragments it starts at 0
+        """
+        last = self.received.size - 1
+        for sequence_number, payload in self.held.items():
+            if sequence_number < last - 1:
+                return len(payload)
+            if sequence_number == last - 1 and (last == 1 or len(self.held.get(last, b''))):
+                return len(payload)
+        return None
 
-    def recv_packet(self, packet: Packet.Packet):
-        self.received[packet.header.packetsequencenumber] = packet
-        self.selective_repeat_time = create_response_time(
-            NetworkCommunicationConstants.WAIT_TIME_BEFORE_REPEAT_REQUEST_NS)
+    def __store__(self, sequence_number: int, payload: bytes | memoryview):
+        start = sequence_number * self.fragment_size
+        self.payload[start:start + len(payload)] = payload
 
     def is_completed(self) -> bool:
-        return None not in self.received
+        return self.received.is_full()
 
     def find_missing(self) -> List[int]:
-        return [item for item, x in enumerate(self.received) if x is None]
+        return self.received.missing()
+
+    def repeat_request(self, compact: bool = True) -> bytes:
+        """
+        Encodes the missing packets as a selective repeat payload that fits in a single packet of any header version,
+        in the legacy one byte per index form unless compact
+        """
+        if not compact:
+            return PacketBitmap.encode_legacy_selective_repeat(
+                self.received,
+                Packet.Message.max_payload_size(Packet.HEADER_VERSION_1) - Packet.FooterFormat.FOOTER_LENGTH)
+        return PacketBitmap.encode_selective_repeat(
+            self.received,
+            Packet.Message.max_payload_size(Packet.LATEST_HEADER_VERSION) - Packet.FooterFormat.FOOTER_LENGTH)
+
+    def to_message(self, message_id: bytes, sender: Tuple[str, int]) -> Packet.Message:
+        # Trim the unused tail of the last fragment in place rather than copying the payload out
+        del self.payload[self.payload_length:]
+        return Packet.Message(self.payload, self.footer.payloadtype, self.footer.userid, message_id,
+                              self.received.size, self.footer.unixtime, sender=sender)
 
 
 class OutgoingTransaction:
-    def __init__(self, bytepackets: List[bytes]):
-        self.bytepackets: List[bytes | None] = bytepackets
-        self.resend_time = create_response_time(NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
+    def __init__(self, bytepackets: List[bytes], round_trip: RoundTripEstimator):
+        self.bytepackets: List[bytes] = bytepackets
+        self.round_trip = round_trip
+        self.sent_time: int = time.time_ns()
+        self.retransmitted: bool = False  # Karn's rule, the acknowledgement of a retransmission is never sampled
+        self.resend_time = self.sent_time + round_trip.resend_timeout()
 
-    def handle_selective_repeat(self, repeats: List[int]) -> List[bytes | None]:
-        # Run through the repeat and 'remove' items that were not asked for
-        for i in range(len(self.bytepackets)):
-            if i not in repeats:
-                self.bytepackets[i] = None
-        self.resend_time = create_response_time(NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
-        return self.bytepackets
+    def handle_selective_repeat(self, repeats: List[int]) -> List[bytes]:
+        # Look the requested packets up directly, the full list is kept intact for a later timeout resend
+        self.retransmitted = True
+        self.resend_time = create_response_time(self.round_trip.resend_timeout())
+        count = len(self.bytepackets)
+        return [self.bytepackets[i] for i in repeats if i < count]
 
 
 class TransactionHandler:
-    def __init__(self, outgoing_queue: asyncio.queues.Queue, outgoing_loop: asyncio.AbstractEventLoop, user_id: int):
-        self.active = LockedDictionary()
-        self.outgoing_queue = outgoing_queue
-        self.outgoing_loop = outgoing_loop
+    def __init__(self, send_packets: Callable[[List[bytes], Tuple[str, int]], None], user_id: int,
+                 shard_count: int = NetworkCommunicationConstants.TRANSACTION_SHARD_COUNT,
+                 schedule: Callable[[float, Callable[[], None]], None] | None = None):
+        """
+        schedule(delay_s, callback) runs callback later on the owner's loop, without it nothing is delayed
+        """
+        self.active = ShardedDictionary(shard_count)
+        self.send_packets = send_packets
+        self.schedule = schedule
+        self.acknowledgements = PendingAcknowledgements()
+        self.peers = PeerTable()
         self.USER_ID = user_id
         self.completed = CompletedMessages(NetworkCommunicationConstants.COMPLETED_MESSAGE_BUFFER_SIZE)
 
-    def send_packet(self, packet: bytes, recipient: Tuple[str, int]):
-        asyncio.run_coroutine_threadsafe(self.outgoing_queue.put((packet, recipient)), self.outgoing_loop)
+    def track_metrics(self, label: str):
+        """
+        Reports this handler's open transactions under label and its peers' round trips to the metrics registry
+        """
+        Metrics.ACTIVE_TRANSACTIONS.track(self, lambda: {label: len(self.active)})
+        Metrics.ROUND_TRIP.track(self, lambda: {Metrics.peer_label(peer): state.round_trip.smoothed_ns
+                                                for peer, state in self.peers})
+
+    def untrack_metrics(self):
+        Metrics.ACTIVE_TRANSACTIONS.untrack(self)
+        Metrics.ROUND_TRIP.untrack(self)
 
     def receive_packet_internal(self, packet: Packet.Packet, sender: Tuple[str, int]) -> Packet.Message | None:
         message_id = packet.header.messageid
 
-        if message_id in self.completed:  # Packet relates to an already completed transaction
-            BetterLog.log_text(f"Packet Received Relating to Completed Message {message_id}")
+        if (message_id, sender) in self.completed:  # Packet relates to an already completed transaction
+            BetterLog.log_debug("Packet Received Relating to Completed Message {}", message_id)
             return None
         BetterLog.log_packet_received(packet)
         if packet.header.packetcount == 1:  # Automatically create a message and return it if the message only has one packet
             message = Packet.Message.from_packet_list([packet], sender)
             return message
 
-        return self.active.recv_packet(message_id, packet, sender)
+        peer = self.peers.get(sender)
+        interval = NetworkCommunicationConstants.FLOW_PROGRESS_INTERVAL_PACKETS if peer.reports_progress() else 0
+        message, received = self.active.recv_packet(message_id, packet, sender, interval, peer.round_trip)
+        if received:
+            self.send_progress(message_id, received, sender)
+        return message
+
+    def receive_raw_packet(self, raw_packet: bytes, sender: Tuple[str, int]) -> Packet.Message | None:
+        Metrics.PACKETS_RECEIVED.inc(sender)
+        # Peek at the header first so duplicates of completed messages are dropped before decoding anything else
+        versioned = self.peers.is_versioned(sender)
+        if versioned:
+            version = Packet.PacketCodec.version_of(raw_packet, versioned)
+            if version != Packet.HEADER_VERSION_1:
+                self.peers.get(sender).confirm_header_version(version)
+        message_id = Packet.PacketCodec.peek_messageid(raw_packet, versioned)
+        if (message_id, sender) in self.completed:
+            BetterLog.log_debug("Packet Received Relating to Completed Message {}", message_id)
+            return None
+        return self.receive_packet(Packet.Packet.from_bytes(raw_packet, versioned), sender)
 
     def receive_packet(self, packet: Packet.Packet, sender: Tuple[str, int]) -> Packet.Message | None:
         possible_message = self.receive_packet_internal(packet, sender)
@@ -212,83 +573,275 @@ class TransactionHandler:
             return None
 
         BetterLog.log_message_received(possible_message)
+        Metrics.MESSAGES_RECEIVED.inc(sender)
         msg_type = possible_message.payloadtype
 
         if msg_type == Packet.PayloadType.ACKNOWLEDGE:
-            self.force_close(possible_message.messageid)
+            self.recv_acknowledgements(possible_message.messageid, possible_message.payload, sender)
             return None
 
         if msg_type == Packet.PayloadType.SELECTIVE_REPEAT:
-            packets = self.recv_selective_repeat(possible_message.messageid, list(possible_message.payload))
-            if packets is not None:
-                for p in packets:
-                    if p is not None:
-                        self.send_packet(p, sender)
+            Metrics.SELECTIVE_REPEATS_RECEIVED.inc(sender)
+            repeats = PacketBitmap.decode_selective_repeat(possible_message.payload)
+            packets = self.recv_selective_repeat(possible_message.messageid, repeats, sender)
+            if packets:
+                peer = self.peers.find(sender)
+                if peer is not None and peer.window is not None and possible_message.messageid in peer.window:
+                    packets = peer.window.lost(possible_message.messageid, repeats)
+                Metrics.PACKETS_RETRANSMITTED.inc(sender, len(packets))
+                self.__send_released__(packets, sender)
 
             return None
 
-        message = Packet.Message(b'', Packet.PayloadType.ACKNOWLEDGE, self.USER_ID, messageid=possible_message.messageid)
-        pkts = message.to_packet_list()
-        for packet in pkts:
-            self.send_packet(packet.to_bytes(), sender)
-        self.force_close(message_id=possible_message.messageid)
+        if msg_type == Packet.PayloadType.PROGRESS:
+            self.recv_progress(possible_message.messageid, int.from_bytes(possible_message.payload, byteorder='big'),
+                               sender)
+            return None
+
+        self.acknowledge(possible_message.messageid, sender)
+        if msg_type == Packet.PayloadType.PROBE:  # Only the acknowledgement matters to the prober
+            return None
         return possible_message
 
+    def prepare_message(self, message: Packet.Message, recipient: Tuple[str, int], should_track: bool = True) -> List[bytes]:
+        """
+        Packetizes message for recipient's negotiated header version and, if tracked, opens its outgoing transaction
+        before any packet is handed out so an early acknowledgement always finds it
+        """
+        peer = self.peers.find(recipient)
+        if peer is None:
+            bytepackets = message.to_bytes_list()
+        else:
+            bytepackets = message.to_bytes_list(peer.header_version, peer.datagram_size)
+        return self.__track__(message.messageid, bytepackets, recipient, peer, should_track)
+
+    def prepare_shared(self, message: Packet.Message, recipients: List[Tuple[str, int]],
+                       should_track: bool = True) -> List[Tuple[bytes, Tuple[str, int]]]:
+        """
+        Packetizes message once per distinct header version and datagram size among recipients, every recipient is
+        sent the very same packets and only the transactions are opened per recipient
+        """
+        packetized: Dict[Tuple[int, int] | None, List[bytes]] = {}
+        batch: List[Tuple[bytes, Tuple[str, int]]] = []
+        for recipient in recipients:
+            peer = self.peers.find(recipient)
+            layout = None if peer is None else (peer.header_version, peer.datagram_size)
+            if layout not in packetized:
+                packetized[layout] = message.to_bytes_list() if layout is None else message.to_bytes_list(*layout)
+            bytepackets = self.__track__(message.messageid, packetized[layout], recipient, peer, should_track)
+            batch.extend((bytepacket, recipient) for bytepacket in bytepackets)
+        return batch
+
+    def __track__(self, message_id: bytes, bytepackets: List[bytes], recipient: Tuple[str, int],
+                  peer: PeerState | None, should_track: bool) -> List[bytes]:
+        Metrics.MESSAGES_SENT.inc(recipient)
+        if should_track:
+            self.sent_message(message_id, bytepackets, recipient)
+            if peer is not None and peer.window is not None:  # Only what the congestion window allows leaves now
+                return peer.window.submit(message_id, bytepackets)
+        return bytepackets
+
+    def probe_datagram_size(self, recipient: Tuple[str, int]):
+        """
+        Sends one padded PROBE per candidate size, each acknowledged probe raises the peer's datagram size
+        """
+        peer = self.peers.get(recipient)
+        for size in peer.probe_sizes():
+            padding = size - Packet.PacketCodec.packed_size(0, True, peer.header_version)
+            message = Packet.Message(bytes(padding), Packet.PayloadType.PROBE, self.USER_ID)
+            peer.probes[message.messageid] = size
+            self.send_packets(message.to_bytes_list(peer.header_version, size), recipient)
+
+    def acknowledge(self, message_id: bytes, recipient: Tuple[str, int]):
+        """
+        Closes a completed message and acknowledges it, together with others to the same peer when it agreed to that
+        """
+        self.force_close(message_id, recipient)
+        peer = self.peers.find(recipient)
+        if self.schedule is None or peer is None or not peer.aggregates_acknowledgements():
+            self.__send_acknowledgement__([message_id], recipient)
+            return
+        full, started = self.acknowledgements.add(recipient, message_id, peer.acknowledgements_per_datagram())
+        if full is not None:
+            self.__send_acknowledgement__(full, recipient)
+        elif started:
+            self.schedule(NetworkCommunicationConstants.ACK_DELAY_S, self.flush_acknowledgements)
+
+    def flush_acknowledgements(self):
+        for recipient, message_ids in self.acknowledgements.drain():
+            self.__send_acknowledgement__(message_ids, recipient)
+
+    def __send_acknowledgement__(self, message_ids: List[bytes], recipient: Tuple[str, int]):
+        # The first id rides in the header like a legacy acknowledgement, any others follow as the payload
+        message = Packet.Message(b''.join(message_ids[1:]), Packet.PayloadType.ACKNOWLEDGE, self.USER_ID,
+                                 messageid=message_ids[0])
+        peer = self.peers.find(recipient)
+        if peer is None:
+            self.send_packets(message.to_bytes_list(), recipient)
+        else:
+            self.send_packets(message.to_bytes_list(peer.header_version, peer.datagram_size), recipient)
+
+    def recv_acknowledgements(self, message_id: bytes, payload: bytes, sender: Tuple[str, int]):
+        """
+        Closes every transaction an acknowledgement lists, releasing the window once for all of them
+        """
+        length = Packet.Header.MESSAGE_ID.length
+        message_ids = [message_id] + [bytes(payload[i:i + length]) for i in range(0, len(payload) - length + 1, length)]
+        peer = self.peers.find(sender)
+        released: List[bytes] = []
+        for acknowledged_id in message_ids:
+            self.recv_acknowledgement(acknowledged_id, sender)
+            if peer is not None:
+                peer.acknowledged(acknowledged_id)
+                if peer.window is not None:
+                    released.extend(peer.window.acknowledged(acknowledged_id))
+            self.force_close(acknowledged_id, sender)
+        self.__send_released__(released, sender)
+
     def sent_message(self, message_id: bytes, bytepackets: List[bytes], recipient: Tuple[str, int]):
-        self.active.new_outgoing_transaction(message_id, bytepackets, recipient)
+        self.active.new_outgoing_transaction(message_id, bytepackets, recipient, self.peers.get(recipient).round_trip)
+
+    def recv_acknowledgement(self, message_id: bytes, sender: Tuple[str, int]):
+        """
+        Samples the peer's round trip from a message that went out exactly once, timed from its last packet
+        """
+        transaction_record = self.active[(message_id, sender)]
+        if transaction_record is None:
+            return
+        if not transaction_record.is_incoming and not transaction_record.outgoing.retransmitted:
+            sent_time = transaction_record.outgoing.sent_time
+            peer = self.peers.find(sender)
+            if peer is not None:
+                if peer.window is not None:
+                    sent_time = max(sent_time, peer.window.released_at(message_id))
+                peer.sample_round_trip(time.time_ns() - sent_time)
+        transaction_record.release()
 
-    def force_close(self, message_id: bytes) -> bool:
-        self.completed.add(message_id)
-        BetterLog.log_text(f"Closed Message: {message_id}")
-        return bool(self.active.pop(message_id))
+    def peer_statistics(self) -> Dict[Tuple[str, int], Dict[str, int | float | None]]:
+        """
+        Round trip, timeout, datagram size and congestion window of every known peer, for monitoring
+        """
+        return {peer: state.statistics() for peer, state in self.peers}
+
+    def force_close(self, message_id: bytes, peer_address: Tuple[str, int]) -> bool:
+        self.completed.add((message_id, peer_address))
+        BetterLog.log_debug("Closed Message: {}", message_id)
+        record = self.active.pop((message_id, peer_address))
+        if record is not None and not record.is_incoming:
+            peer = self.peers.find(peer_address)
+            if peer is not None and peer.window is not None:
+                peer.window.forget(message_id)
+        return bool(record)
+
+    def send_progress(self, message_id: bytes, received: int, recipient: Tuple[str, int]):
+        message = Packet.Message(received.to_bytes(length=4, byteorder='big'), Packet.PayloadType.PROGRESS,
+                                 self.USER_ID, messageid=message_id)
+        self.send_packets(message.to_bytes_list(self.peers.header_version(recipient)), recipient)
+
+    def recv_progress(self, message_id: bytes, received: int, sender: Tuple[str, int]):
+        """
+        The receiver is still making progress on message_id, so hold off its resend and move the window along
+        """
+        transaction_record = self.active[(message_id, sender)]
+        if transaction_record is None:
+            return
+        transaction_record.progressed()
+        transaction_record.release()
+        self.active.reschedule((message_id, sender))
+        peer = self.peers.find(sender)
+        if peer is not None and peer.window is not None:
+            self.__send_released__(peer.window.progress(message_id, received), sender)
+
+    def __send_released__(self, packets: List[bytes], recipient: Tuple[str, int]):
+        if packets:
+            self.send_packets(packets, recipient)
 
     def poll_ongoing(self) -> Tuple[
-        List[Tuple[List[int], Tuple[str, int], bytes]], List[Tuple[List[bytes], Tuple[str, int], bytes]], List[bytes]]:
-        return self.active.find_repeats_resends_and_fails()
+        List[Tuple[bytes, Tuple[str, int], bytes]], List[Tuple[List[bytes], Tuple[str, int], bytes]],
+            List[TransactionKey]]:
+        return self.active.find_repeats_resends_and_fails(self.peers.is_versioned)
 
-    def fix_ongoing(self) -> List[bytes]:
+    def fix_ongoing(self) -> List[TransactionKey]:
         repeats, resends, fails = self.poll_ongoing()
 
-        for fail in fails:
-            self.force_close(fail)
+        for message_id, peer_address in fails:
+            Metrics.TRANSACTIONS_FAILED.inc(peer_address)
+            self.force_close(message_id, peer_address)
 
         for resend in resends:
             packets, recipient, message_id = resend
-            for packet in packets:
-                if packet is not None:
-                    self.send_packet(packet, recipient)
-            self.resent(message_id)
+            peer = self.peers.find(recipient)
+            if peer is not None and peer.window is not None and message_id in peer.window:
+                # Still queued behind the window, nothing was lost yet. Unless what it did release has gone a whole
+                # timeout unanswered, then the window is full of lost packets and would otherwise hold it forever
+                released_at = peer.window.released_at(message_id)
+                if peer.window.has_pending(message_id) and \
+                        (not released_at or time.time_ns() - released_at < peer.round_trip.resend_timeout()):
+                    self.held(message_id, recipient)
+                    continue
+                # Only the last packet goes out again, the receiver answers with a selective repeat of exactly what
+                # is missing instead of the window filling up with packets it already holds
+                packets = peer.window.lost(message_id, (len(packets) - 1,))
+            Metrics.PACKETS_RETRANSMITTED.inc(recipient, len(packets))
+            self.__send_released__(packets, recipient)
+            if self.resent(message_id, recipient) > 1 and peer is not None:  # Twice unanswered, the datagram size may be too large
+                peer.datagram_lost()
 
         for repeat in repeats:
-            repeat_list, recipient, message_id = repeat
-            message = Packet.Message(bytes(repeat_list), Packet.PayloadType.SELECTIVE_REPEAT, self.USER_ID,
+            repeat_payload, recipient, message_id = repeat
+            message = Packet.Message(repeat_payload, Packet.PayloadType.SELECTIVE_REPEAT, self.USER_ID,
                                      messageid=message_id)
-            pkts = message.to_packet_list()
-            for packet in pkts:
-                self.send_packet(packet.to_bytes(), recipient)
-            self.sent_repeat(message_id)
+            self.send_packets(message.to_bytes_list(self.peers.header_version(recipient)), recipient)
+            Metrics.SELECTIVE_REPEATS_SENT.inc(recipient)
+            self.sent_repeat(message_id, recipient)
+
+        for recipient, peer in self.peers:  # Pacing tick, releases whatever the window held back
+            if peer.window is not None and len(peer.window):
+                self.__send_released__(peer.window.release(), recipient)
 
         return fails
 
-    def resent(self, message_id: bytes):
-        transaction_record = self.active[message_id]
+    def resent(self, message_id: bytes, recipient: Tuple[str, int]) -> int:
+        """
+        Re-arms the resend with backoff, returns how many attempts in a row went unanswered
+        """
+        transaction_record = self.active[(message_id, recipient)]
         if transaction_record is None:
-            return
+            return 0
         transaction_record.resent()
         transaction_record.release()
+        return transaction_record.reattempts
+
+    def progressed(self, message_id: bytes, recipient: Tuple[str, int]):
+        transaction_record = self.active[(message_id, recipient)]
+        if transaction_record is None:
+            return
+        transaction_record.progressed()
+        transaction_record.release()
+        self.active.reschedule((message_id, recipient))
+
+    def held(self, message_id: bytes, recipient: Tuple[str, int]):
+        transaction_record = self.active[(message_id, recipient)]
+        if transaction_record is None:
+            return
+        transaction_record.held()
+        transaction_record.release()
+        self.active.reschedule((message_id, recipient))
 
-    def sent_repeat(self, message_id: bytes):
-        transaction_record = self.active[message_id]
+    def sent_repeat(self, message_id: bytes, sender: Tuple[str, int]):
+        transaction_record = self.active[(message_id, sender)]
         if transaction_record is None:
             return
         transaction_record.sent_repeat()
         transaction_record.release()
 
-    def recv_selective_repeat(self, message_id: bytes, repeats: List[int]) -> List[bytes | None] | None:
-        transaction_record = self.active[message_id]
+    def recv_selective_repeat(self, message_id: bytes, repeats: List[int],
+                              sender: Tuple[str, int]) -> List[bytes] | None:
+        transaction_record = self.active[(message_id, sender)]
         if transaction_record is None:
             return None
         repeats = transaction_record.outgoing.handle_selective_repeat(repeats)
-        transaction_record.reattempts = 0
+        transaction_record.heard_from()
         transaction_record.release()
+        self.active.reschedule((message_id, sender))
         return repeats
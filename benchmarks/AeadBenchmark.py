@@ -0,0 +1,58 @@
+"""
+Micro-benchmark comparing CryptWrapper's random nonce AES GCM with the counter nonce SessionCipher, its batch API and
+chunked AEAD.
+
+Run from the repository root:
+    python benchmarks/AeadBenchmark.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from CryptWrapper import CryptWrapper, SessionCipher
+
+ITERATIONS = 20_000
+LARGE_ITERATIONS = 50
+BATCH_SIZE = 64
+
+
+def run(iterations: int = ITERATIONS, large_iterations: int = LARGE_ITERATIONS) -> dict:
+    """
+    Returns the per-operation time (ns) of every case keyed by name, batch cases are per message
+    """
+    aesgcm = AESGCM(AESGCM.generate_key(bit_length=256))
+    cipher = SessionCipher(aesgcm, True)
+    small = os.urandom(512)
+    large = os.urandom(4 * 1024 * 1024)
+    batch = [small] * BATCH_SIZE
+    frame = cipher.encrypt(small)
+    frames = cipher.encrypt_batch(batch)
+    buffer = bytearray(SessionCipher.frame_length(len(small)))
+    output = bytearray(len(small))
+    large_frame = cipher.encrypt(large)
+    large_chunked = cipher.encrypt_chunked(large)
+
+    cases = {
+        'encrypt_random_nonce': (lambda: CryptWrapper.encrypt(aesgcm, small), iterations, 1),
+        'encrypt_counter_nonce': (lambda: cipher.encrypt(small), iterations, 1),
+        'encrypt_into': (lambda: cipher.encrypt_into(small, buffer), iterations, 1),
+        'encrypt_batch': (lambda: cipher.encrypt_batch(batch), iterations // BATCH_SIZE, BATCH_SIZE),
+        'decrypt_wrapper': (lambda: CryptWrapper.decrypt(aesgcm, bytes(frame)), iterations, 1),
+        'decrypt_into': (lambda: cipher.decrypt_into(frame, output), iterations, 1),
+        'decrypt_batch': (lambda: cipher.decrypt_batch(frames), iterations // BATCH_SIZE, BATCH_SIZE),
+        'encrypt_4MiB_single': (lambda: cipher.encrypt(large), large_iterations, 1),
+        'encrypt_4MiB_chunked': (lambda: cipher.encrypt_chunked(large), large_iterations, 1),
+        'decrypt_4MiB_single': (lambda: cipher.decrypt(large_frame), large_iterations, 1),
+        'decrypt_4MiB_chunked': (lambda: cipher.decrypt_chunked(large_chunked), large_iterations, 1),
+    }
+    return {name: timeit.timeit(case, number=number) / (number * per_call) * 1e9
+            for name, (case, number, per_call) in cases.items()}
+
+
+if __name__ == '__main__':
+    for name, ns in run().items():
+        print(f"{name:<28}{ns:>14.1f} ns/op")
@@ -0,0 +1,133 @@
+"""
+End-to-end load generator: N clients connect to a Server over 127.0.0.1 UDP and each sends a burst of chat messages,
+which the server broadcasts to every client. Reports sent and delivered messages/s, p50/p99 delivery latency from send
+to receipt at every client, the CPU time spent, and the retransmissions and failed transactions it took, for either
+engine. Each message counts once per client, duplicates are reported apart.
+
+Everything runs in one fresh interpreter per case, so the server, clients and their threads never leak into the caller.
+
+Run from the repository root:
+    python benchmarks/LoadBenchmark.py
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CASES = ((1, 200), (4, 100), (16, 25))  # CLIENTS, MESSAGES PER CLIENT
+PORT = 9801
+CONNECT_TIMEOUT_S = 10
+DELIVERY_TIMEOUT_S = 30
+SETTLE_S = 0.5
+
+
+def percentile(ordered: list, fraction: float) -> float | None:
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else None
+
+
+def measure(clients: int, messages: int, single_loop: bool, port: int = PORT) -> dict:
+    """
+    Runs one case in this interpreter, which is left with the server's and clients' threads running
+    """
+    import Client
+    import Metrics
+    import Server
+
+    latencies_ns = []
+    seen = set()
+    duplicates = 0
+    lock = threading.Lock()
+    delivered = threading.Event()
+    expected = clients * messages * clients
+
+    class LoadClient(Client.Client):
+        def show_chat(self, payload: bytes, user_id: int):
+            nonlocal duplicates
+            received = time.perf_counter_ns()
+            index, seq, sent = bytes(payload).split(b':')
+            with lock:
+                if (self.user_id, index, seq) in seen:  # Counted apart, so they never make up for a lost message
+                    duplicates += 1
+                    return
+                seen.add((self.user_id, index, seq))
+                latencies_ns.append(received - int(sent))
+                if len(latencies_ns) >= expected:
+                    delivered.set()
+
+    server = Server.Server(port=port, single_loop=single_loop)
+    load_clients = [LoadClient('127.0.0.1', index + 1, port=port, single_loop=single_loop, local_port=0)
+                    for index in range(clients)]
+    deadline = time.time() + CONNECT_TIMEOUT_S
+    while not all(client.encryption_handler.is_prepared() for client in load_clients) and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(SETTLE_S)  # Group keys follow PREPARED
+
+    cpu = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    for seq in range(messages):
+        for index, client in enumerate(load_clients):
+            client.send(f"{index}:{seq}:{time.perf_counter_ns()}")
+    sent_s = time.perf_counter() - started
+    delivered.wait(DELIVERY_TIMEOUT_S)
+    elapsed_s = time.perf_counter() - started
+    cpu_after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_s = (cpu_after.ru_utime - cpu.ru_utime) + (cpu_after.ru_stime - cpu.ru_stime)
+
+    server.handshakes.shutdown(wait=True)  # Worker processes hold the output pipe open until they exit
+    with lock:
+        ordered = sorted(latencies_ns)
+    return {
+        'engine': 'async' if single_loop else 'threaded',
+        'clients': clients,
+        'messages_sent': clients * messages,
+        'deliveries_expected': expected,
+        'deliveries': len(ordered),
+        'duplicates': duplicates,
+        'sent_per_s': clients * messages / sent_s,
+        'delivered_per_s': len(ordered) / elapsed_s,
+        'latency_p50_ms': None if not ordered else percentile(ordered, 0.50) / 1e6,
+        'latency_p99_ms': None if not ordered else percentile(ordered, 0.99) / 1e6,
+        'cpu_s': cpu_s,
+        'cpu_percent': 100 * cpu_s / elapsed_s,
+        'packets_sent': Metrics.PACKETS_SENT.total,
+        'packets_retransmitted': Metrics.PACKETS_RETRANSMITTED.total,
+        'transactions_failed': Metrics.TRANSACTIONS_FAILED.total,
+    }
+
+
+def run_case(clients: int, messages: int, single_loop: bool, port: int = PORT) -> dict:
+    """
+    Runs one case in a fresh interpreter and returns its results
+    """
+    output = subprocess.run([sys.executable, '-W', 'ignore', os.path.abspath(__file__), '--case', str(clients),
+                             str(messages), str(int(single_loop)), str(port)], cwd=ROOT, capture_output=True,
+                            text=True, timeout=CONNECT_TIMEOUT_S + DELIVERY_TIMEOUT_S + 30,
+                            stdin=subprocess.DEVNULL).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(cases=CASES) -> list:
+    results = []
+    for single_loop in (False, True):
+        for offset, (clients, messages) in enumerate(cases):
+            results.append(run_case(clients, messages, single_loop, PORT + 2 * offset + int(single_loop)))
+    return results
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == '--case':
+        result = measure(int(sys.argv[2]), int(sys.argv[3]), bool(int(sys.argv[4])), int(sys.argv[5]))
+        print(json.dumps(result), flush=True)
+        os._exit(0)  # Server, client and pool threads would otherwise keep the interpreter alive
+    for result in run():
+        print(f"{result['engine']:<10}clients={result['clients']:<4}{result['delivered_per_s']:>10.0f} delivered/s"
+              f"{result['latency_p50_ms'] or 0:>10.2f} ms p50{result['latency_p99_ms'] or 0:>10.2f} ms p99"
+              f"{result['cpu_percent']:>8.0f}% cpu  {result['deliveries']}/{result['deliveries_expected']}"
+              f"{result['duplicates']:>6} dup"
+              f"{result['packets_retransmitted']:>8} resent{result['transactions_failed']:>6} failed")
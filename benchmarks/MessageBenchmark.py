@@ -0,0 +1,45 @@
+"""
+Micro-benchmark for fragmenting and reassembling whole messages: Message.to_packet_list, to_bytes_list and
+from_packet_list, for a single packet chat message and a large multi-packet one.
+
+Run from the repository root:
+    python benchmarks/MessageBenchmark.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Packet
+from Packet import PayloadType
+
+ITERATIONS = 20_000
+LARGE_ITERATIONS = 200
+LARGE_PAYLOAD_BYTES = 256 * 1024
+
+
+def run(iterations: int = ITERATIONS, large_iterations: int = LARGE_ITERATIONS) -> dict:
+    """
+    Returns the per-message time (ns) of every case keyed by name
+    """
+    small = Packet.Message(os.urandom(200), PayloadType.CHAT, 1)
+    large = Packet.Message(os.urandom(LARGE_PAYLOAD_BYTES), PayloadType.CHAT, 1)
+    latest = Packet.LATEST_HEADER_VERSION
+    small_packets = small.to_packet_list()
+    large_packets = large.to_packet_list(latest)
+
+    cases = {
+        'to_packet_list_small': (lambda: small.to_packet_list(), iterations),
+        'to_bytes_list_small': (lambda: small.to_bytes_list(), iterations),
+        'from_packet_list_small': (lambda: Packet.Message.from_packet_list(small_packets), iterations),
+        'to_packet_list_256KiB': (lambda: large.to_packet_list(latest), large_iterations),
+        'to_bytes_list_256KiB': (lambda: large.to_bytes_list(latest), large_iterations),
+        'from_packet_list_256KiB': (lambda: Packet.Message.from_packet_list(large_packets), large_iterations),
+    }
+    return {name: timeit.timeit(case, number=number) / number * 1e9 for name, (case, number) in cases.items()}
+
+
+if __name__ == '__main__':
+    for name, ns in run().items():
+        print(f"{name:<28}{ns:>14.1f} ns/op")
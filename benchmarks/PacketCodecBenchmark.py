@@ -0,0 +1,86 @@
+"""
+Micro-benchmark comparing the struct based PacketCodec with the previous field-by-field header / footer codec.
+
+Run from the repository root:
+    python benchmarks/PacketCodecBenchmark.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Packet
+from Packet import Footer, FooterFormat, Header, HeaderFormat, PacketCodec, PayloadType
+
+ITERATIONS = 100_000
+
+
+def legacy_header_to_bytes(header: Header) -> bytes:
+    arr = bytearray(b'\x00' * HeaderFormat.HEADER_LENGTH)
+    Header.MESSAGE_ID.set_to(arr, bytearray(header.messageid))
+    Header.PACKET_COUNT.set_to(arr, bytearray(header.packetcount.to_bytes(length=Header.PACKET_COUNT.length,
+                                                                          byteorder='big')))
+    Header.PACKET_SEQUENCE_NUMBER.set_to(arr, bytearray(
+        header.packetsequencenumber.to_bytes(length=Header.PACKET_SEQUENCE_NUMBER.length, byteorder='big')))
+    return bytes(arr)
+
+
+def legacy_header_from_bytes(raw: bytes) -> Header:
+    arr = bytearray(raw)
+    return Header(bytes(Header.MESSAGE_ID.get_from(arr)),
+                  int.from_bytes(bytes(Header.PACKET_COUNT.get_from(arr)), byteorder='big'),
+                  int.from_bytes(bytes(Header.PACKET_SEQUENCE_NUMBER.get_from(arr)), byteorder='big'))
+
+
+def legacy_footer_to_bytes(footer: Footer) -> bytes:
+    arr = bytearray(b'\x00' * FooterFormat.FOOTER_LENGTH)
+    Footer.PAYLOAD_TYPE.set_to(arr, bytearray(footer.payloadtype.to_bytes()))
+    Footer.USER_ID.set_to(arr, bytearray(footer.userid.to_bytes(length=Footer.USER_ID.length, byteorder='big')))
+    Footer.UNIX_TIME.set_to(arr, bytearray(footer.unixtime.to_bytes(length=Footer.UNIX_TIME.length,
+                                                                     byteorder='big')))
+    return bytes(arr)
+
+
+def legacy_footer_from_bytes(raw: bytes) -> Footer:
+    arr = bytearray(raw)
+    return Footer(PayloadType.from_bytes(bytes(Footer.PAYLOAD_TYPE.get_from(arr))),
+                  int.from_bytes(bytes(Footer.USER_ID.get_from(arr)), byteorder='big'),
+                  int.from_bytes(bytes(Footer.UNIX_TIME.get_from(arr)), byteorder='big'))
+
+
+def legacy_packet_to_bytes(packet: Packet.Packet) -> bytes:
+    return legacy_header_to_bytes(packet.header) + packet.payload + legacy_footer_to_bytes(packet.footer)
+
+
+def legacy_packet_from_bytes(raw: bytes) -> Packet.Packet:
+    header = legacy_header_from_bytes(raw[:HeaderFormat.HEADER_LENGTH])
+    footerstart = len(raw) - FooterFormat.FOOTER_LENGTH
+    return Packet.Packet(header, raw[HeaderFormat.HEADER_LENGTH:footerstart],
+                         legacy_footer_from_bytes(raw[footerstart:]))
+
+
+def run(iterations: int = ITERATIONS) -> dict:
+    """
+    Returns the per-operation time (ns) of every case keyed by name
+    """
+    payload = os.urandom(Packet.Message.max_payload_size(Packet.HEADER_VERSION_1) - FooterFormat.FOOTER_LENGTH)
+    packet = Packet.Packet(Header(b'\x01\x02\x03', 1, 0), payload, Footer(PayloadType.CHAT, 1234, 1_700_000_000))
+    raw = packet.to_bytes()
+    assert raw == legacy_packet_to_bytes(packet)
+    send_buffer = bytearray(packet.size())
+
+    cases = {
+        'encode_legacy': lambda: legacy_packet_to_bytes(packet),
+        'encode_struct': packet.to_bytes,
+        'encode_struct_pack_into': lambda: packet.pack_into(send_buffer),
+        'decode_legacy': lambda: legacy_packet_from_bytes(raw),
+        'decode_struct': lambda: Packet.Packet.from_bytes(raw),
+        'peek_messageid': lambda: PacketCodec.peek_messageid(raw),
+    }
+    return {name: timeit.timeit(case, number=iterations) / iterations * 1e9 for name, case in cases.items()}
+
+
+if __name__ == '__main__':
+    for name, ns in run().items():
+        print(f"{name:<28}{ns:>10.1f} ns/op")
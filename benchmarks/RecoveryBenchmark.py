@@ -0,0 +1,105 @@
+"""
+Recovery benchmark: one handler sends a large message to another over 127.0.0.1 UDP with a NetworkImpairment in front
+of each socket, so the retransmit, selective repeat and give up paths of TransactionHandler.fix_ongoing actually run.
+Reports the time until the message is delivered, beyond a run with the same delay but no loss, and the extra bytes and
+packets the sender spent. settled_ms runs until the sender has nothing left in flight, which includes giving up when
+every acknowledgement was lost.
+
+Impairment decisions come from fixed seeds, so every profile drops, duplicates and reorders the same datagrams of the
+same send sequence on every run; retransmission timing still follows the clock.
+
+Run from the repository root:
+    python benchmarks/RecoveryBenchmark.py
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import AsyncNetworkHandler
+import Metrics
+import Packet
+from Capabilities import Capabilities
+from NetworkImpairment import NetworkImpairment
+from Packet import PayloadType
+
+BASELINE = 'delay'
+PROFILES = {
+    BASELINE: {'delay_s': 0.005, 'jitter_s': 0.001},
+    'loss_1': {'delay_s': 0.005, 'jitter_s': 0.001, 'loss': 0.01},
+    'loss_5': {'delay_s': 0.005, 'jitter_s': 0.001, 'loss': 0.05},
+    'loss_10': {'delay_s': 0.005, 'jitter_s': 0.001, 'loss': 0.10},
+    'loss_20': {'delay_s': 0.005, 'jitter_s': 0.001, 'loss': 0.20},
+    'reorder_duplicate': {'delay_s': 0.005, 'jitter_s': 0.001, 'reorder': 0.05, 'duplicate': 0.05},
+    'bandwidth_8MBps': {'delay_s': 0.005, 'jitter_s': 0.001, 'loss': 0.01, 'bandwidth_bytes_per_s': 8_000_000},
+}
+''' Impairment applied in both directions, every profile is measured against BASELINE '''
+PAYLOAD_BYTES = 256 * 1024
+SEED = 25
+PORT = 9851
+TIMEOUT_S = 30
+
+
+def measure(impairment: dict, port: int = PORT, seed: int = SEED, payload_bytes: int = PAYLOAD_BYTES) -> dict:
+    """
+    Sends one message from port to port + 1 and waits until it is delivered and the sender has settled
+    """
+    delivered = threading.Event()
+    receiver_peer = ('127.0.0.1', port + 1)
+    sender_impairment = NetworkImpairment(seed=seed, **impairment)
+    receiver_impairment = NetworkImpairment(seed=seed + 1, **impairment)
+    sender = AsyncNetworkHandler.AsyncNetworkHandler(port + 1, lambda message: None, 1, host='127.0.0.1',
+                                                     local_port=port, impairment=sender_impairment)
+    receiver = AsyncNetworkHandler.AsyncNetworkHandler(port, lambda message: delivered.set(), 2, host='127.0.0.1',
+                                                       local_port=port + 1, impairment=receiver_impairment)
+    sender.set_peer_capabilities(None, Capabilities.local())
+    receiver.set_peer_capabilities(None, Capabilities.local())
+
+    started = time.perf_counter()
+    sender.send_message(Packet.Message(os.urandom(payload_bytes), PayloadType.CHAT, 1), receiver_peer)
+    delivered.wait(TIMEOUT_S)
+    delivered_s = time.perf_counter() - started
+    deadline = started + TIMEOUT_S
+    while sender.TRANSACTION_HANDLER.active and time.perf_counter() < deadline:
+        time.sleep(0.005)
+    settled_s = time.perf_counter() - started
+
+    sender.shutdown()
+    receiver.shutdown()
+    offered = sender_impairment.statistics()
+    return {
+        'delivered': delivered.is_set(),
+        'delivery_ms': delivered_s * 1e3,
+        'settled_ms': settled_s * 1e3,
+        'sender_packets': offered['offered'],
+        'sender_bytes': offered['offered_bytes'],
+        'sender_dropped': offered['dropped'],
+        'receiver_dropped': receiver_impairment.statistics()['dropped'],
+        'retransmitted_packets': Metrics.PACKETS_RETRANSMITTED.snapshot()['peers'].get(receiver_peer, 0),
+        'selective_repeats': Metrics.SELECTIVE_REPEATS_SENT.snapshot()['peers'].get(('127.0.0.1', port), 0),
+        'transactions_failed': Metrics.TRANSACTIONS_FAILED.snapshot()['peers'].get(receiver_peer, 0),
+    }
+
+
+def run(profiles=PROFILES) -> dict:
+    """
+    Returns every profile's results keyed by name, with recovery time and wasted bytes relative to BASELINE
+    """
+    results = {}
+    for offset, (name, impairment) in enumerate(profiles.items()):
+        results[name] = measure(impairment, PORT + 2 * offset)
+    baseline = results.get(BASELINE)
+    if baseline is not None:
+        for result in results.values():
+            result['recovery_ms'] = result['delivery_ms'] - baseline['delivery_ms']
+            result['wasted_bytes'] = result['sender_bytes'] - baseline['sender_bytes']
+    return results
+
+
+if __name__ == '__main__':
+    for name, result in run().items():
+        print(f"{name:<20}{'ok' if result['delivered'] else 'LOST':<6}{result['delivery_ms']:>9.1f} ms"
+              f"{result.get('recovery_ms', 0):>9.1f} ms recovery{result.get('wasted_bytes', 0):>10} B wasted"
+              f"{result['retransmitted_packets']:>6} resent{result['selective_repeats']:>5} repeats")
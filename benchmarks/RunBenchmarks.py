@@ -0,0 +1,112 @@
+"""
+Runs the benchmark suite and writes every result as JSON, tagged with the commit, interpreter and machine it ran on, so
+runs on different commits can be compared.
+
+Run from the repository root:
+    python benchmarks/RunBenchmarks.py --output results.json
+    python benchmarks/RunBenchmarks.py --only PacketCodec Aead --compare results.json
+"""
+import argparse
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+SUITE = (
+    # MICRO
+    'PacketCodec', 'Message', 'Aead',
+    # COMPONENT
+    'TransactionContention',
+    # END TO END
+    'Startup', 'Load', 'Recovery',
+)
+''' Benchmark modules in the order they run, each is <name>Benchmark.py with a run() returning its results '''
+
+
+def commit() -> str | None:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                  timeout=30).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                               capture_output=True, text=True, timeout=30).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return f"{revision}-dirty" if revision and dirty else revision or None
+
+
+def run(names=SUITE) -> dict:
+    results = {}
+    for name in names:
+        module = importlib.import_module(f"{name}Benchmark")
+        started = time.perf_counter()
+        results[name] = {'result': module.run(), 'seconds': time.perf_counter() - started}
+        print(f"{name:<24}{results[name]['seconds']:>8.1f} s", file=sys.stderr)
+    return {
+        'commit': commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'benchmarks': results,
+    }
+
+
+def flatten(value, prefix: str = '') -> dict:
+    """
+    Every numeric leaf keyed by its path, list entries are keyed by their non-numeric fields so cases line up across runs
+    """
+    if isinstance(value, bool):
+        return {}
+    if isinstance(value, (int, float)):
+        return {prefix: value}
+    flat = {}
+    if isinstance(value, dict):
+        for key, item in value.items():
+            flat.update(flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+    elif isinstance(value, list):
+        for index, item in enumerate(value):
+            if isinstance(item, dict):
+                label = ','.join(f"{key}={item[key]}" for key in sorted(item)
+                                 if isinstance(item[key], (str, bool)) or key in ('clients', 'senders', 'shards'))
+            else:
+                label = str(index)
+            flat.update(flatten(item, f"{prefix}[{label or index}]"))
+    return flat
+
+
+def compare(baseline: dict, current: dict) -> list:
+    """
+    (path, baseline, current, ratio) for every numeric result both runs share
+    """
+    old = flatten(baseline['benchmarks'])
+    new = flatten(current['benchmarks'])
+    return [(path, old[path], new[path], new[path] / old[path] if old[path] else None)
+            for path in new if path in old]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--only', nargs='+', choices=SUITE, default=SUITE, help='benchmarks to run')
+    parser.add_argument('--output', help='file to write the JSON results to, stdout if omitted')
+    parser.add_argument('--compare', help='earlier JSON results to print ratios against')
+    arguments = parser.parse_args()
+
+    report = run(arguments.only)
+    text = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            baseline = json.load(file)
+        print(f"compared against {baseline.get('commit')}", file=sys.stderr)
+        for path, old, new, ratio in compare(baseline, report):
+            print(f"{path:<72}{old:>14.2f}{new:>14.2f}{'' if ratio is None else f'{ratio:>8.2f}x'}", file=sys.stderr)
@@ -0,0 +1,67 @@
+"""
+Measures how long a fresh interpreter takes to import Server and to construct a headless Server.Server, and checks that
+neither pulls in eel.
+
+Run from the repository root:
+    python benchmarks/StartupBenchmark.py
+"""
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RUNS = 5
+PORT = 9701
+
+IMPORT_TARGET_MS = 130
+''' Most time (ms) a fresh interpreter may spend importing Server. asyncio, which both engines are built on, takes
+about 65 ms of that on its own and the AES-GCM bindings the constructor needs another 10 ms, so the rest is the budget
+for this repository's own modules '''
+
+STARTUP_TARGET_MS = 150
+''' Most time (ms) from a fresh interpreter to a constructed Server.Server, imports included '''
+
+PROBE = """
+import json, os, sys, time
+started = time.perf_counter_ns()
+import Server
+imported = time.perf_counter_ns()
+server = Server.Server(port={port})
+constructed = time.perf_counter_ns()
+server.handshakes.shutdown(wait=True)  # Worker processes hold the output pipe open until they exit
+print(json.dumps({{'import_ms': (imported - started) / 1e6, 'startup_ms': (constructed - started) / 1e6,
+                  'eel_loaded': 'eel' in sys.modules}}), flush=True)
+os._exit(0)  # The server's timers would otherwise keep the interpreter alive
+"""
+
+
+def measure(port: int = PORT) -> dict:
+    """
+    Times one fresh interpreter, each run needs its own interpreter as the imports are cached after the first
+    """
+    output = subprocess.run([sys.executable, '-W', 'ignore', '-c', PROBE.format(port=port)], cwd=ROOT,
+                            capture_output=True, text=True, timeout=60).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(runs: int = RUNS) -> dict:
+    """
+    Returns the median import and startup time (ms) over runs fresh interpreters, and whether eel was ever imported
+    """
+    samples = [measure(PORT + i) for i in range(runs)]
+    import_ms = sorted(sample['import_ms'] for sample in samples)[runs // 2]
+    startup_ms = sorted(sample['startup_ms'] for sample in samples)[runs // 2]
+    return {
+        'import_ms': import_ms,
+        'startup_ms': startup_ms,
+        'eel_loaded': any(sample['eel_loaded'] for sample in samples),
+        'import_within_target': import_ms <= IMPORT_TARGET_MS,
+        'startup_within_target': startup_ms <= STARTUP_TARGET_MS,
+    }
+
+
+if __name__ == '__main__':
+    for name, value in run().items():
+        print(f"{name:<28}{value:>14.1f} ms" if isinstance(value, float) else f"{name:<28}{value!s:>14}")
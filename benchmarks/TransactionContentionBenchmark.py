@@ -0,0 +1,65 @@
+"""
+Contention benchmark for the transaction table: several sender threads push fragmented messages through one
+TransactionHandler at the same time, once with a single shard (the previous master lock) and once sharded.
+
+Run from the repository root:
+    python benchmarks/TransactionContentionBenchmark.py
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+import Packet
+from TransactionHandler import TransactionHandler
+
+SENDER_COUNTS = (1, 2, 4, 8, 16)
+MESSAGES_PER_SENDER = 200
+PACKETS_PER_MESSAGE = 16
+
+
+def build_messages(count: int) -> list:
+    size = (PACKETS_PER_MESSAGE * Packet.Message.max_payload_size(Packet.HEADER_VERSION_1)
+            - Packet.FooterFormat.FOOTER_LENGTH)
+    return [[bytes(p) for p in Packet.Message(os.urandom(size), Packet.PayloadType.CHAT, 1).to_bytes_list()]
+            for _ in range(count)]
+
+
+def run_case(sender_count: int, shard_count: int) -> dict:
+    handler = TransactionHandler(lambda packets, recipient: None, 0, shard_count=shard_count)
+    workloads = [build_messages(MESSAGES_PER_SENDER) for _ in range(sender_count)]
+    barrier = threading.Barrier(sender_count + 1)
+
+    def sender(index: int, messages: list):
+        address = ('127.0.0.1', 10_000 + index)
+        barrier.wait()
+        for packets in messages:
+            for raw in packets:
+                handler.receive_raw_packet(raw, address)
+
+    threads = [threading.Thread(target=sender, args=(i, w)) for i, w in enumerate(workloads)]
+    for t in threads:
+        t.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    packets = sender_count * MESSAGES_PER_SENDER * PACKETS_PER_MESSAGE
+    return {'senders': sender_count, 'shards': shard_count, 'seconds': elapsed, 'packets_per_s': packets / elapsed}
+
+
+def run() -> list:
+    results = []
+    for sender_count in SENDER_COUNTS:
+        for shard_count in (1, NetworkCommunicationConstants.TRANSACTION_SHARD_COUNT):
+            results.append(run_case(sender_count, shard_count))
+    return results
+
+
+if __name__ == '__main__':
+    for result in run():
+        print(f"senders={result['senders']:<4}shards={result['shards']:<4}{result['packets_per_s']:>12.0f} packets/s")
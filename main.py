@@ -27,31 +27,35 @@ RUN_AS_SERVER = False
 USER_ID = random.randint(1, 4_294_967_295)
 PORT = 8888
 
-if RUN_AS_SERVER:
-    server = Server.Server(port=PORT)
-    BetterLog.CALLBACK = server.broadcast_text
-    while True:
-        message = input()
-        if message == "x":
-            break
-
-else:
-    BetterLog.PRETTY_PRINT = True
-    client = Client.Client("10.127.15.88", USER_ID, port=PORT)
-    BetterLog.CALLBACK = client.send
-    while True:
-        message = input('Enter your message: ')
-        if message == "x":
-            break
-        if message == "file":
-            file = open("file.txt", "r")
-            message = file.read()
-            file.close()
-        if message == "filex":
-            num = input('Enter a quantity: ')
-            file = open("file.txt", "r")
-            message = file.read()
-            message *= int(num)
-            file.close()
-
-        client.send(message)
+if __name__ == '__main__':
+    # Handshake worker processes import this module, they must not start a client or server of their own
+    BetterLog.attach_gui()
+
+    if RUN_AS_SERVER:
+        server = Server.Server(port=PORT)
+        BetterLog.CALLBACK = server.broadcast_text
+        while True:
+            message = input()
+            if message == "x":
+                break
+
+    else:
+        BetterLog.PRETTY_PRINT = True
+        client = Client.Client("10.127.15.88", USER_ID, port=PORT)
+        BetterLog.CALLBACK = client.send
+        while True:
+            message = input('Enter your message: ')
+            if message == "x":
+                break
+            if message == "file":
+                file = open("file.txt", "r")
+                message = file.read()
+                file.close()
+            if message == "filex":
+                num = input('Enter a quantity: ')
+                file = open("file.txt", "r")
+                message = file.read()
+                message *= int(num)
+                file.close()
+
+            client.send(message)
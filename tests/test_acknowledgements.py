@@ -0,0 +1,78 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Packet
+from Capabilities import Capabilities
+from Packet import PayloadType
+from TransactionHandler import TransactionHandler
+
+SENDER = ('127.0.0.1', 1)
+RECEIVER = ('127.0.0.1', 2)
+MESSAGES = 5
+
+
+class AcknowledgementTest(unittest.TestCase):
+    """
+    One acknowledgement closes every transaction it lists, the first id in its header and the rest in its payload
+    """
+
+    def setUp(self):
+        self.sent = {SENDER: [], RECEIVER: []}
+        self.scheduled = []
+        self.sender = TransactionHandler(lambda packets, recipient: self.sent[recipient].extend(packets), 1)
+        self.receiver = TransactionHandler(lambda packets, recipient: self.sent[recipient].extend(packets), 2,
+                                           schedule=lambda delay_s, callback: self.scheduled.append(callback))
+
+    def send(self, count: int) -> list:
+        message_ids = []
+        for index in range(count):
+            message = Packet.Message(f"chat {index}".encode(), PayloadType.CHAT, 1)
+            self.sent[RECEIVER].extend(self.sender.prepare_message(message, RECEIVER))
+            message_ids.append(message.messageid)
+        return message_ids
+
+    def assert_closed(self, message_ids: list):
+        for message_id in message_ids:
+            self.assertNotIn((message_id, RECEIVER), self.sender.active)
+            self.assertIn((message_id, RECEIVER), self.sender.completed)
+
+    def test_header_and_payload_ids_are_all_closed(self):
+        message_ids = self.send(MESSAGES)
+        self.sender.recv_acknowledgements(message_ids[0], b''.join(message_ids[1:]), RECEIVER)
+        self.assert_closed(message_ids)
+        self.assertEqual(len(self.sender.active), 0)
+
+    def test_legacy_acknowledgement_closes_only_its_own_message(self):
+        message_ids = self.send(2)
+        self.sender.recv_acknowledgements(message_ids[0], b'', RECEIVER)
+        self.assert_closed(message_ids[:1])
+        self.assertIn((message_ids[1], RECEIVER), self.sender.active)
+
+    def test_trailing_partial_id_is_ignored(self):
+        message_ids = self.send(3)
+        self.sender.recv_acknowledgements(message_ids[0], message_ids[1] + message_ids[2][:-1], RECEIVER)
+        self.assert_closed(message_ids[:2])
+        self.assertIn((message_ids[2], RECEIVER), self.sender.active)
+
+    def test_aggregated_acknowledgement_round_trip(self):
+        agreed = Capabilities(features=Capabilities.ACK_AGGREGATION)
+        self.sender.peers.get(RECEIVER).set_capabilities(agreed)
+        self.receiver.peers.get(SENDER).set_capabilities(agreed)
+        message_ids = self.send(MESSAGES)
+        for packet in self.sent[RECEIVER]:
+            self.assertIsNotNone(self.receiver.receive_raw_packet(packet, SENDER))
+        self.assertEqual(self.sent[SENDER], [])  # Held back until the delay runs out
+        for callback in self.scheduled:
+            callback()
+        self.assertEqual(len(self.sent[SENDER]), 1)
+        acknowledgement = Packet.Packet.from_bytes(self.sent[SENDER][0])
+        self.assertEqual(acknowledgement.footer.payloadtype, PayloadType.ACKNOWLEDGE)
+        self.assertIsNone(self.sender.receive_raw_packet(self.sent[SENDER][0], RECEIVER))
+        self.assert_closed(message_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Bundling
+import NetworkCommunicationConstants
+import Packet
+from Capabilities import Capabilities
+from Packet import PayloadType
+from PeerState import PeerTable
+
+PEER = ('127.0.0.1', 1)
+LEGACY_PEER = ('127.0.0.1', 2)
+LIMIT = 200
+
+
+def packets(*lengths: int) -> list:
+    return [os.urandom(length) for length in lengths]
+
+
+class BundlingTest(unittest.TestCase):
+    def test_round_trip(self):
+        for lengths in ((1, 1), (10, 0, 30), (100,) * 10):
+            with self.subTest(lengths=lengths):
+                bundled = packets(*lengths)
+                datagram = Bundling.pack(bundled)
+                self.assertTrue(Bundling.is_bundle(datagram))
+                self.assertEqual([bytes(packet) for packet in Bundling.unbundle(datagram)], bundled)
+
+    def test_lone_packet_is_sent_as_it_is(self):
+        packet = Packet.Message(b'chat', PayloadType.CHAT, 1).to_bytes_list()[0]
+        self.assertEqual(Bundling.pack([packet]), packet)
+        self.assertFalse(Bundling.is_bundle(packet))
+
+    def test_packets_are_never_mistaken_for_bundles(self):
+        for header_version in (Packet.HEADER_VERSION_1, Packet.HEADER_VERSION_2):
+            for _ in range(64):
+                with self.subTest(header_version=header_version):
+                    packet = Packet.Message(b'chat', PayloadType.CHAT, 1).to_bytes_list(header_version)[0]
+                    self.assertFalse(Bundling.is_bundle(packet))
+
+    def test_truncated_entry_is_dropped(self):
+        bundled = packets(10, 20)
+        datagram = Bundling.pack(bundled)
+        self.assertEqual([bytes(packet) for packet in Bundling.unbundle(datagram[:-1])], bundled[:1])
+
+    def test_full_bundle_is_sent_and_a_new_one_started(self):
+        bundler = Bundling.Bundler()
+        first, second, third = packets(90, 90, 90)
+        self.assertEqual(bundler.add(first, PEER, LIMIT), ([], True))
+        self.assertEqual(bundler.add(second, PEER, LIMIT), ([], False))
+        ready, started = bundler.add(third, PEER, LIMIT)
+        self.assertTrue(started)
+        self.assertEqual(len(ready), 1)
+        self.assertLessEqual(len(ready[0]), LIMIT)
+        self.assertEqual([bytes(packet) for packet in Bundling.unbundle(ready[0])], [first, second])
+        self.assertEqual(bundler.drain(), [(third, PEER)])
+        self.assertEqual(bundler.drain(), [])
+
+    def test_only_small_packets_to_peers_that_agreed_are_held(self):
+        peers = PeerTable()
+        peers.get(PEER).set_capabilities(Capabilities(header_version=2, features=Capabilities.BUNDLING))
+        peers.get(LEGACY_PEER)
+        small, other = packets(20, 20)
+        large = os.urandom(NetworkCommunicationConstants.BUNDLE_MAXIMUM_PACKET_BYTES + 1)
+        bundler = Bundling.Bundler()
+        immediate, started = bundler.hold([(small, PEER), (large, PEER), (other, LEGACY_PEER)], peers)
+        self.assertTrue(started)
+        self.assertEqual(immediate, [(large, PEER), (other, LEGACY_PEER)])
+        self.assertEqual(bundler.drain(), [(small, PEER)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Capabilities as CapabilitiesModule
+import Compression
+import Packet
+from Capabilities import Capabilities
+
+DH_PARAMETERS = b'-----BEGIN DH PARAMETERS-----\nMIIBCAKCAQEA\n-----END DH PARAMETERS-----\n'
+
+
+def offered() -> Capabilities:
+    return Capabilities(header_version=2, max_datagram_size=1_200,
+                        features=Capabilities.FLOW_CONTROL | Capabilities.BUNDLING | Capabilities.RESUMPTION,
+                        compression=(Compression.LZMA, Compression.ZLIB), key_exchange=(CapabilitiesModule.X25519,),
+                        key_share=os.urandom(32), ticket=os.urandom(60), ticket_nonce=os.urandom(16))
+
+
+class CapabilitiesTest(unittest.TestCase):
+    def assert_same(self, decoded: Capabilities, capabilities: Capabilities):
+        self.assertEqual(decoded.fields(), capabilities.fields())
+
+    def test_round_trip(self):
+        capabilities = offered()
+        self.assert_same(Capabilities.from_bytes(capabilities.to_bytes()), capabilities)
+
+    def test_local_round_trip(self):
+        capabilities = Capabilities.local()
+        self.assert_same(Capabilities.from_bytes(capabilities.to_bytes()), capabilities)
+
+    def test_unknown_tags_are_skipped(self):
+        capabilities = offered()
+        unknown = CapabilitiesModule.FIELD.pack(200, 3) + b'new'
+        trailer = capabilities.to_bytes()
+        self.assert_same(Capabilities.from_bytes(trailer[:len(CapabilitiesModule.CAPABILITIES_MAGIC)] + unknown +
+                                                 trailer[len(CapabilitiesModule.CAPABILITIES_MAGIC):]), capabilities)
+
+    def test_split_connect_payload(self):
+        capabilities = offered()
+        parameters, decoded = Capabilities.split(DH_PARAMETERS + capabilities.to_bytes())
+        self.assertEqual(parameters, DH_PARAMETERS)
+        self.assert_same(decoded, capabilities)
+
+    def test_legacy_connect_has_no_capabilities(self):
+        parameters, decoded = Capabilities.split(DH_PARAMETERS)
+        self.assertEqual(parameters, DH_PARAMETERS)
+        self.assertIsNone(decoded)
+
+    def test_missing_fields_keep_the_original_protocol(self):
+        decoded = Capabilities.from_bytes(CapabilitiesModule.CAPABILITIES_MAGIC)
+        self.assertEqual(decoded.header_version, 1)
+        self.assertEqual(decoded.features, 0)
+        self.assertIsNone(decoded.compression_codec())
+        self.assertIsNone(decoded.key_exchange_method())
+
+    def test_malformed_fields_are_absent(self):
+        magic = CapabilitiesModule.CAPABILITIES_MAGIC
+        for trailer in (magic + CapabilitiesModule.FIELD.pack(Capabilities.HEADER_VERSION, 0),
+                        magic + CapabilitiesModule.FIELD.pack(Capabilities.MAX_DATAGRAM_SIZE, 1) + b'\x0a',
+                        magic + CapabilitiesModule.FIELD.pack(Capabilities.HEADER_VERSION, 4) + b'\x02'):
+            with self.subTest(trailer=trailer):
+                self.assert_same(Capabilities.from_bytes(trailer), Capabilities())
+
+    def test_agree_never_trusts_the_peer(self):
+        for header_version in (0, 200):
+            with self.subTest(header_version=header_version):
+                agreed = Capabilities.local().agree(Capabilities(header_version=header_version, max_datagram_size=10))
+                message = Packet.Message(bytes(100), Packet.PayloadType.CHAT, 1)
+                self.assertEqual(len(message.to_packet_list(agreed.header_version, agreed.max_datagram_size)), 1)
+
+    def test_agree_keeps_what_both_support(self):
+        other = Capabilities(header_version=1, max_datagram_size=1_500,
+                             features=Capabilities.BUNDLING | Capabilities.ACK_AGGREGATION,
+                             compression=(Compression.ZLIB,))
+        agreed = offered().agree(other)
+        self.assertEqual(agreed.header_version, 1)
+        self.assertEqual(agreed.max_datagram_size, 1_200)
+        self.assertTrue(agreed.supports(Capabilities.BUNDLING))
+        self.assertFalse(agreed.supports(Capabilities.FLOW_CONTROL))
+        self.assertFalse(agreed.supports(Capabilities.ACK_AGGREGATION))
+        self.assertEqual(agreed.compression_codec(), Compression.ZLIB)
+        self.assertIsNone(agreed.key_exchange_method())
+        self.assertEqual(agreed.key_share, b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
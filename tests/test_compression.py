@@ -0,0 +1,54 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Compression
+import NetworkCommunicationConstants
+
+CODECS = (Compression.NONE,) + Compression.AVAILABLE
+THRESHOLD = NetworkCommunicationConstants.COMPRESSION_THRESHOLD_BYTES
+LIMIT = 65_536
+PAYLOADS = (b'', b'short', b'chat message ' * 200, os.urandom(THRESHOLD * 4))
+
+
+class CompressionTest(unittest.TestCase):
+    def test_round_trip(self):
+        for codec in CODECS:
+            for payload in PAYLOADS:
+                with self.subTest(codec=codec, length=len(payload)):
+                    self.assertEqual(Compression.decompress(Compression.compress(payload, codec)), payload)
+
+    def test_compressible_payload_is_flagged_with_its_codec(self):
+        payload = b'chat message ' * 200
+        for codec in Compression.AVAILABLE:
+            with self.subTest(codec=codec):
+                frame = Compression.compress(payload, codec)
+                self.assertEqual(frame[0], codec)
+                self.assertLess(len(frame), len(payload))
+
+    def test_small_or_incompressible_payload_is_left_as_it_is(self):
+        for codec in Compression.AVAILABLE:
+            for payload in (b'x' * (THRESHOLD - 1), os.urandom(THRESHOLD * 4)):
+                with self.subTest(codec=codec, length=len(payload)):
+                    self.assertEqual(Compression.compress(payload, codec), bytes((Compression.NONE,)) + payload)
+
+    def test_bad_frames_are_refused(self):
+        truncated = Compression.compress(b'chat message ' * 200, Compression.ZLIB)[:-4]
+        for frame in (b'', bytes((200,)) + b'data', truncated, bytes((Compression.LZMA,)) + b'not lzma'):
+            with self.subTest(frame=frame[:8]):
+                self.assertRaises(Compression.DecompressionError, Compression.decompress, frame)
+
+    def test_decompression_is_bounded(self):
+        with mock.patch.object(NetworkCommunicationConstants, 'MAXIMUM_DECOMPRESSED_BYTES', LIMIT):
+            for codec in Compression.AVAILABLE:
+                with self.subTest(codec=codec):
+                    self.assertEqual(len(Compression.decompress(Compression.compress(bytes(LIMIT), codec))), LIMIT)
+                    frame = Compression.compress(bytes(LIMIT + 1), codec)
+                    self.assertRaises(Compression.DecompressionError, Compression.decompress, frame)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from TransactionHandler import DeadlineHeap, TransactionRecord
+
+PEER = ('127.0.0.1', 1)
+
+
+def outgoing(deadline: int) -> TransactionRecord:
+    record = TransactionRecord(False, [b'packet'])
+    record.outgoing.resend_time = deadline
+    return record
+
+
+class DeadlineHeapTest(unittest.TestCase):
+    """
+    A poll hands back exactly the transactions that are due, however often their deadlines moved
+    """
+
+    def setUp(self):
+        self.heap = DeadlineHeap()
+        self.records = {}
+
+    def add(self, message_id: bytes, deadline: int) -> TransactionRecord:
+        record = outgoing(deadline)
+        self.records[(message_id, PEER)] = record
+        self.heap.push((message_id, PEER), record)
+        return record
+
+    def test_rescheduled_earlier_is_due_at_the_new_deadline(self):
+        record = self.add(b'\x00\x00\x01', 1_000)
+        record.outgoing.resend_time = 100
+        self.heap.reschedule((b'\x00\x00\x01', PEER), record)
+        self.assertEqual(self.heap.pop_due(200, self.records), [((b'\x00\x00\x01', PEER), record)])
+        # The entry it left behind at the old deadline is stale, so the record is not handed back twice
+        self.assertEqual(self.heap.pop_due(2_000, self.records), [])
+        self.assertEqual(len(self.heap), 0)
+
+    def test_rescheduled_later_is_not_due_at_the_old_deadline(self):
+        record = self.add(b'\x00\x00\x01', 100)
+        record.outgoing.resend_time = 1_000
+        self.heap.reschedule((b'\x00\x00\x01', PEER), record)
+        self.assertEqual(len(self.heap), 1)  # A later deadline is only caught when the old entry surfaces
+        self.assertEqual(self.heap.pop_due(200, self.records), [])
+        self.assertEqual(self.heap.pop_due(1_100, self.records), [((b'\x00\x00\x01', PEER), record)])
+
+    def test_only_due_records_are_popped(self):
+        early = self.add(b'\x00\x00\x01', 100)
+        self.add(b'\x00\x00\x02', 1_000)
+        self.assertEqual(self.heap.pop_due(200, self.records), [((b'\x00\x00\x01', PEER), early)])
+        self.assertEqual(len(self.heap), 1)
+
+    def test_discarded_record_is_never_due(self):
+        record = self.add(b'\x00\x00\x01', 100)
+        self.heap.discard(record)
+        self.assertEqual(self.heap.pop_due(200, self.records), [])
+
+    def test_replaced_record_only_pops_once(self):
+        self.add(b'\x00\x00\x01', 100)
+        replacement = self.add(b'\x00\x00\x01', 150)
+        self.assertEqual(self.heap.pop_due(200, self.records), [((b'\x00\x00\x01', PEER), replacement)])
+
+    def test_stale_entries_are_compacted(self):
+        record = self.add(b'\x00\x00\x01', 10_000)
+        for deadline in range(9_000, 0, -1_000):
+            record.outgoing.resend_time = deadline
+            self.heap.reschedule((b'\x00\x00\x01', PEER), record)
+        self.add(b'\x00\x00\x02', 20_000)
+        self.assertEqual(self.heap.pop_due(1_500, self.records), [((b'\x00\x00\x01', PEER), record)])
+        self.assertEqual(len(self.heap), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import math
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+from FlowControl import SendWindow
+
+INITIAL = NetworkCommunicationConstants.FLOW_INITIAL_WINDOW_PACKETS
+MINIMUM = NetworkCommunicationConstants.FLOW_MINIMUM_WINDOW_PACKETS
+
+
+def packets(count: int, tag: bytes = b'') -> list:
+    return [tag + index.to_bytes(length=2, byteorder='big') for index in range(count)]
+
+
+class SendWindowTest(unittest.TestCase):
+    """
+    The window caps packets in flight, grows by one packet per window acknowledged and halves on loss
+    """
+
+    def setUp(self):
+        # Pacing is covered on its own, everywhere else only the window may hold packets back
+        patcher = mock.patch.object(NetworkCommunicationConstants, 'FLOW_PACING_BURST_PACKETS', 100_000)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.window = SendWindow()
+        self.window.round_trip_ns = 1
+        self.window._tokens = 100_000
+
+    def test_window_caps_packets_in_flight(self):
+        released = self.window.submit(b'\x00\x00\x01', packets(INITIAL * 3))
+        self.assertEqual(released, packets(INITIAL))
+        self.assertEqual(self.window.in_flight, INITIAL)
+        self.assertEqual(len(self.window), INITIAL * 2)
+
+    def test_acknowledging_a_window_grows_it_by_one_packet(self):
+        self.window.submit(b'\x00\x00\x01', packets(INITIAL))
+        released = self.window.submit(b'\x00\x00\x02', packets(INITIAL * 2))
+        self.assertEqual(released, [])
+        released = self.window.acknowledged(b'\x00\x00\x01')
+        self.assertAlmostEqual(self.window.window, INITIAL + 1)
+        self.assertEqual(len(released), INITIAL + 1)
+        self.assertEqual(self.window.in_flight, INITIAL + 1)
+
+    def test_progress_releases_what_the_receiver_holds(self):
+        self.window.submit(b'\x00\x00\x01', packets(INITIAL * 2))
+        released = self.window.progress(b'\x00\x00\x01', INITIAL // 2)
+        self.assertAlmostEqual(self.window.window, INITIAL + (INITIAL // 2) / INITIAL)
+        # Half the window was freed, and the half packet it grew by is rounded up to a whole one
+        self.assertEqual(len(released), INITIAL // 2 + 1)
+        self.assertEqual(self.window.in_flight, math.ceil(self.window.window))
+        self.assertEqual(self.window.progress(b'\x00\x00\x01', INITIAL // 4), [])  # Older reports change nothing
+
+    def test_loss_halves_the_window_once_per_round_trip(self):
+        sent = range(len(self.window.submit(b'\x00\x00\x01', packets(INITIAL * 2))))
+        self.window.round_trip_ns = 10 ** 12
+        self.window.lost(b'\x00\x00\x01', sent)
+        self.assertEqual(self.window.window, INITIAL / 2)
+        self.window.lost(b'\x00\x00\x01', sent)
+        self.assertEqual(self.window.window, INITIAL / 2)
+        for _ in range(8):
+            self.window._last_decrease = 0  # A round trip has gone by
+            self.window.lost(b'\x00\x00\x01', sent)
+        self.assertEqual(self.window.window, MINIMUM)
+
+    def test_lost_packets_go_ahead_of_new_traffic(self):
+        window = self.window
+        sent = window.submit(b'\x00\x00\x01', packets(INITIAL, b'a'))
+        window.submit(b'\x00\x00\x02', packets(INITIAL, b'b'))
+        window.round_trip_ns = 10 ** 12
+        released = window.lost(b'\x00\x00\x01', range(4))
+        # Nothing of the lost message is in flight any more, the halved window is filled from the front of the queue
+        self.assertEqual(released, sent[:4] + packets(INITIAL // 2 - 4, b'b'))
+        self.assertEqual(window.in_flight, INITIAL // 2)
+
+    def test_loss_is_matched_by_sequence_number(self):
+        window = self.window
+        sent = packets(INITIAL * 2, b'a')
+        window.submit(b'\x00\x00\x01', sent)
+        window.round_trip_ns = 10 ** 12
+        # A repeated, a still queued and an out of range sequence number, only the first packet was lost
+        released = window.lost(b'\x00\x00\x01', [2, 2, INITIAL, INITIAL * 2])
+        self.assertEqual(released, sent[2:3] + sent[INITIAL:INITIAL + INITIAL // 2 - 1])
+        self.assertEqual(len(window), INITIAL + 1 - INITIAL // 2)
+
+    def test_forgotten_message_frees_the_window(self):
+        self.window.submit(b'\x00\x00\x01', packets(INITIAL * 2))
+        self.window.forget(b'\x00\x00\x01')
+        self.assertEqual(self.window.in_flight, 0)
+        self.assertEqual(len(self.window), 0)
+        self.assertNotIn(b'\x00\x00\x01', self.window)
+
+    def test_pacing_caps_a_burst(self):
+        window = SendWindow()
+        window.round_trip_ns = 10 ** 12
+        with mock.patch.object(NetworkCommunicationConstants, 'FLOW_PACING_BURST_PACKETS', 4):
+            window._tokens = 4
+            self.assertEqual(len(window.submit(b'\x00\x00\x01', packets(INITIAL))), 4)
+            self.assertEqual(window.release(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import sys
+import threading
+import unittest
+from concurrent.futures import BrokenExecutor
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from HandshakeExecutor import HandshakeExecutor
+
+QUEUE_SIZE = 2
+
+
+class HandshakeExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.executor = HandshakeExecutor(workers=1, queue_size=QUEUE_SIZE, processes=False)
+        self.addCleanup(self.executor.shutdown, True)
+
+    def run_step(self, *args) -> list:
+        results = []
+        done = threading.Event()
+        self.assertTrue(self.executor.submit(sum, args, callback=lambda result: (results.append(result), done.set())))
+        self.assertTrue(done.wait(5))
+        return results
+
+    def test_full_queue_turns_steps_away(self):
+        release = threading.Event()
+        for _ in range(QUEUE_SIZE):
+            self.assertTrue(self.executor.submit(release.wait, callback=lambda result: None))
+        self.assertFalse(self.executor.submit(release.wait, callback=lambda result: None))
+        release.set()
+        self.assertEqual(self.executor.statistics()['rejected'], 1)
+
+    def test_failed_submits_give_their_slot_back(self):
+        self.run_step(0)  # Creates the pool
+        broken = self.executor.pool
+        with mock.patch.object(broken, 'submit', side_effect=BrokenExecutor('worker died')):
+            self.assertFalse(self.executor.submit(sum, (1, 2), callback=lambda result: None))
+        statistics = self.executor.statistics()
+        self.assertEqual(statistics['queue_depth'], 0)
+        self.assertEqual(statistics['failed'], 1)
+        self.assertIsNot(self.executor.pool, broken)  # Dropped and started again by the next submit
+        for _ in range(QUEUE_SIZE + 1):
+            self.assertEqual(self.run_step(1, 2), [3])
+
+    def test_submit_after_shutdown_is_refused(self):
+        self.run_step(0)
+        self.executor.shutdown(wait=True)
+        for _ in range(QUEUE_SIZE + 1):
+            self.assertFalse(self.executor.submit(sum, (1, 2), callback=lambda result: None))
+        self.assertEqual(self.executor.statistics()['queue_depth'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
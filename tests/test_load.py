@@ -0,0 +1,36 @@
+import importlib.util
+import os
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import LoadBenchmark
+
+CLIENTS = 16
+MESSAGES = 25
+PORT = 9901
+
+
+@unittest.skipIf(importlib.util.find_spec('cryptography') is None, 'the server and clients need cryptography')
+class LoadTest(unittest.TestCase):
+    """
+    Every chat message a burst of clients sends reaches every client, queueing delay under load must never be taken for
+    loss and give up on a transaction
+    """
+
+    def assert_delivers_everything(self, single_loop: bool, port: int):
+        result = LoadBenchmark.run_case(CLIENTS, MESSAGES, single_loop, port)
+        self.assertEqual(result['deliveries'], result['deliveries_expected'], result)
+
+    def test_threaded_engine_delivers_everything(self):
+        self.assert_delivers_everything(False, PORT)
+
+    def test_single_loop_engine_delivers_everything(self):
+        self.assert_delivers_everything(True, PORT + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
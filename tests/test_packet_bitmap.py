@@ -0,0 +1,87 @@
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PacketBitmap
+from PacketBitmap import PacketBitmap as Bitmap
+
+MAX_LENGTH = 1_000
+SIZES = (1, 7, 8, 9, 255, 1_000, 1_003)
+
+
+def with_missing(size: int, missing: set) -> Bitmap:
+    bitmap = Bitmap(size)
+    for index in range(size):
+        if index not in missing:
+            bitmap.set(index)
+    return bitmap
+
+
+def gaps(size: int) -> list:
+    """
+    Nothing missing, everything missing, a single run, scattered gaps and every other packet
+    """
+    shuffler = random.Random(size)
+    return [set(), set(range(size)), set(range(size // 3, size // 2 + 1)),
+            set(shuffler.sample(range(size), max(1, size // 10))), set(range(0, size, 2))]
+
+
+class PacketBitmapTest(unittest.TestCase):
+    def test_set_counts_each_index_once(self):
+        bitmap = Bitmap(10)
+        self.assertTrue(bitmap.set(3))
+        self.assertFalse(bitmap.set(3))
+        self.assertEqual(bitmap.count, 1)
+        self.assertIn(3, bitmap)
+        self.assertNotIn(4, bitmap)
+        self.assertRaises(IndexError, bitmap.set, 10)
+
+    def test_missing_ranges(self):
+        bitmap = with_missing(20, {0, 1, 2, 9, 17, 18, 19})
+        self.assertEqual(bitmap.missing_ranges(), [(0, 3), (9, 1), (17, 3)])
+        self.assertEqual(bitmap.missing(), [0, 1, 2, 9, 17, 18, 19])
+        self.assertFalse(bitmap.is_full())
+        self.assertTrue(with_missing(20, set()).is_full())
+
+    def test_round_trip(self):
+        for size in SIZES:
+            for missing in gaps(size):
+                with self.subTest(size=size, missing=len(missing)):
+                    bitmap = with_missing(size, missing)
+                    payload = PacketBitmap.encode_selective_repeat(bitmap, MAX_LENGTH)
+                    self.assertEqual(payload[0], PacketBitmap.REPEAT_MARKER)
+                    self.assertEqual(PacketBitmap.decode_selective_repeat(payload), sorted(missing))
+
+    def test_scattered_gaps_use_the_bitmap_form(self):
+        bitmap = with_missing(1_000, set(range(0, 1_000, 2)))
+        payload = PacketBitmap.encode_selective_repeat(bitmap, MAX_LENGTH)
+        self.assertEqual(payload[1], PacketBitmap.REPEAT_BITMAP)
+        self.assertEqual(len(payload), 2 + len(bitmap.bits))
+
+    def test_runs_use_the_ranges_form(self):
+        bitmap = with_missing(1_000, set(range(100, 400)))
+        payload = PacketBitmap.encode_selective_repeat(bitmap, MAX_LENGTH)
+        self.assertEqual(payload[1], PacketBitmap.REPEAT_RANGES)
+        self.assertEqual(len(payload), 2 + PacketBitmap.RANGE.size)
+
+    def test_ranges_past_max_length_are_left_out(self):
+        missing = set(range(0, 1_000, 10))
+        bitmap = with_missing(1_000, missing)
+        max_length = 2 + 3 * PacketBitmap.RANGE.size
+        payload = PacketBitmap.encode_selective_repeat(bitmap, max_length)
+        self.assertLessEqual(len(payload), max_length)
+        self.assertEqual(PacketBitmap.decode_selective_repeat(payload), sorted(missing)[:3])
+
+    def test_legacy_round_trip(self):
+        for size in (1, 9, 255):
+            for missing in gaps(size):
+                with self.subTest(size=size, missing=len(missing)):
+                    payload = PacketBitmap.encode_legacy_selective_repeat(with_missing(size, missing), MAX_LENGTH)
+                    self.assertEqual(PacketBitmap.decode_selective_repeat(payload), sorted(missing))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import random
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+import Packet
+from FlowControl import RoundTripEstimator
+from Packet import PayloadType
+from TransactionHandler import IncomingTransaction, TransactionHandler
+
+LAYOUTS = (
+    (Packet.HEADER_VERSION_1, NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES),
+    (Packet.HEADER_VERSION_2, NetworkCommunicationConstants.MAXIMUM_PACKET_SIZE_BYTES),
+    (Packet.HEADER_VERSION_2, NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES),
+)
+BOUNDARY_PACKETS = 4
+LIMIT = 65_536
+PEER = ('127.0.0.1', 1)
+
+
+def boundary_sizes(header_version: int, datagram_size: int) -> list:
+    """
+    Payload sizes on both sides of every point where the payload or the footer spills into another packet
+    """
+    size = Packet.Message.max_payload_size(header_version, datagram_size)
+    footer = Packet.FooterFormat.FOOTER_LENGTH
+    sizes = set()
+    for packets in range(1, BOUNDARY_PACKETS + 1):
+        for edge in (packets * size, packets * size - footer):
+            sizes.update(length for length in range(edge - 2, edge + 3) if length >= 0)
+    return sorted(sizes)
+
+
+def arrival_orders(packets: list) -> list:
+    """
+    In order, reversed, the short fragment before the last first, and a few shuffles
+    """
+    orders = [packets, packets[::-1], packets[-2:-1] + packets[:-2] + packets[-1:], packets[-1:] + packets[-2:-1]
+              + packets[:-2]]
+    shuffler = random.Random(len(packets))
+    for _ in range(3):
+        orders.append(shuffler.sample(packets, len(packets)))
+    return orders
+
+
+def reassemble(packets: list) -> Packet.Message:
+    packets = [Packet.Packet.from_bytes(packet.to_bytes(), packet.header.version != Packet.HEADER_VERSION_1)
+               for packet in packets]
+    transaction = IncomingTransaction(packets[0].header.packetcount, RoundTripEstimator())
+    for packet in packets:
+        transaction.recv_packet(packet)
+    assert transaction.is_completed()
+    return transaction.to_message(packets[0].header.messageid, ('127.0.0.1', 1))
+
+
+class ReassemblyTest(unittest.TestCase):
+    def test_sizes_around_packet_boundaries(self):
+        for header_version, datagram_size in LAYOUTS:
+            for length in boundary_sizes(header_version, datagram_size):
+                with self.subTest(header_version=header_version, datagram_size=datagram_size, length=length):
+                    payload = os.urandom(length)
+                    message = Packet.Message(payload, PayloadType.CHAT, 1)
+                    packets = message.to_packet_list(header_version, datagram_size)
+                    if len(packets) == 1:
+                        continue  # Single packet messages never reach reassembly
+                    self.assertEqual(bytes(reassemble(packets).payload), payload)
+
+    def test_arrival_order_does_not_matter(self):
+        for header_version, datagram_size in LAYOUTS:
+            for length in boundary_sizes(header_version, datagram_size):
+                payload = os.urandom(length)
+                packets = Packet.Message(payload, PayloadType.CHAT, 1).to_packet_list(header_version, datagram_size)
+                if len(packets) == 1:
+                    continue
+                for order in arrival_orders(packets):
+                    with self.subTest(header_version=header_version, datagram_size=datagram_size, length=length,
+                                      order=[packet.header.packetsequencenumber for packet in order]):
+                        self.assertEqual(bytes(reassemble(order).payload), payload)
+
+
+class ReassemblyLimitTest(unittest.TestCase):
+    """
+    The packet count of an incoming header is unauthenticated, so it never sizes a buffer past MAXIMUM_MESSAGE_BYTES
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(NetworkCommunicationConstants, 'MAXIMUM_MESSAGE_BYTES', LIMIT)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = TransactionHandler(lambda packets, recipient: None, 1)
+
+    def packets(self, length: int) -> list:
+        message = Packet.Message(os.urandom(length), PayloadType.CHAT, 1)
+        return message.to_bytes_list(Packet.HEADER_VERSION_2, NetworkCommunicationConstants.MAXIMUM_DATAGRAM_SIZE_BYTES)
+
+    def test_message_at_the_limit_is_reassembled(self):
+        received = [self.handler.receive_packet(Packet.Packet.from_bytes(packet, True), PEER)
+                    for packet in self.packets(LIMIT)]
+        self.assertEqual(len(received[-1].payload), LIMIT)
+
+    def test_forged_packet_count_is_dropped(self):
+        packets = self.packets(LIMIT)
+        forged = bytearray(packets[0])
+        forged[4:6] = (0xFFFF).to_bytes(length=2, byteorder='big')  # PACKET_COUNT of the version 2 header
+        self.assertIsNone(self.handler.receive_packet(Packet.Packet.from_bytes(forged, True), PEER))
+        self.assertEqual(len(self.handler.active), 0)
+
+    def test_oversized_message_is_refused_by_the_sender(self):
+        self.assertRaises(Packet.MessageTooLarge, self.packets, LIMIT + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import importlib.util
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+
+NONCE_LENGTH = NetworkCommunicationConstants.RESUMPTION_NONCE_LENGTH
+
+
+@unittest.skipIf(importlib.util.find_spec('cryptography') is None, 'tickets are sealed with cryptography')
+class ResumptionTicketsTest(unittest.TestCase):
+    def setUp(self):
+        import EncryptionHandler
+        self.EncryptionHandler = EncryptionHandler
+        self.tickets = EncryptionHandler.ResumptionTickets()
+
+    def test_issued_ticket_opens_to_its_secret(self):
+        resumption_secret, ticket = self.tickets.issue()
+        self.assertEqual(len(resumption_secret), self.EncryptionHandler.RESUMPTION_SECRET_LENGTH)
+        self.assertEqual(self.tickets.open(ticket), resumption_secret)
+        self.assertNotIn(resumption_secret, ticket)
+
+    def test_expired_ticket_is_refused(self):
+        tickets = self.EncryptionHandler.ResumptionTickets(lifetime_ns=1)
+        _, ticket = tickets.issue()
+        time.sleep(0.001)
+        self.assertIsNone(tickets.open(ticket))
+
+    def test_foreign_or_damaged_ticket_is_refused(self):
+        _, ticket = self.tickets.issue()
+        restarted = self.EncryptionHandler.ResumptionTickets()  # A restart draws a new ticket key
+        self.assertIsNone(restarted.open(ticket))
+        damaged = bytearray(ticket)
+        damaged[-1] ^= 1
+        self.assertIsNone(self.tickets.open(bytes(damaged)))
+        self.assertIsNone(self.tickets.open(ticket[:8]))
+        self.assertIsNone(self.tickets.open(b''))
+
+    def test_redeemed_ticket_resumes_the_same_key_on_both_sides(self):
+        resumption_secret, ticket = self.tickets.issue()
+        client_nonce, server_nonce = os.urandom(NONCE_LENGTH), os.urandom(NONCE_LENGTH)
+        client = self.EncryptionHandler.EncryptionHandler(None)
+        server = self.EncryptionHandler.EncryptionHandler(client.dh_parameters_bytes)
+        client.resume(resumption_secret, client_nonce, server_nonce)
+        server.resume(self.tickets.open(ticket), client_nonce, server_nonce)
+        self.assertEqual(bytes(server.decrypt(client.encrypt(b'chat'))), b'chat')
+        self.assertEqual(bytes(client.decrypt(server.encrypt(b'chat'))), b'chat')
+
+    def test_fresh_nonces_give_a_fresh_key(self):
+        from cryptography.exceptions import InvalidTag
+        resumption_secret, _ = self.tickets.issue()
+        client_nonce = os.urandom(NONCE_LENGTH)
+        client = self.EncryptionHandler.EncryptionHandler(None)
+        server = self.EncryptionHandler.EncryptionHandler(client.dh_parameters_bytes)
+        client.resume(resumption_secret, client_nonce, os.urandom(NONCE_LENGTH))
+        server.resume(resumption_secret, client_nonce, os.urandom(NONCE_LENGTH))
+        self.assertRaises(InvalidTag, server.decrypt, client.encrypt(b'chat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+import Packet
+from FlowControl import RoundTripEstimator
+from Packet import PayloadType
+from TransactionHandler import TransactionHandler
+
+SECOND_NS = 1_000_000_000
+MINIMUM = NetworkCommunicationConstants.MINIMUM_RESPONSE_TIME_NS
+MAXIMUM = NetworkCommunicationConstants.MAXIMUM_RESPONSE_TIME_NS
+PEER = ('127.0.0.1', 1)
+
+
+class RoundTripEstimatorTest(unittest.TestCase):
+    def test_first_sample(self):
+        estimator = RoundTripEstimator()
+        self.assertEqual(estimator.timeout_ns, NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
+        estimator.sample(SECOND_NS)
+        self.assertEqual(estimator.smoothed_ns, SECOND_NS)
+        self.assertEqual(estimator.variance_ns, SECOND_NS // 2)
+        self.assertEqual(estimator.timeout_ns, SECOND_NS + 4 * (SECOND_NS // 2))
+
+    def test_later_samples_follow_rfc_6298(self):
+        estimator = RoundTripEstimator()
+        estimator.sample(SECOND_NS)
+        estimator.sample(2 * SECOND_NS)
+        # RTTVAR = 3/4 RTTVAR + 1/4 |SRTT - R|, then SRTT = 7/8 SRTT + 1/8 R, RTO = SRTT + 4 RTTVAR
+        variance = (3 * (SECOND_NS // 2) + SECOND_NS) // 4
+        smoothed = (7 * SECOND_NS + 2 * SECOND_NS) // 8
+        self.assertEqual(estimator.variance_ns, variance)
+        self.assertEqual(estimator.smoothed_ns, smoothed)
+        self.assertEqual(estimator.timeout_ns, smoothed + 4 * variance)
+        self.assertEqual(estimator.samples, 2)
+
+    def test_timeout_is_clamped(self):
+        fast = RoundTripEstimator()
+        for _ in range(20):
+            fast.sample(100_000)
+        self.assertEqual(fast.timeout_ns, MINIMUM)
+        slow = RoundTripEstimator()
+        slow.sample(MAXIMUM)
+        self.assertEqual(slow.timeout_ns, MAXIMUM)
+
+    def test_resend_timeout_backs_off(self):
+        estimator = RoundTripEstimator()
+        estimator.sample(SECOND_NS // 4)
+        timeout = estimator.timeout_ns
+        self.assertEqual([estimator.resend_timeout(attempts) for attempts in range(3)],
+                         [timeout, 2 * timeout, 4 * timeout])
+        self.assertEqual(estimator.resend_timeout(20), MAXIMUM)
+
+    def test_expiry_backs_the_timeout_off_until_the_next_sample(self):
+        estimator = RoundTripEstimator()
+        estimator.sample(SECOND_NS // 10)
+        timeout = estimator.timeout_ns
+        estimator.timed_out()
+        estimator.timed_out()  # Ran out together with the first, still one congestion event
+        self.assertEqual(estimator.timeout_ns, 2 * timeout)
+        estimator.sample(SECOND_NS // 10)
+        self.assertLess(estimator.timeout_ns, 2 * timeout)
+
+    def test_repeat_wait_never_exceeds_the_timeout(self):
+        estimator = RoundTripEstimator()
+        self.assertEqual(estimator.repeat_wait(), min(
+            NetworkCommunicationConstants.WAIT_TIME_BEFORE_REPEAT_REQUEST_NS, estimator.timeout_ns))
+
+    def test_fast_path_waits_less_than_the_unmeasured_defaults(self):
+        estimator = RoundTripEstimator()
+        for _ in range(20):
+            estimator.sample(100_000)  # A loopback round trip
+        self.assertEqual(estimator.repeat_wait(), NetworkCommunicationConstants.MINIMUM_REPEAT_WAIT_NS)
+        self.assertLess(estimator.repeat_wait(), NetworkCommunicationConstants.WAIT_TIME_BEFORE_REPEAT_REQUEST_NS)
+        self.assertLess(estimator.resend_timeout(), NetworkCommunicationConstants.WAIT_RESPONSE_TIME_NS)
+
+    def test_repeat_wait_follows_the_round_trip(self):
+        estimator = RoundTripEstimator()
+        estimator.sample(SECOND_NS // 10)
+        self.assertEqual(estimator.repeat_wait(), SECOND_NS // 10 + 2 * (SECOND_NS // 20))
+
+    def test_retransmitted_messages_are_not_sampled(self):
+        handler = TransactionHandler(lambda packets, recipient: None, 1)
+        first = Packet.Message(b'chat', PayloadType.CHAT, 1)
+        second = Packet.Message(b'chat', PayloadType.CHAT, 1)
+        handler.prepare_message(first, PEER)
+        handler.prepare_message(second, PEER)
+        record = handler.active[(second.messageid, PEER)]  # Handed out locked
+        record.outgoing.retransmitted = True
+        record.release()
+        handler.recv_acknowledgements(first.messageid, b'', PEER)
+        handler.recv_acknowledgements(second.messageid, b'', PEER)
+        self.assertEqual(handler.peers.get(PEER).round_trip.samples, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
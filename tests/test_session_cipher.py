@@ -0,0 +1,85 @@
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import NetworkCommunicationConstants
+
+CHUNK_SIZE = 1_024
+COPY_FREE = NetworkCommunicationConstants.AEAD_COPY_FREE_BYTES
+SIZES = (0, 1, COPY_FREE - 1, COPY_FREE, 100_000)
+CHUNKED_SIZES = (0, 1, CHUNK_SIZE - 1, CHUNK_SIZE, CHUNK_SIZE + 1, 3 * CHUNK_SIZE,
+                 NetworkCommunicationConstants.AEAD_PARALLEL_CHUNKS * CHUNK_SIZE + 17)
+
+
+@unittest.skipIf(importlib.util.find_spec('cryptography') is None, 'SessionCipher is built on cryptography')
+class SessionCipherTest(unittest.TestCase):
+    def setUp(self):
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        import CryptWrapper
+        self.CryptWrapper = CryptWrapper
+        self.aesgcm = AESGCM(AESGCM.generate_key(bit_length=256))
+        self.initiator = CryptWrapper.SessionCipher(self.aesgcm, True)
+        self.responder = CryptWrapper.SessionCipher(self.aesgcm, False)
+
+    def test_initiator_and_responder_nonces_never_meet(self):
+        for _ in range(64):
+            initiator = self.CryptWrapper.SessionCipher(self.aesgcm, True)
+            responder = self.CryptWrapper.SessionCipher(self.aesgcm, False)
+            self.assertTrue(initiator.prefix[0] & self.CryptWrapper.INITIATOR_NONCE_BIT)
+            self.assertFalse(responder.prefix[0] & self.CryptWrapper.INITIATOR_NONCE_BIT)
+            self.assertNotEqual(initiator.nonce(0), responder.nonce(0))
+
+    def test_nonces_count_up(self):
+        frames = [self.initiator.encrypt(b'chat') for _ in range(3)]
+        nonces = [bytes(frame[:self.CryptWrapper.NONCE_LENGTH]) for frame in frames]
+        self.assertEqual(nonces, [self.initiator.nonce(counter) for counter in range(3)])
+
+    def test_round_trip(self):
+        for size in SIZES:
+            with self.subTest(size=size):
+                plaintext = os.urandom(size)
+                frame = self.initiator.encrypt(plaintext)
+                self.assertEqual(len(frame), self.CryptWrapper.SessionCipher.frame_length(size))
+                self.assertEqual(bytes(self.responder.decrypt(frame)), plaintext)
+                # Peers that predate counter nonces read the same nonce || ciphertext frame
+                self.assertEqual(self.CryptWrapper.CryptWrapper.decrypt(self.aesgcm, bytes(frame)), plaintext)
+
+    def test_batch_round_trip(self):
+        plaintexts = [os.urandom(size) for size in (0, 10, 1_000)]
+        frames = self.initiator.encrypt_batch(plaintexts)
+        self.assertEqual(self.responder.decrypt_batch(frames), plaintexts)
+
+    def test_chunked_round_trip(self):
+        for threads in (1, NetworkCommunicationConstants.AEAD_CHUNK_THREADS):
+            with mock.patch.object(self.CryptWrapper, 'chunk_threads', return_value=threads):
+                for size in CHUNKED_SIZES:
+                    with self.subTest(threads=threads, size=size):
+                        plaintext = os.urandom(size)
+                        frame = self.initiator.encrypt_chunked(plaintext, CHUNK_SIZE)
+                        self.assertEqual(bytes(self.responder.decrypt_chunked(frame)), plaintext)
+
+    def test_chunked_frame_is_tamper_evident(self):
+        from cryptography.exceptions import InvalidTag
+        plaintext = os.urandom(3 * CHUNK_SIZE)
+        frame = self.initiator.encrypt_chunked(plaintext, CHUNK_SIZE)
+        header = self.CryptWrapper.NONCE_LENGTH + self.CryptWrapper.CHUNK_SIZE_LENGTH
+        sealed = CHUNK_SIZE + self.CryptWrapper.TAG_LENGTH
+
+        flipped = bytearray(frame)
+        flipped[header + sealed + 5] ^= 1
+        self.assertRaises(InvalidTag, self.responder.decrypt_chunked, flipped)
+
+        # Dropping the last chunk leaves a frame whose new last chunk was not sealed as the last
+        self.assertRaises(InvalidTag, self.responder.decrypt_chunked, frame[:header + 2 * sealed])
+
+        swapped = frame[:header] + frame[header + sealed:header + 2 * sealed] + frame[header:header + sealed] + \
+            frame[header + 2 * sealed:]
+        self.assertRaises(InvalidTag, self.responder.decrypt_chunked, swapped)
+
+
+if __name__ == '__main__':
+    unittest.main()